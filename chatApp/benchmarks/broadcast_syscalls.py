@@ -0,0 +1,100 @@
+import argparse, socket, time
+
+from chatapp.shared import message
+from chatapp.server import outbound
+
+# compares the number of write syscalls (and time spent in them) needed to fan a burst of messages out to many clients:
+#   per message: one send() per client per message, how broadcast_message used to write
+#   batched:     frames queued in each client's Outbound_Queue and written with one sendmsg() per client per loop iteration
+# clients are simulated with unix socketpairs, run with: python -m chatapp.benchmarks.broadcast_syscalls
+
+def create_clients(client_count):
+  pairs = [socket.socketpair() for i in range(client_count)]
+  for server_end, client_end in pairs:
+    server_end.setblocking(False)
+    client_end.setblocking(False)
+  return pairs
+
+def drain(pairs):
+  # reads everything that was written so the next round starts with empty socket buffers
+  for server_end, client_end in pairs:
+    try:
+      while client_end.recv(message.recv_size):
+        pass
+    except BlockingIOError:
+      pass
+
+def create_burst(message_count, body_size):
+  return [message.encode_message(message.create_message(message.config_msg_types['SERVER_TEXT'], msg_body='x' * body_size, username=f'user{i}'))
+          for i in range(message_count)]
+
+def run_per_message(pairs, burst):
+  syscalls = 0
+  start = time.perf_counter()
+
+  for frame in burst:
+    for server_end, client_end in pairs:
+      server_end.sendall(frame)
+      syscalls += 1
+
+  return syscalls, time.perf_counter() - start
+
+def run_batched(pairs, burst):
+  syscalls = 0
+  start = time.perf_counter()
+
+  queues = [outbound.Outbound_Queue() for pair in pairs]
+  for frame in burst:
+    for client_outbound in queues:
+      client_outbound.append(frame)
+
+  for (server_end, client_end), client_outbound in zip(pairs, queues):
+    while client_outbound:
+      client_outbound.flush(server_end)
+      syscalls += 1
+
+  return syscalls, time.perf_counter() - start
+
+def run_benchmark(client_count, message_count, body_size, rounds):
+  pairs = create_clients(client_count)
+  burst = create_burst(message_count, body_size)
+  results = {}
+
+  for name, function in (('per message', run_per_message), ('batched', run_batched)):
+    total_syscalls = 0
+    total_time = 0
+
+    for i in range(rounds):
+      syscalls, elapsed = function(pairs, burst)
+      total_syscalls += syscalls
+      total_time += elapsed
+      drain(pairs)
+
+    results[name] = (total_syscalls, total_time)
+
+  for server_end, client_end in pairs:
+    server_end.close()
+    client_end.close()
+
+  return results
+
+def main():
+  parser = argparse.ArgumentParser(description='Compares write syscalls of per message sends and batched sendmsg for broadcasts')
+  parser.add_argument('--clients', type=int, default=200)
+  parser.add_argument('--messages', type=int, default=50, help='messages per burst')
+  parser.add_argument('--size', type=int, default=100, help='message body size in bytes')
+  parser.add_argument('--rounds', type=int, default=20)
+  args = parser.parse_args()
+
+  results = run_benchmark(args.clients, args.messages, args.size, args.rounds)
+
+  print(f'{args.clients} clients, bursts of {args.messages} messages ({args.size} byte bodies), {args.rounds} rounds')
+  for name, (syscalls, elapsed) in results.items():
+    print(f'{name:>12}: {syscalls:>9} write syscalls, {elapsed * 1000:9.1f} ms')
+
+  per_message_syscalls = results['per message'][0]
+  batched_syscalls = results['batched'][0]
+  print(f'syscall reduction: {per_message_syscalls / batched_syscalls:.1f}x')
+
+if __name__ == '__main__':
+  main()
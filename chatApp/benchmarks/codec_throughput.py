@@ -0,0 +1,56 @@
+import argparse, time
+
+from chatapp.shared import message
+
+# compares the json and binary codecs (see "codecs" in shared_config.json) on typical messages:
+# encode and decode throughput (frames per second, frame header included) and bytes per frame
+# run with: python -m chatapp.benchmarks.codec_throughput
+
+def create_samples(body_size, page_size):
+  server_text = message.create_message(message.config_msg_types['SERVER_TEXT'], msg_body='x' * body_size,
+                                       username='some_user', room_id=12, message_id=1234567)
+  client_text = message.create_message(message.config_msg_types['CLIENT_TEXT'], msg_body='x' * body_size, room_id=12)
+  room_response = message.create_message(message.config_msg_types['ROOM_RESPONSE'], success=True, room_id=12, error_msg='', status_code='')
+  history_response = message.create_message(message.config_msg_types['HISTORY_RESPONSE'], success=True, room_id=12,
+                                            messages=[dict(server_text, message_id=1234567 - i) for i in range(page_size)],
+                                            before_id=1234567 - page_size + 1, error_msg='', status_code='')
+
+  return {'server_text': server_text, 'client_text': client_text, 'room_response': room_response, 'history_response': history_response}
+
+def run_codec(msg, codec, iterations):
+  frame = message.encode_message(msg, codec=codec)
+
+  start = time.perf_counter()
+  for i in range(iterations):
+    message.encode_message(msg, codec=codec)
+  encode_time = time.perf_counter() - start
+
+  frame_buffer = message.Frame_Buffer()
+  start = time.perf_counter()
+  for i in range(iterations):
+    frame_buffer.feed(frame)
+  decode_time = time.perf_counter() - start
+
+  return len(frame), iterations / encode_time, iterations / decode_time
+
+def main():
+  parser = argparse.ArgumentParser(description='Compares encode/decode throughput and frame size of the json and binary codecs')
+  parser.add_argument('--size', type=int, default=100, help='text message body size in bytes')
+  parser.add_argument('--page', type=int, default=50, help='messages per history page')
+  parser.add_argument('--iterations', type=int, default=50000, help='iterations per message (divided by page size for history pages)')
+  args = parser.parse_args()
+
+  print(f'{args.size} byte bodies, history pages of {args.page} messages')
+  print(f'{"message":>17} {"codec":>7} {"bytes":>8} {"encode/s":>10} {"decode/s":>10}')
+
+  for name, msg in create_samples(args.size, args.page).items():
+    iterations = args.iterations if name != 'history_response' else max(args.iterations // args.page, 1)
+    results = {codec: run_codec(msg, codec, iterations) for codec in ('json', 'binary')}
+
+    for codec, (frame_size, encode_rate, decode_rate) in results.items():
+      print(f'{name:>17} {codec:>7} {frame_size:>8} {encode_rate:>10.0f} {decode_rate:>10.0f}')
+
+    print(f'{"":>17} binary frames are {100 - results["binary"][0] * 100 / results["json"][0]:.0f}% smaller')
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,285 @@
+import argparse, asyncio, collections, multiprocessing, os, shutil, signal, socket, tempfile, time
+
+from chatapp.shared import message, compression
+from chatapp.server import server as tcp_server
+from chatapp.server import storage
+
+# load test of a whole server: starts a local server (in its own process, on the memory or a temporary sqlite storage backend) and drives it
+# with simulated clients (bots) speaking the same protocol as client.TCP_Nonblocking_Client
+#   signups:  every bot signs up on its own connection
+#   connects: every bot opens the connection it keeps for the rest of the run
+#   logins:   every bot verifies on that connection and joins one of the rooms
+#   messages: every bot sends bursts of text messages to its room, each message carries its send time so every
+#             delivery (to every member of the room, sender included) gives one end-to-end latency sample
+# signup and login rates are mostly bound by password hashing, see "password_hashing" in server_config.json
+# run with: python -m chatapp.benchmarks.load_test
+
+def raise_open_file_limit():
+  # every bot is one socket in both processes
+  try:
+    import resource
+  except ImportError:
+    return
+
+  soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+  resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def run_server(engine, port, room_count, storage_config):
+  # runs in the server process until it receives SIGINT
+  raise_open_file_limit()
+  db_connector_factory = storage.create_connector_factory(storage_config, None)
+  db_connector = db_connector_factory()
+  db_connector.create_tables_if_needed()
+  for room_id in range(1, room_count + 1):
+    db_connector.insert_room(f'room{room_id}')
+
+  server = tcp_server.create_server(engine, 'localhost', port, verbose_output=False, backlog=4096, db_connector_factory=db_connector_factory)
+  server.listen_for_connections()
+
+def find_free_port():
+  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+    sock.bind(('localhost', 0))
+    return sock.getsockname()[1]
+
+def wait_for_server(port, timeout):
+  deadline = time.monotonic() + timeout
+  while True:
+    try:
+      socket.create_connection(('localhost', port)).close()
+      return
+    except ConnectionRefusedError:
+      if time.monotonic() > deadline:
+        raise
+      time.sleep(0.1)
+
+
+class Bot:
+  # one simulated client, sends and receives the same frames as client.TCP_Nonblocking_Client over an asyncio stream
+  def __init__(self, index, codecs, compressions):
+    self.username = f'bot{index}'
+    self.password = f'password{index}'
+    self.codecs = codecs
+    self.compressions = compressions
+    self.room_id = None
+
+    self.reader = None
+    self.writer = None
+    self.codec = 'json'
+    self.compressor = None
+    self.frame_buffer = None
+    self.pending_messages = collections.deque()
+
+  async def connect(self, port):
+    self.reader, self.writer = await asyncio.open_connection('localhost', port)
+    self.codec = 'json'
+    self.compressor = None
+    self.frame_buffer = message.Frame_Buffer()
+    self.pending_messages.clear()
+
+  def close(self):
+    self.writer.close()
+
+  def send(self, msg):
+    self.writer.write(message.compress_frame(message.encode_message(msg, codec=self.codec), self.compressor))
+
+  async def receive(self):
+    while not self.pending_messages:
+      data = await self.reader.read(message.recv_size)
+      if not data:
+        raise ConnectionError(f'{self.username} was disconnected by the server')
+      self.pending_messages.extend(self.frame_buffer.feed(data))
+
+    return self.pending_messages.popleft()
+
+  async def request(self, msg, response_type):
+    # sends msg and returns the response, anything received in between (ex. backfilled messages) is dropped
+    self.send(msg)
+    response_type = message.config_msg_types[response_type]
+    while True:
+      response = await self.receive()
+      if response['type'] == response_type:
+        return response
+
+  async def sign_up(self, port, stats):
+    await self.connect(port)
+    try:
+      while True:
+        response = await self.request(message.create_message(message.config_msg_types['SIGNUP_REQUEST'], username=self.username, password=self.password), 'SIGNUP_RESPONSE')
+        if response['status_code'] != '503':
+          break
+        stats['busy'] += 1
+        await asyncio.sleep(0.05)
+    finally:
+      self.close()
+
+    if not response['success']:
+      raise ConnectionError(f'{self.username} could not sign up: {response["error_msg"]}')
+
+  async def log_in(self, port, stats):
+    # verifies on the connection opened by connect(), server closes it when busy so it has to reconnect then
+    while True:
+      if self.compressions:
+        self.frame_buffer.decompressor = compression.Frame_Decompressor()
+
+      msg = message.create_message(message.config_msg_types['VERIFICATION_REQUEST'], username=self.username, password=self.password,
+                                   codecs=self.codecs, compression=self.compressions or None)
+      response = await self.request(msg, 'VERIFICATION_RESPONSE')
+      if response['status_code'] != '503':
+        break
+
+      stats['busy'] += 1
+      self.close()
+      await asyncio.sleep(0.05)
+      await self.connect(port)
+
+    if not response['success']:
+      raise ConnectionError(f'{self.username} could not log in: {response["error_msg"]}')
+
+    self.codec = response.get('codec', 'json')
+    if response.get('compression') is not None:
+      self.compressor = compression.create_compressor()
+
+    response = await self.request(message.create_message(message.config_msg_types['JOIN_ROOM_REQUEST'], room_id=self.room_id), 'ROOM_RESPONSE')
+    if not response['success']:
+      raise ConnectionError(f'{self.username} could not join room {self.room_id}: {response["error_msg"]}')
+
+  async def read_loop(self, stats):
+    # records the latency of every message sent by the benchmark, ends once the connection is closed
+    server_text = message.config_msg_types['SERVER_TEXT']
+    ping = message.config_msg_types['PING']
+    latencies = stats['latencies']
+    while True:
+      try:
+        msg = await self.receive()
+      except (ConnectionError, asyncio.CancelledError):
+        return
+
+      if msg['type'] == server_text:
+        latencies.append(time.perf_counter() - float(msg['msg_body'].split(' ', 1)[0]))
+        if len(latencies) == stats['expected']:
+          stats['done'].set()
+      elif msg['type'] == ping:
+        self.send(message.create_message(message.config_msg_types['PONG']))
+
+  async def send_bursts(self, message_count, burst, interval, body_size):
+    client_text = message.config_msg_types['CLIENT_TEXT']
+    sent = 0
+    while sent < message_count:
+      for i in range(min(burst, message_count - sent)):
+        body = f'{time.perf_counter():.9f} '
+        self.send(message.create_message(client_text, msg_body=body.ljust(body_size, 'x'), room_id=self.room_id))
+        sent += 1
+
+      await self.writer.drain()
+      if sent < message_count:
+        await asyncio.sleep(interval)
+
+
+async def run_phase(coroutines, concurrency):
+  # runs coroutines with at most concurrency of them at once, returns seconds it took to finish all of them
+  semaphore = asyncio.Semaphore(concurrency)
+
+  async def run_limited(coroutine):
+    async with semaphore:
+      await coroutine
+
+  start = time.perf_counter()
+  await asyncio.gather(*(run_limited(coroutine) for coroutine in coroutines))
+  return time.perf_counter() - start
+
+async def run_bots(args, port):
+  codecs = [args.codec] if args.codec else message.supported_codecs
+  compressions = [] if args.no_compression else compression.supported_compressions
+  bots = [Bot(index, codecs, compressions) for index in range(args.bots)]
+  for index, bot in enumerate(bots):
+    bot.room_id = index % args.rooms + 1
+
+  room_sizes = collections.Counter(bot.room_id for bot in bots)
+  stats = {'busy': 0, 'latencies': [], 'done': asyncio.Event(),
+           'expected': sum(size * size for size in room_sizes.values()) * args.messages}
+  results = {}
+
+  results['signups'] = await run_phase([bot.sign_up(port, stats) for bot in bots], args.concurrency)
+  results['connects'] = await run_phase([bot.connect(port) for bot in bots], args.concurrency)
+  results['logins'] = await run_phase([bot.log_in(port, stats) for bot in bots], args.concurrency)
+
+  readers = [asyncio.ensure_future(bot.read_loop(stats)) for bot in bots]
+  start = time.perf_counter()
+  await asyncio.gather(*(bot.send_bursts(args.messages, args.burst, args.interval, args.size) for bot in bots))
+  results['sends'] = time.perf_counter() - start
+
+  try:
+    await asyncio.wait_for(stats['done'].wait(), args.timeout)
+  except asyncio.TimeoutError:
+    pass
+  results['deliveries'] = time.perf_counter() - start
+
+  for bot in bots:
+    bot.close()
+  for reader in readers:
+    reader.cancel()
+  await asyncio.gather(*readers, return_exceptions=True)
+
+  return results, stats
+
+def percentile(sorted_values, fraction):
+  return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def print_results(args, results, stats):
+  bot_count = args.bots
+  print(f'{args.engine} engine, {args.storage} storage, {bot_count} bots in {args.rooms} rooms, {args.messages} messages per bot '
+        f'(bursts of {args.burst} every {args.interval:.2f} s, {args.size} byte bodies)')
+
+  for name in ('signups', 'connects', 'logins'):
+    print(f'{name:>10}: {bot_count:>9} in {results[name]:7.2f} s {bot_count / results[name]:>10.0f}/s')
+  print(f'{"":>10}  {stats["busy"]} requests retried because the server was busy')
+
+  sent = bot_count * args.messages
+  latencies = sorted(stats['latencies'])
+  print(f'{"messages":>10}: {sent:>9} in {results["sends"]:7.2f} s {sent / results["sends"]:>10.0f}/s sent')
+  print(f'{"":>10}  {len(latencies):>9} in {results["deliveries"]:7.2f} s {len(latencies) / results["deliveries"]:>10.0f}/s delivered'
+        f' ({stats["expected"] - len(latencies)} missing)')
+
+  if latencies:
+    print(f'{"latency":>10}: ' + ', '.join(f'{name} {percentile(latencies, fraction) * 1000:.2f} ms'
+                                          for name, fraction in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999))) +
+          f', max {latencies[-1] * 1000:.2f} ms')
+
+def main():
+  parser = argparse.ArgumentParser(description='Measures signup/connect/login rates, message throughput and delivery latency of a local server under simulated clients')
+  parser.add_argument('--engine', choices=('select', 'asyncio'), default='select')
+  parser.add_argument('--storage', choices=('memory', 'sqlite'), default='memory', help='storage backend, sqlite uses a temporary file')
+  parser.add_argument('--bots', type=int, default=200)
+  parser.add_argument('--rooms', type=int, default=10)
+  parser.add_argument('--messages', type=int, default=20, help='messages sent by every bot')
+  parser.add_argument('--burst', type=int, default=5, help='messages a bot sends at once')
+  parser.add_argument('--interval', type=float, default=0.1, help='seconds between bursts')
+  parser.add_argument('--size', type=int, default=100, help='message body size in bytes')
+  parser.add_argument('--codec', choices=message.supported_codecs, help='codec offered by bots (default: every supported codec)')
+  parser.add_argument('--no-compression', action='store_true', help="bots don't offer compression")
+  parser.add_argument('--concurrency', type=int, default=100, help='max bots signing up, connecting or logging in at once')
+  parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for all messages to be delivered')
+  args = parser.parse_args()
+
+  raise_open_file_limit()
+  port = find_free_port()
+  temp_dir = tempfile.mkdtemp()
+  storage_config = {'backend': args.storage, 'sqlite_path': os.path.join(temp_dir, 'load_test.db'), 'sqlite_busy_timeout': 5}
+
+  # spawned, so the server process doesn't inherit anything from this one and its loop doesn't compete with the bots
+  server_process = multiprocessing.get_context('spawn').Process(target=run_server, args=(args.engine, port, args.rooms, storage_config))
+  server_process.start()
+  try:
+    wait_for_server(port, 30)
+    results, stats = asyncio.run(run_bots(args, port))
+  finally:
+    os.kill(server_process.pid, signal.SIGINT)
+    server_process.join(10)
+    if server_process.is_alive():
+      server_process.terminate()
+    shutil.rmtree(temp_dir)
+
+  print_results(args, results, stats)
+
+if __name__ == '__main__':
+  main()
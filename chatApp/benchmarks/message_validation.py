@@ -0,0 +1,92 @@
+import argparse, time
+
+from chatapp.shared import message
+
+# compares messages per second through creation and validation:
+#   legacy:  linear search over all message types on every validation, the server checked received messages with
+#            is_type once per possible type until one matched (copied below from before validation was table driven)
+#   current: required fields looked up per type in a table built at import time, received messages validated once by
+#            parse_message and dispatched with a dict lookup
+# run with: python -m chatapp.benchmarks.message_validation
+
+def legacy_remove_null_keys(msg):
+  new_msg = {}
+  for key in msg:
+    if msg[key] != None:
+      new_msg[key] = msg[key]
+  return new_msg
+
+def legacy_valid_message(msg):
+  try:
+    for message_type in message.message_types:
+      if msg['type'] == message_type:
+        for field in message.types_required_fields[message_type]:
+          if msg[field] != None:
+            pass
+          else:
+            return False
+        return True
+
+  except KeyError:
+    return False
+
+def legacy_is_type(msg, type):
+  if legacy_valid_message(msg):
+    if msg['type'] == type:
+      return True
+  return False
+
+def legacy_create_message(type, msg_body=None, username=None, room_id=None, message_id=None):
+  msg = {'type': type, 'msg_body': msg_body, 'username': username, 'password': None,
+         'success': None, 'status_code': None, 'error_msg': None, 'room_id': room_id,
+         'message_id': message_id, 'messages': None, 'before_id': None, 'limit': None,
+         'after_id': None, 'codecs': None, 'codec': None}
+  msg = legacy_remove_null_keys(msg)
+  if legacy_valid_message(msg):
+    return msg
+
+# order the server used to check the types of messages received from verified clients
+legacy_dispatch_order = [message.config_msg_types[type_key] for type_key in ('CLIENT_TEXT', 'JOIN_ROOM_REQUEST', 'LEAVE_ROOM_REQUEST', 'HISTORY_REQUEST')]
+
+def legacy_dispatch(data):
+  for message_type in legacy_dispatch_order:
+    if legacy_is_type(data, message_type):
+      return message_type
+
+handlers = {message_type: message_type for message_type in legacy_dispatch_order}
+
+def current_dispatch(data):
+  msg = message.parse_message(data)
+  if msg is not None:
+    return handlers.get(msg.type)
+
+def run(function, args_list, iterations):
+  start = time.perf_counter()
+  for i in range(iterations):
+    for args in args_list:
+      function(*args)
+  return iterations * len(args_list) / (time.perf_counter() - start)
+
+def main():
+  parser = argparse.ArgumentParser(description='Compares messages per second through creation and validation of legacy and table driven validation')
+  parser.add_argument('--iterations', type=int, default=100000)
+  args = parser.parse_args()
+
+  server_text = message.config_msg_types['SERVER_TEXT']
+  create_args = [(server_text, 'hello', 'some_user', 12, 1234567), (server_text, 'hello', 'some_user', None, 1234568)]
+
+  received = [message.create_message(message.config_msg_types['CLIENT_TEXT'], msg_body='hello', room_id=12),
+              message.create_message(message.config_msg_types['JOIN_ROOM_REQUEST'], room_id=12),
+              message.create_message(message.config_msg_types['HISTORY_REQUEST'], room_id=12, before_id=1234567),
+              {'type': message.config_msg_types['CLIENT_TEXT']}] # invalid, missing msg_body
+  dispatch_args = [(data,) for data in received]
+
+  results = [('create', run(legacy_create_message, create_args, args.iterations), run(message.create_message, create_args, args.iterations)),
+             ('receive + dispatch', run(legacy_dispatch, dispatch_args, args.iterations), run(current_dispatch, dispatch_args, args.iterations))]
+
+  print(f'{"":>18} {"legacy msgs/s":>14} {"current msgs/s":>15} {"speedup":>8}')
+  for name, legacy_rate, current_rate in results:
+    print(f'{name:>18} {legacy_rate:>14.0f} {current_rate:>15.0f} {current_rate / legacy_rate:>7.1f}x')
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,286 @@
+import asyncio, collections, random
+from chatapp.shared import exceptions, message, compression, log
+from chatapp.client import load_client_config
+
+# asyncio based client for programs that keep many sessions in one process (ex. bots and bridges)
+# nothing waits for a round trip: signup, verification and anything sent before the connection is verified are written
+# back to back, the server handles them in order (messages sent before verification are deferred until it is done)
+# a lost connection is reopened with exponential backoff, verifying with room_cursors (the largest message_id received from
+# every room so far) so the server backfills what was missed while disconnected
+# messages sent while disconnected are kept and written once the connection is reopened, messages written right before the
+# connection was lost may not have reached the server and are not sent again
+# run with the loop that runs the session, one loop can run thousands of sessions
+
+logger = log.get_logger('client')
+message_logger = log.get_logger('client', 'messages')
+
+client_config = load_client_config.load_config()
+client_config_reconnect = client_config['reconnect']
+
+
+class Client_Protocol(asyncio.Protocol):
+  # asyncio protocol for a single connection of an Async_TCP_Client, every reconnect creates a new one
+  def __init__(self, client):
+    self.client = client
+    self.transport = None
+
+  def connection_made(self, transport):
+    self.transport = transport
+
+  def data_received(self, data):
+    self.client.receive_data(self, data)
+
+  def connection_lost(self, exc):
+    self.client.connection_lost(self, exc)
+
+  def pause_writing(self):
+    self.client.writable.clear()
+
+  def resume_writing(self):
+    self.client.writable.set()
+
+
+class Async_TCP_Client:
+  def __init__(self, host, port, username, password, verbose_output=True, should_signup=False, message_cache=None):
+    self.host = host
+    self.port = port
+    self.format = 'utf-8'
+
+    self.verbose_output = verbose_output # determines if anything is logged to terminal
+    if verbose_output:
+      log.start()
+
+    self.username = username
+    self.password = password
+    self.should_signup = should_signup # only signs up on the first connection
+
+    self.received_messages = asyncio.Queue() # everything received except responses handled by the client itself (ex. PING)
+    self.after_id = None # sent as after_id, backfill of rooms that aren't in room_cursors starts after it
+    self.room_cursors = {} # room_id -> largest message_id received from the room (None for messages sent to all clients)
+    self.message_cache = message_cache # optional message_cache.Message_Cache, every received message is stored in it
+    if message_cache is not None:
+      # only messages that aren't cached yet are synced
+      self.after_id = message_cache.after_id
+      self.room_cursors = dict(message_cache.room_cursors)
+
+    self.protocol = None # Client_Protocol of the current connection, None while disconnected
+    self.verification = None # future resolved with the VERIFICATION_RESPONSE of the current connection
+    self.codec = 'json'
+    self.compressor = None
+    self.frame_buffer = None
+
+    self.pending_messages = collections.deque() # messages sent while disconnected, written once a connection is opened
+    self.connected = asyncio.Event() # set while the connection is verified
+    self.writable = asyncio.Event() # cleared while the transport's buffer is above its high-water mark, see drain
+    self.writable.set()
+    self.reconnect_task = None
+    self.closing = False
+
+  async def connect(self):
+    # opens the connection and verifies, retrying with backoff while the server can't be reached or is busy
+    # returns True/False if successfully connected, along with message to be displayed by ui incase something goes wrong
+    # once connected, lost connections are reopened in the background until close() is called
+    attempt = 0
+    while True:
+      connected, error_msg, retry = await self.open_connection()
+      if connected or not retry or self.closing:
+        return connected, error_msg
+
+      attempt += 1
+      if client_config_reconnect['max_attempts'] is not None and attempt >= client_config_reconnect['max_attempts']:
+        return False, error_msg
+      await asyncio.sleep(self.backoff_delay(attempt))
+
+  async def open_connection(self):
+    # returns (connected, error_msg, retry), retry is False if the server rejected the login
+    loop = asyncio.get_running_loop()
+    try:
+      logger.info('Connecting to server [%s] on port [%s]...', self.host, self.port)
+      transport, protocol = await loop.create_connection(lambda: Client_Protocol(self), self.host, self.port)
+    except OSError:
+      logger.exception('Encountered an error:')
+      return False, 'Encountered an OSError', True
+
+    if self.closing:
+      transport.close()
+      return False, 'Client was closed', False
+
+    self.protocol = protocol
+    self.verification = loop.create_future()
+    self.codec = 'json'
+    self.compressor = None
+    self.frame_buffer = message.Frame_Buffer(self.format)
+    self.writable.set()
+
+    # offers every supported codec and compression, frames of all of them can be decoded
+    if compression.supported_compressions:
+      self.frame_buffer.decompressor = compression.Frame_Decompressor()
+
+    msgs = []
+    if self.should_signup:
+      msgs.append(message.create_message(message.config_msg_types['SIGNUP_REQUEST'], username=self.username, password=self.password))
+    msgs.append(message.create_message(message.config_msg_types['VERIFICATION_REQUEST'], username=self.username, password=self.password,
+                                       after_id=self.after_id, room_cursors=[list(cursor) for cursor in self.room_cursors.items()] or None,
+                                       codecs=message.supported_codecs,
+                                       compression=compression.supported_compressions or None))
+    sent_pending = list(self.pending_messages)
+    msgs.extend(sent_pending)
+    self.pending_messages.clear()
+    transport.writelines([self.encode_message(msg) for msg in msgs])
+
+    try:
+      response = await self.verification
+    except ConnectionError:
+      self.pending_messages.extendleft(reversed(sent_pending))
+      return False, 'Connection closed by server', True
+
+    if response['success']:
+      logger.info('Username and password verified with server')
+      self.should_signup = False
+      self.connected.set()
+      return True, '', False
+
+    # connection is closed by connect(), so connection_lost doesn't reconnect on its own
+    # messages written behind the verification request were never handled by the server, they are sent again on the next connection
+    self.protocol = None
+    transport.close()
+    self.pending_messages.extendleft(reversed(sent_pending))
+
+    if response['status_code'] == '503':
+      logger.info('Server is busy, retrying')
+      return False, 'Server is busy', True
+
+    logger.info('Username and/or password could not be verified by server')
+    self.closing = True
+    return False, 'Username and/or password could not be verified by server', False
+
+  def backoff_delay(self, attempt):
+    # exponential backoff with jitter, so sessions that lost their connections together don't reconnect together
+    delay = min(client_config_reconnect['initial_delay'] * client_config_reconnect['multiplier'] ** (attempt - 1), client_config_reconnect['max_delay'])
+    return random.uniform(delay / 2, delay)
+
+  async def reconnect(self):
+    connected, error_msg = await self.connect()
+    if not connected:
+      logger.info('Could not reconnect to server: %s', error_msg)
+    self.reconnect_task = None
+
+  def receive_data(self, protocol, data):
+    try:
+      msgs = self.frame_buffer.feed(data)
+    except (ValueError, exceptions.MessageError):
+      # json.JSONDecodeError, UnicodeDecodeError, malformed binary payload or a frame over max_frame_size
+      # stream can't be resynchronized after a corrupt frame, the connection is reopened
+      logger.exception('Encountered error:')
+      protocol.transport.abort()
+      return
+
+    for msg in msgs:
+      if self.message_cache is not None:
+        self.message_cache.add(msg)
+
+      if message.is_type(msg, message.config_msg_types['PING']):
+        # server checks that the connection is still alive, answered here so users of the client never see heartbeats
+        self.write_message(message.create_message(message.config_msg_types['PONG']))
+        continue
+
+      if message.is_type(msg, message.config_msg_types['VERIFICATION_RESPONSE']) and not self.verification.done():
+        if msg['success']:
+          self.codec = msg.get('codec', 'json')
+          if msg.get('compression') is not None:
+            self.compressor = compression.create_compressor()
+        self.verification.set_result(msg)
+        continue
+
+      if message.is_type(msg, message.config_msg_types['SIGNUP_RESPONSE']) and not self.verification.done():
+        logger.info('Signup response from server: %s', msg)
+        continue
+
+      message_id = msg.get('message_id')
+      if message_id is not None and message_id > self.room_cursors.get(msg.get('room_id'), 0):
+        self.room_cursors[msg.get('room_id')] = message_id
+
+      message_logger.info('Received from [SERVER]: %s', msg)
+      self.received_messages.put_nowait(msg)
+
+    if self.message_cache is not None:
+      self.message_cache.flush() # everything received with one recv is written together
+
+  def connection_lost(self, protocol, exc):
+    # only a verified connection is reopened from here, connect() retries connections that weren't verified itself
+    if protocol is not self.protocol:
+      return
+
+    was_connected = self.connected.is_set()
+    self.protocol = None
+    self.connected.clear()
+    self.writable.set()
+    if not self.verification.done():
+      self.verification.set_exception(ConnectionError('Connection closed by server'))
+      return # connect() is still waiting for this connection and retries itself
+
+    if self.closing or not was_connected or self.reconnect_task is not None:
+      return
+
+    logger.info('Connection to server lost, reconnecting...')
+    self.reconnect_task = asyncio.ensure_future(self.reconnect())
+
+  def write_message(self, msg):
+    # writes msg if there is a connection, otherwise it is sent once one is opened
+    # until the connection is verified, messages are encoded with json and written right behind the verification request
+    if self.protocol is None:
+      if len(self.pending_messages) >= client_config['max_pending_messages']:
+        return False, 'Too many messages waiting for the connection'
+      self.pending_messages.append(msg)
+      return True, ''
+
+    frame = self.encode_message(msg)
+    self.protocol.transport.write(frame)
+    message_logger.debug('Sent %s bytes to the server', len(frame))
+    return True, ''
+
+  def encode_message(self, msg):
+    # converts python dict to a frame using the negotiated codec and compression
+    return message.compress_frame(message.encode_message(msg, self.format, self.codec), self.compressor)
+
+  def send_message(self, msg, room_id=None):
+    # sends text to the given room, or to all clients if no room_id is given
+    # texts longer than max_text_length are refused by the server (TEXT_RESPONSE with status code 413), so they aren't sent
+    if len(msg) > message.max_text_length:
+      return False, 'Message is too long'
+    if msg:
+      return self.write_message(message.create_message(message.config_msg_types['CLIENT_TEXT'], msg_body=msg, room_id=room_id))
+    return True, ''
+
+  def join_room(self, room_id):
+    # requests to be added to room, response (ROOM_RESPONSE) is put into received_messages
+    return self.write_message(message.create_message(message.config_msg_types['JOIN_ROOM_REQUEST'], room_id=room_id))
+
+  def leave_room(self, room_id):
+    # requests to be removed from room, response (ROOM_RESPONSE) is put into received_messages
+    return self.write_message(message.create_message(message.config_msg_types['LEAVE_ROOM_REQUEST'], room_id=room_id))
+
+  def request_history(self, room_id, before_id=None, limit=None):
+    # requests a page of stored messages from a room, response (HISTORY_RESPONSE) is put into received_messages
+    return self.write_message(message.create_message(message.config_msg_types['HISTORY_REQUEST'], room_id=room_id, before_id=before_id, limit=limit))
+
+  def request_stats(self):
+    # requests the server's metrics, response (STATS_RESPONSE) is put into received_messages
+    return self.write_message(message.create_message(message.config_msg_types['STATS_REQUEST']))
+
+  async def receive_next_message(self):
+    # waits until a message has been received from the server
+    return await self.received_messages.get()
+
+  async def drain(self):
+    # waits while the transport's buffer is above its high-water mark, call between bursts of sends
+    await self.writable.wait()
+
+  async def close(self):
+    # closes the connection and stops reconnecting, the message cache is left open for its owner to close
+    self.closing = True
+    if self.reconnect_task is not None:
+      self.reconnect_task.cancel()
+      self.reconnect_task = None
+    if self.protocol is not None:
+      self.protocol.transport.close()
@@ -1,80 +1,96 @@
-import socket, threading, traceback, queue, json
-from datetime import datetime
-from chatapp.shared import message
+import socket, threading, queue, collections
+from chatapp.shared import message, compression, log
+from chatapp.client import message_cache
+
+# written to stdout by a background thread, so the read loop never waits on the terminal (see log.py)
+logger = log.get_logger('client')
+message_logger = log.get_logger('client', 'messages')
 
 
 class TCP_Nonblocking_Client:
-  def __init__(self, host, port, username, password, verbose_output=True):
+  def __init__(self, host, port, username, password, verbose_output=True, message_cache=None):
     self.host = host
     self.port = port
     self.sock = None
     self.format = 'utf-8'
     
-    self.verbose_output = verbose_output
+    self.verbose_output = verbose_output # determines if anything is logged to terminal
+    if verbose_output:
+      log.start()
     
     self.username = username
     self.password = password
     
     self.received_messages = queue.Queue()
     
-  def print_tstamp(self, msg):
-    if self.verbose_output:
-      current_time = datetime.now().strftime("%Y-%M-%d %H:%M:%S")
-      print(f'[{current_time}] [CLIENT] {msg}')
-  
+    self.codec = 'json' # codec used for sending, switched to the one chosen by the server once verified
+    self.compressor = None # compression.Frame_Compressor once the server accepted compression
+    self.frame_buffer = message.Frame_Buffer(self.format)
+    self.pending_messages = collections.deque() # messages already parsed from the socket but not yet consumed
+    self.send_lock = threading.Lock() # read_message_loop answers PINGs from its own thread, see send
+    self.message_cache = message_cache # optional message_cache.Message_Cache, received messages are stored in it by read_message_loop
+    
   def create_socket(self):
-    self.print_tstamp('Creating socket...')
+    logger.info('Creating socket...')
     self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    self.print_tstamp(f'Socket created')
+    logger.info('Socket created')
 
-  def connect_to_server(self, should_signup):
+  def connect_to_server(self, should_signup, after_id=None, room_cursors=None):
     # returns True/False if successfully connected, along with message to be displayed by ui incase something goes wrong
+    # room_cursors are [room_id, message_id] pairs of the last message received from each room before reconnecting, the server
+    # then only backfills newer messages, after_id is used for rooms without a cursor
+    # (both default to the message cache's high-water marks, so only messages that aren't cached yet are sent)
+    if after_id is None and room_cursors is None and self.message_cache is not None:
+      after_id = self.message_cache.after_id
+      room_cursors = self.message_cache.get_room_cursors()
+    
     try:
-      self.print_tstamp(f'Connecting to server [{self.host}] on port [{self.port}]...')
+      logger.info('Connecting to server [%s] on port [%s]...', self.host, self.port)
       self.sock.connect((self.host, self.port))
-      self.print_tstamp(f'Connected to server [{self.host}] on port [{self.port}]')
+      logger.info('Connected to server [%s] on port [%s]', self.host, self.port)
 
       if should_signup:
         signup_response = self.send_signup(self.username, self.password)
       
-      self.print_tstamp('Verifying username and password with server...')
+      logger.info('Verifying username and password with server...')
       
-      verification_response = self.send_verification(self.username, self.password)
-      if verification_response['success']:
-        self.print_tstamp('Username and password verified with server')
+      verification_response = self.send_verification(self.username, self.password, after_id, room_cursors)
+      if verification_response and verification_response['success']:
+        logger.info('Username and password verified with server')
         
         return True, ''
         
       else:
-        self.print_tstamp('Username and/or password could not be verified by server')
+        logger.info('Username and/or password could not be verified by server')
         self.shutdown_socket()
         
         return False, 'Username and/or password could not be verified by server'  
 
     except socket.error:
-      self.print_tstamp('Encountered an error:')
-      traceback.print_exc()
+      logger.exception('Encountered an error:')
       
       return False, 'Encountered a socket error'
       
     except OSError as err:
-      self.print_tstamp('Encountered an error:')
-      traceback.print_exc()
+      logger.exception('Encountered an error:')
       
       return False, 'Encountered an OSError'
       
-  def send_verification(self, username, password):
+  def send_verification(self, username, password, after_id=None, room_cursors=None):
     # attempts to verify username, password with server; returns response from server or false if response from server was incorrectly formatted
-    msg = message.create_message(message.config_msg_types['VERIFICATION_REQUEST'], username=username, password=password)
-    msg = json.dumps(msg)
-    msg = msg.encode(self.format)
-    
-    self.sock.send(msg)
-    response = self.sock.recv(128)
-    response = response.decode(self.format)
-    response = json.loads(response)
+    # offers every supported codec and compression, frames of all of them can be decoded
+    if compression.supported_compressions:
+      self.frame_buffer.decompressor = compression.Frame_Decompressor()
+    msg = message.create_message(message.config_msg_types['VERIFICATION_REQUEST'], username=username, password=password, after_id=after_id,
+                                 room_cursors=room_cursors, codecs=message.supported_codecs, compression=compression.supported_compressions or None)
+    self.send(msg)
+    response = self.receive_next_message()
     
-    if message.is_type(response, message.config_msg_types['VERIFICATION_RESPONSE']):
+    if response is not None and message.is_type(response, message.config_msg_types['VERIFICATION_RESPONSE']):
+      if response['success']:
+        self.codec = response.get('codec', 'json')
+        if response.get('compression') is not None:
+          self.compressor = compression.create_compressor()
       return response
     
     return False
@@ -82,66 +98,140 @@ class TCP_Nonblocking_Client:
   def send_signup(self, username, password):
     # attempts to signup new user with username, password
     msg = message.create_message(message.config_msg_types['SIGNUP_REQUEST'], username=username, password=password)
-    msg = json.dumps(msg)
-    msg = msg.encode(self.format)
+    self.send(msg)
+    response = self.receive_next_message()
     
-    self.sock.send(msg)
-    response = self.sock.recv(128)
-    response = response.decode(self.format)
-    response = json.loads(response)
-    
-    if message.is_type(response, message.config_msg_types['SIGNUP_RESPONSE']):
+    if response is not None and message.is_type(response, message.config_msg_types['SIGNUP_RESPONSE']):
       return response
     
     return False
     
-  def send_message(self, msg):
+  def send_message(self, msg, room_id=None):
+    # sends text to the given room, or to all clients if no room_id is given
+    # texts longer than max_text_length are refused by the server (TEXT_RESPONSE with status code 413), so they aren't sent
+    if len(msg) > message.max_text_length:
+      return False, 'Message is too long'
+    
     try:
       if msg:
-        msg = message.create_message(message.config_msg_types['CLIENT_TEXT'], msg_body=msg)
-        msg = json.dumps(msg)  # convert python dict to json string
-        msg = msg.encode(self.format)   # convert json string to utf-8 bytes
-        send_info = self.sock.send(msg) # send json string encoded with utf-8
-        self.print_tstamp(f'Sent {send_info} bytes to the server')
+        msg = message.create_message(message.config_msg_types['CLIENT_TEXT'], msg_body=msg, room_id=room_id)
+        frame = self.send(msg)
+        message_logger.debug('Sent %s bytes to the server', len(frame))
         return True, ''
 
     except OSError as err:
-      self.print_tstamp('Encountered an error:')
-      traceback.print_exc()
+      logger.exception('Encountered an error:')
+      return False, 'Encountered an OSError'
+  
+  def join_room(self, room_id):
+    # requests to be added to room, response (ROOM_RESPONSE) is put into received_messages by read_message_loop
+    return self.send_room_request(message.config_msg_types['JOIN_ROOM_REQUEST'], room_id)
+  
+  def leave_room(self, room_id):
+    # requests to be removed from room, response (ROOM_RESPONSE) is put into received_messages by read_message_loop
+    return self.send_room_request(message.config_msg_types['LEAVE_ROOM_REQUEST'], room_id)
+  
+  def send_room_request(self, type, room_id):
+    try:
+      msg = message.create_message(type, room_id=room_id)
+      self.send(msg)
+      return True, ''
+    
+    except OSError as err:
+      logger.exception('Encountered an error:')
+      return False, 'Encountered an OSError'
+  
+  def request_history(self, room_id, before_id=None, limit=None):
+    # requests a page of stored messages from a room, newest first unless before_id is given (the before_id of the previous HISTORY_RESPONSE)
+    # response (HISTORY_RESPONSE) is put into received_messages by read_message_loop
+    try:
+      msg = message.create_message(message.config_msg_types['HISTORY_REQUEST'], room_id=room_id, before_id=before_id, limit=limit)
+      self.send(msg)
+      return True, ''
+    
+    except OSError as err:
+      logger.exception('Encountered an error:')
       return False, 'Encountered an OSError'
   
+  def request_stats(self):
+    # requests the server's metrics (prometheus text format in msg_body), only answered for users in the server's "admin_users"
+    # response (STATS_RESPONSE) is put into received_messages by read_message_loop
+    try:
+      msg = message.create_message(message.config_msg_types['STATS_REQUEST'])
+      self.send(msg)
+      return True, ''
+    
+    except OSError as err:
+      logger.exception('Encountered an error:')
+      return False, 'Encountered an OSError'
+  
+  def send(self, msg):
+    # encodes message and sends it, returns the sent frame
+    # compressed frames have to be sent in the order they were compressed, so both happen under send_lock
+    with self.send_lock:
+      frame = self.encode_message(msg)
+      self.sock.sendall(frame)
+    return frame
+  
+  def encode_message(self, msg):
+    # converts python dict to a frame using the negotiated codec and compression
+    return message.compress_frame(message.encode_message(msg, self.format, self.codec), self.compressor)
+  
+  def receive_next_message(self):
+    # blocks until a complete message has been received from the server, returns None if connection was closed
+    while not self.pending_messages:
+      data = self.sock.recv(message.recv_size)
+      if not data:
+        return None
+      self.pending_messages.extend(self.frame_buffer.feed(data))
+    
+    return self.pending_messages.popleft()
+  
   def shutdown_socket(self):
-    self.print_tstamp('Closing socket...')
+    logger.info('Closing socket...')
     self.sock.close()
-    self.print_tstamp('Socket closed')
+    logger.info('Socket closed')
     
   def read_message_loop(self):
     # if function returns value then error has occured and interaction should be halted
     while True:
       try:
-        msg = self.sock.recv(1024)    # receive json string encoded with utf-8 from server
-        msg = msg.decode(self.format) # decode msg from utf-8 bytes to json string
-        msg = json.loads(msg)         # decode json string to python dict
+        msg = self.receive_next_message() # receive next framed message from server as python dict
           
       except socket.timeout:
-        self.print_tstamp('Socket timed out, retrying receive')
+        logger.info('Socket timed out, retrying receive')
         continue
 
-      except json.JSONDecodeError:
-        self.print_tstamp('Encountered error: ')
-        traceback.print_exc()
+      except ValueError:
+        # json.JSONDecodeError, UnicodeDecodeError or malformed binary payload
+        # stream can't be resynchronized after a corrupt frame
+        logger.exception('Encountered error:')
+        break
       
       except:
-        self.print_tstamp('Encountered socket error:')
-        traceback.print_exc()
+        logger.exception('Encountered socket error:')
         break
         
-      if msg == '':
+      if msg is None:
         # connection closed by peer, exit loop
-        self.print_tstamp('Connection closed by server')
+        logger.info('Connection closed by server')
         break
+      
+      if self.message_cache is not None:
+        self.message_cache.add(msg)
+        if not self.pending_messages:
+          self.message_cache.flush() # everything received with one recv is written together
+      
+      if message.is_type(msg, message.config_msg_types['PING']):
+        # server checks that the connection is still alive, answered here so users of the client never see heartbeats
+        try:
+          self.send(message.create_message(message.config_msg_types['PONG']))
+        except OSError:
+          logger.exception('Encountered socket error:')
+          break
+        continue
         
-      self.print_tstamp(f'Received from [SERVER]: {msg}')
+      message_logger.info('Received from [SERVER]: %s', msg)
       self.received_messages.put(msg)
 
     self.shutdown_socket()
@@ -162,9 +252,19 @@ def run_client():
     print('Password: ')
     password = input()
     
-    tcp_client = TCP_Nonblocking_Client('localhost', 8080, username, password, True)
+    # cached messages are read before connecting and shown once logged in, the server then only sends newer ones
+    cache = message_cache.open_default('localhost', 8080, username)
+    cached_messages = cache.get_latest_messages(message_cache.client_config_message_cache['startup_messages']) if cache is not None else []
+    
+    tcp_client = TCP_Nonblocking_Client('localhost', 8080, username, password, True, message_cache=cache)
     tcp_client.create_socket()
-    tcp_client.connect_to_server(is_signup)
+    connection_success, connection_msg = tcp_client.connect_to_server(is_signup)
+    if not connection_success:
+      print(connection_msg)
+      return
+    
+    for cached_msg in cached_messages:
+      print(f'{cached_msg["username"]}: {cached_msg["msg_body"]}')
 
     thread = threading.Thread(target=tcp_client.read_message_loop)
     thread.daemon = True
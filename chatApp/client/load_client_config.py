@@ -0,0 +1,8 @@
+import json
+from chatapp import path_util
+
+def load_config():
+  with open(path_util.get_file_path('client', 'client_config.json'), 'r') as client_config_json:
+    client_config = json.load(client_config_json)
+  
+  return client_config
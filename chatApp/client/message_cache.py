@@ -0,0 +1,172 @@
+import os, re, sqlite3, threading
+from chatapp.shared import message
+from chatapp.client import load_client_config
+
+# optional local copy of received messages in a sqlite file, one file per user and server (see "message_cache" in client_config.json)
+# clients show cached messages right away on startup, and verify with room_cursors set to the cache's per-room high-water marks,
+# so the server only sends what was sent to each room since (from its recent messages buffer, without reading the database)
+# received messages are collected by add() and written with a single transaction per flush(), clients flush once they've
+# handled everything a recv returned
+# a room's high-water mark only moves with live (and backfilled) messages of that room, history pages are cached but never
+# move it, so messages of one room can't make the client skip messages it hasn't received yet
+
+client_config = load_client_config.load_config()
+client_config_message_cache = client_config['message_cache']
+
+no_room_id = 0 # stored room_id of messages sent to all clients, primary key columns can't be NULL (rooms start at 1)
+
+def default_path(host, port, username):
+  # file of the given user's cache in the configured directory
+  file_name = re.sub(r'[^\w.-]', '_', f'{username}@{host}_{port}') + '.sqlite3'
+  return os.path.join(os.path.expanduser(client_config_message_cache['directory']), file_name)
+
+def open_default(host, port, username):
+  # returns the user's Message_Cache, or None if caching is disabled
+  if not client_config_message_cache['enabled']:
+    return None
+
+  path = default_path(host, port, username)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  message_cache = Message_Cache(path, client_config_message_cache['max_messages_per_room'])
+  message_cache.trim()
+  return message_cache
+
+
+class Message_Cache:
+  # used by the thread reading from the server and the one showing messages, connection is shared under a lock
+  def __init__(self, path, max_messages_per_room):
+    self.max_messages_per_room = max_messages_per_room
+    self.lock = threading.Lock()
+    self.pending_rows = [] # received messages not written yet
+    self.pending_room_cursors = {}
+
+    self.conn = sqlite3.connect(path, check_same_thread=False)
+    self.cursor = self.conn.cursor()
+
+    self.cursor.execute('PRAGMA journal_mode = WAL;')
+    self.cursor.execute('PRAGMA synchronous = NORMAL;') # losing the last messages on power loss only means they are synced again
+    self.cursor.executescript('''CREATE TABLE IF NOT EXISTS cached_message(
+                                room_id INTEGER NOT NULL,
+                                message_id INTEGER NOT NULL,
+                                username TEXT,
+                                message_body TEXT,
+                                PRIMARY KEY (room_id, message_id)
+                              ) WITHOUT ROWID;
+
+                              CREATE INDEX IF NOT EXISTS cached_message_message_id_idx ON cached_message (message_id);
+
+                              CREATE TABLE IF NOT EXISTS sync_state(
+                                name TEXT PRIMARY KEY,
+                                value INTEGER
+                              );
+
+                              CREATE TABLE IF NOT EXISTS room_cursor(
+                                room_id INTEGER PRIMARY KEY,
+                                message_id INTEGER NOT NULL
+                              );
+                              ''')
+    self.conn.commit()
+    self.after_id = self.read_after_id()
+    self.room_cursors = self.read_room_cursors() # room_id (None for messages sent to all clients) -> largest message_id received
+
+  def read_after_id(self):
+    # single high-water mark of caches written before room cursors, it is sent as after_id for rooms without a cursor
+    self.cursor.execute('''SELECT value FROM sync_state WHERE name = 'high_water_mark';''')
+    row = self.cursor.fetchone()
+    return row[0] if row else None
+
+  def read_room_cursors(self):
+    self.cursor.execute('''SELECT room_id, message_id FROM room_cursor;''')
+    return {None if room_id == no_room_id else room_id: message_id for room_id, message_id in self.cursor.fetchall()}
+
+  def get_room_cursors(self):
+    # room cursors as sent in a VERIFICATION_REQUEST, None if there are none
+    return [[room_id, message_id] for room_id, message_id in self.room_cursors.items()] or None
+
+  def add(self, msg):
+    # collects a received message, SERVER_TEXT messages are cached and so are the pages of HISTORY_RESPONSEs
+    if message.is_type(msg, message.config_msg_types['SERVER_TEXT']):
+      if msg.get('message_id') is None:
+        return
+
+      self.pending_rows.append(self.to_row(msg))
+      room_id = msg.get('room_id')
+      if msg['message_id'] > self.pending_room_cursors.get(room_id, 0):
+        self.pending_room_cursors[room_id] = msg['message_id']
+
+    elif message.is_type(msg, message.config_msg_types['HISTORY_RESPONSE']) and msg['success']:
+      self.pending_rows.extend(self.to_row(page_msg) for page_msg in msg['messages'])
+
+  def to_row(self, msg):
+    room_id = msg.get('room_id')
+    return (no_room_id if room_id is None else room_id, msg['message_id'], msg['username'], msg['msg_body'])
+
+  def flush(self):
+    # writes collected messages in a single transaction
+    if not self.pending_rows:
+      return
+
+    with self.lock:
+      self.cursor.executemany('''INSERT OR IGNORE INTO cached_message (room_id, message_id, username, message_body)
+                              VALUES (?, ?, ?, ?);''', self.pending_rows)
+
+      moved_cursors = [(room_id, message_id) for room_id, message_id in self.pending_room_cursors.items()
+                       if message_id > self.room_cursors.get(room_id, 0)]
+      self.room_cursors.update(moved_cursors)
+      self.cursor.executemany('''INSERT OR REPLACE INTO room_cursor (room_id, message_id)
+                              VALUES (?, ?);''', [(no_room_id if room_id is None else room_id, message_id) for room_id, message_id in moved_cursors])
+      self.conn.commit()
+
+    self.pending_rows = []
+    self.pending_room_cursors = {}
+
+  def get_room_messages(self, room_id, limit):
+    # newest messages of a room (None for messages sent to all clients), oldest first, as SERVER_TEXT messages
+    with self.lock:
+      self.cursor.execute('''SELECT room_id, message_id, username, message_body
+                            FROM cached_message
+                            WHERE room_id = ?
+                            ORDER BY message_id DESC
+                            LIMIT ?;''', (no_room_id if room_id is None else room_id, limit))
+      rows = self.cursor.fetchall()
+
+    rows.reverse()
+    return [self.to_message(row) for row in rows]
+
+  def get_latest_messages(self, limit):
+    # newest messages of every room together, oldest first, used to show something right away on startup
+    with self.lock:
+      self.cursor.execute('''SELECT room_id, message_id, username, message_body
+                            FROM cached_message
+                            ORDER BY message_id DESC
+                            LIMIT ?;''', (limit,))
+      rows = self.cursor.fetchall()
+
+    rows.reverse()
+    return [self.to_message(row) for row in rows]
+
+  def to_message(self, row):
+    room_id, message_id, username, message_body = row
+    return message.create_message(message.config_msg_types['SERVER_TEXT'], msg_body=message_body, username=username,
+                                  room_id=None if room_id == no_room_id else room_id, message_id=message_id)
+
+  def trim(self):
+    # keeps the newest max_messages_per_room messages of every room
+    with self.lock:
+      self.cursor.execute('''SELECT DISTINCT room_id FROM cached_message;''')
+      for room_id, in self.cursor.fetchall():
+        self.cursor.execute('''SELECT message_id
+                              FROM cached_message
+                              WHERE room_id = ?
+                              ORDER BY message_id DESC
+                              LIMIT 1 OFFSET ?;''', (room_id, self.max_messages_per_room))
+        oldest_dropped = self.cursor.fetchone()
+        if oldest_dropped:
+          self.cursor.execute('''DELETE FROM cached_message WHERE room_id = ? AND message_id <= ?;''', (room_id, oldest_dropped[0]))
+      self.conn.commit()
+
+  def close(self):
+    self.flush()
+    with self.lock:
+      self.cursor.close()
+      self.conn.close()
@@ -1,10 +1,14 @@
 from tkinter import *
 from PIL import ImageTk, Image
-import threading
+import queue, threading
 
-from chatapp.client import client
+from chatapp.client import client, message_cache, load_client_config
+from chatapp.shared import message as chat_message
 from chatapp import path_util
 
+client_config = load_client_config.load_config()
+client_config_ui = client_config['ui']
+
 # TODO:
 # -use os.sep instead of \\ when opening files
 
@@ -64,27 +68,37 @@ class Window:
         self.send_message_entry = Entry(self.f, width=28, font=("Times New Roman", 30))
         self.send_message_entry.place(x=26, y=550)
 
+        # cached messages were read before connecting, newer ones are received from the server
+        self.render_lines([self.format_message(cached_msg) for cached_msg in self.cached_messages])
+
         self.f.title('Chat App')
         self.f.geometry("600x700")
+
+        # received messages are rendered by the Tk thread, tkinter widgets can't be used from other threads
+        self.f.after(client_config_ui['render_interval_ms'], self.render_messages)
         
     def connect(self):
         self.username = self.username_entry.get()
         self.password = self.password_entry.get()
 
-        self.tcp_client = client.TCP_Nonblocking_Client('localhost', 8080, self.username, self.password)
+        self.message_cache = message_cache.open_default('localhost', 8080, self.username)
+        self.cached_messages = []
+        if self.message_cache is not None:
+            self.cached_messages = self.message_cache.get_latest_messages(message_cache.client_config_message_cache['startup_messages'])
+
+        self.tcp_client = client.TCP_Nonblocking_Client('localhost', 8080, self.username, self.password, message_cache=self.message_cache)
         self.tcp_client.create_socket()
-        connection_success, connection_msg = self.tcp_client.connect_to_server()
+        connection_success, connection_msg = self.tcp_client.connect_to_server(False)
         
         if not connection_success:
+            if self.message_cache is not None:
+                self.message_cache.close()
             return False, connection_msg
                 
+        # the reading thread only puts messages into tcp_client.received_messages, render_messages shows them
         reading_thread = threading.Thread(target=self.tcp_client.read_message_loop)
         reading_thread.daemon = True
         reading_thread.start()
-        
-        displaying_thread = threading.Thread(target=self.display_messages)
-        displaying_thread.daemon = True
-        displaying_thread.start()
         return True, connection_msg
 
     def display_error(self, error_msg):
@@ -99,10 +113,46 @@ class Window:
         
         return send_success, msg
         
-    def display_messages(self):
-        while True:
-            message = self.tcp_client.received_messages.get()
-            
-            assert isinstance(message, object)
-            self.main_text_box.insert(END, f'{str(message["username"])}: {str(message["content"])}\n')
+    def render_messages(self):
+        # runs on the Tk thread every render_interval_ms, shows up to max_batch received messages with a single insert,
+        # so a busy room costs one widget update per batch instead of one per message
+        if not self.f.winfo_exists():
+            return
+
+        lines = []
+        for i in range(client_config_ui['max_batch']):
+            try:
+                message = self.tcp_client.received_messages.get_nowait()
+            except queue.Empty:
+                break
+
+            if chat_message.is_type(message, chat_message.config_msg_types['SERVER_TEXT']):
+                lines.append(self.format_message(message))
+            elif message.get('success') is False:
+                self.display_error(message['error_msg'])
+
+        self.render_lines(lines)
+
+        # a full batch means more messages are waiting, the next one is rendered as soon as tk handled other events
+        delay = 1 if len(lines) == client_config_ui['max_batch'] else client_config_ui['render_interval_ms']
+        self.f.after(delay, self.render_messages)
+
+    def format_message(self, message):
+        return f'{message["username"]}: {message["msg_body"]}\n'
+
+    def render_lines(self, lines):
+        # appends lines to the chat, keeps at most max_scrollback_lines and only scrolls down if the end was visible
+        if not lines:
+            return
+
+        at_end = self.main_text_box.yview()[1] == 1.0
+        self.main_text_box.insert(END, ''.join(lines))
+
+        line_count = int(self.main_text_box.index('end-1c').split('.')[0]) - 1 # text ends with a newline
+        excess = line_count - client_config_ui['max_scrollback_lines']
+        if excess > 0:
+            self.main_text_box.delete('1.0', f'{excess + 1}.0')
+
+        if at_end:
+            self.main_text_box.see(END)
     
\ No newline at end of file
@@ -0,0 +1,225 @@
+import asyncio
+
+from chatapp.server import server as tcp_server
+
+# asyncio based server engine, selected with "engine": "asyncio" in server_config.json
+# uses the platforms most efficient selector (epoll on linux) instead of select.select(), so the cost of a wakeup
+# depends on the number of active connections instead of the total number of connections and there is no FD_SETSIZE limit
+# all authentication, signup and broadcasting logic is inherited from TCP_Nonblocking_Server,
+# only the transport specific methods are overridden
+
+class Client_Connection(asyncio.Protocol):
+  # asyncio protocol for a single client, instances are used as keys for client_info in place of sockets
+  def __init__(self, server):
+    self.server = server
+    self.transport = None
+
+  def connection_made(self, transport):
+    self.transport = transport
+    self.server.accept_client_connection(self)
+
+  def data_received(self, data):
+    self.server.receive_data(self, data)
+
+  def connection_lost(self, exc):
+    self.server.client_connection_lost(self)
+
+  def pause_writing(self):
+    self.server.pause_writing(self)
+
+  def resume_writing(self):
+    self.server.resume_writing(self)
+
+
+class Bus_Peer_Connection(Client_Connection):
+  # asyncio protocol for a connection to another worker process (see cluster.py)
+  def connection_made(self, transport):
+    self.transport = transport
+    self.server.accept_bus_peer(self)
+
+
+class Async_TCP_Server(tcp_server.TCP_Nonblocking_Server):
+  def __init__(self, *args, **kwargs):
+    self.loop = None
+    self.server = None # asyncio.Server, replaces self.sock of the select engine
+    self.broadcast_scheduled = False
+    self.flush_scheduled = False
+    self.bus_peer_socks = [] # sockets to other workers, wrapped in transports once the loop is running
+
+    super().__init__(*args, **kwargs)
+
+  def configure_server(self):
+    # socket is created by asyncio when listening starts
+    if self.create_tables:
+      tcp_server.logger.info('Initializing database...')
+      self.db_connector.create_tables_if_needed()
+
+  def accept_client_connection(self, client_conn):
+    client_addr = client_conn.transport.get_extra_info('peername')
+    tcp_server.connection_logger.info('Accepted new connection from %s', client_addr)
+
+    if self.metrics:
+      self.metrics.connections_accepted += 1
+    self.client_info[client_conn] = self.new_client_info(client_addr)
+    self.watch_client(client_conn)
+
+  def add_bus_peer(self, peer_sock):
+    self.bus_peer_socks.append(peer_sock)
+
+  def accept_bus_peer(self, peer_conn):
+    self.client_info[peer_conn] = self.new_client_info('bus peer', bus_peer=True)
+    self.bus_peers.append(peer_conn)
+
+  def new_client_info(self, client_addr, bus_peer=False):
+    # frames are collected in outbound during a loop iteration and handed to the transport together,
+    # buffering of data the socket can't accept yet is done by the transport
+    # while the transport's buffer is above its high-water mark (writing_paused), frames stay in outbound,
+    # where the backpressure policy limits them like the select engine's queues
+    client_info = super().new_client_info(client_addr, bus_peer)
+    client_info['writing_paused'] = False
+    return client_info
+
+  def close_client_socket(self, client_conn):
+    client_addr = self.client_info[client_conn]['address']
+    tcp_server.connection_logger.debug('Closing socket from address %s...', client_addr)
+
+    self.write_frames(client_conn) # even if writing is paused, a closing connection won't get any more frames
+    self.pending_writes.discard(client_conn)
+    self.remove_client_info(client_conn)
+    client_conn.transport.close() # any data still buffered by the transport is flushed before closing
+
+    tcp_server.connection_logger.info('Socket closed from address %s', client_addr)
+
+  def abort_client_socket(self, client_conn):
+    # a slow client's transport buffer may never drain, so nothing more is written and the buffer is discarded
+    client_addr = self.client_info[client_conn]['address']
+    self.pending_writes.discard(client_conn)
+    self.remove_client_info(client_conn)
+    client_conn.transport.abort()
+
+    tcp_server.connection_logger.info('Socket aborted from address %s', client_addr)
+
+  def close_client_socket_when_flushed(self, client_conn):
+    # transport already flushes its buffer before closing
+    self.close_client_socket(client_conn)
+
+  def client_connection_lost(self, client_conn):
+    # called by asyncio once the connection is gone, either closed by the client or by close_client_socket()
+    if client_conn in self.client_info:
+      client_addr = self.client_info[client_conn]['address']
+      self.pending_writes.discard(client_conn)
+      self.remove_client_info(client_conn)
+      tcp_server.connection_logger.info('%s disconnected', client_addr)
+
+  def send_to_client(self, client_conn, data, critical=True):
+    # frames are written at the end of the current loop iteration, so all frames queued for a connection
+    # during one iteration are passed to the transport with a single writelines() call
+    super().send_to_client(client_conn, data, critical)
+
+    if not self.flush_scheduled:
+      self.flush_scheduled = True
+      self.loop.call_soon(self.flush_pending_writes)
+
+  def flush_client_socket(self, client_conn):
+    # transport buffers whatever can't be written immediately and only waits for writability while it has data
+    if not self.client_info[client_conn]['writing_paused']:
+      self.write_frames(client_conn)
+
+  def write_frames(self, client_conn):
+    client_info = self.client_info[client_conn]
+    frames = client_info['outbound'].take(client_info['compressor'])
+    if frames:
+      client_conn.transport.writelines(frames)
+
+      # counted once handed to the transport, which writes them as soon as the socket accepts them
+      if self.metrics:
+        self.metrics.bytes_sent += sum(map(len, frames))
+
+  def pause_writing(self, client_conn):
+    # transport's buffer went above its high-water mark, frames are kept in outbound until it drained
+    if client_conn in self.client_info:
+      self.client_info[client_conn]['writing_paused'] = True
+
+  def resume_writing(self, client_conn):
+    if client_conn in self.client_info:
+      self.client_info[client_conn]['writing_paused'] = False
+      self.flush_client_socket(client_conn)
+
+  def flush_pending_writes(self):
+    self.flush_scheduled = False
+
+    for client_conn in self.pending_writes:
+      self.flush_client_socket(client_conn)
+    self.pending_writes.clear()
+
+  def process_message(self, client_conn, data):
+    super().process_message(client_conn, data)
+
+    # messages queued by clients are broadcast once per loop iteration, after all received data has been processed
+    if not self.client_messages.empty() and not self.broadcast_scheduled:
+      self.broadcast_scheduled = True
+      self.loop.call_soon(self.broadcast_pending_messages)
+
+  def broadcast_pending_messages(self):
+    self.broadcast_scheduled = False
+    self.broadcast_message()
+
+  def measure_loop_lag(self, scheduled_time, interval):
+    # runs every interval seconds, how late it runs is how long the loop was busy with other callbacks
+    now = self.loop.time()
+    self.metrics.loop_lag.observe(now - scheduled_time)
+    self.loop.call_later(interval, self.measure_loop_lag, now + interval, interval)
+
+  def run_timers_periodically(self):
+    self.run_timers()
+    self.loop.call_later(self.timers.tick, self.run_timers_periodically)
+
+  def call_from_thread(self, callback, *args):
+    self.loop.call_soon_threadsafe(callback, *args)
+
+  async def serve(self):
+    self.loop = asyncio.get_running_loop()
+
+    if self.metrics:
+      interval = tcp_server.server_config_metrics['loop_lag_interval']
+      self.loop.call_later(interval, self.measure_loop_lag, self.loop.time() + interval, interval)
+
+    self.loop.call_later(self.timers.tick, self.run_timers_periodically)
+
+    tcp_server.logger.info('Binding socket to [%s] on port [%s]...', self.host, self.port)
+    self.server = await self.loop.create_server(lambda: Client_Connection(self), self.host, self.port,
+                                                backlog=self.backlog, reuse_port=self.reuse_port)
+
+    for peer_sock in self.bus_peer_socks:
+      await self.loop.connect_accepted_socket(lambda: Bus_Peer_Connection(self), peer_sock)
+
+    tcp_server.logger.info('Listening for connections...')
+    try:
+      async with self.server:
+        await self.server.serve_forever()
+    finally:
+      # transports have to be closed while the loop is still running
+      for client_conn in list(self.client_info):
+        client_conn.transport.close()
+
+  def listen_for_connections(self):
+    try:
+      asyncio.run(self.serve())
+
+    except KeyboardInterrupt:
+      tcp_server.logger.info('Shutting down server...')
+      self.shutdown_server()
+      tcp_server.logger.info('Server shut down')
+
+  def shutdown_server(self):
+    del self.client_info
+
+    tcp_server.logger.info('Recent message buffer: %s', self.recent_messages.stats())
+    if self.metrics_endpoint is not None:
+      self.metrics_endpoint.shutdown()
+    if self.notification_service is not None:
+      self.notification_service.shutdown()
+    self.db_pool.shutdown()
+    self.hash_pool.shutdown()
+    self.message_persister.shutdown()
+    self.db_connector.shutdown()
@@ -0,0 +1,82 @@
+import itertools, multiprocessing, socket
+
+from chatapp.shared import log
+from chatapp.server import server as tcp_server
+
+# multi-process mode, used when "workers" in server_config.json is larger than 1
+# every worker runs its own server (select or asyncio engine) listening on the same port with SO_REUSEPORT,
+# so the kernel spreads incoming connections over the workers and each worker only parses, authenticates and
+# fans out for its own clients
+# workers are connected to each other by unix socketpairs created before forking (one per pair of workers), this is the
+# local bus used to forward broadcasts: a worker sends every broadcast to all its peers, which fan it out to their clients
+# messages from different workers can reach clients of different workers in a different order
+
+logger = log.get_logger('cluster')
+
+def create_bus(worker_count):
+  # returns a list containing, for each worker, the sockets connecting it to every other worker
+  worker_socks = [[] for i in range(worker_count)]
+
+  for i, j in itertools.combinations(range(worker_count), 2):
+    sock_i, sock_j = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    worker_socks[i].append(sock_i)
+    worker_socks[j].append(sock_j)
+
+  return worker_socks
+
+def run_worker(worker_socks, worker_index, engine, host, port, backlog):
+  worker_count = len(worker_socks)
+
+  # every worker inherits all bus sockets when forked, only its own are kept open,
+  # otherwise a peer wouldn't see the connection close if this worker exits
+  for index, socks in enumerate(worker_socks):
+    if index != worker_index:
+      for sock in socks:
+        sock.close()
+
+  server = tcp_server.create_server(engine, host, port, backlog=backlog, reuse_port=True, create_tables=False,
+                                    worker_index=worker_index, worker_count=worker_count)
+
+  for peer_sock in worker_socks[worker_index]:
+    server.add_bus_peer(peer_sock)
+
+  server.listen_for_connections()
+
+def run_cluster(worker_count, engine, host, port, backlog):
+  log.start() # restarted by every worker once forked, the listener thread isn't inherited
+  if tcp_server.server_config_storage['backend'] == 'memory':
+    logger.error('The memory storage backend keeps its data inside one process, use sqlite or postgres with several workers')
+    return
+
+  # tables are created once before forking instead of concurrently by every worker
+  logger.info('Initializing database...')
+  db_connector = tcp_server.create_connector_factory()()
+  db_connector.create_tables_if_needed()
+  db_connector.shutdown()
+
+  worker_socks = create_bus(worker_count)
+
+  # fork is required so workers inherit the bus sockets
+  context = multiprocessing.get_context('fork')
+  workers = [context.Process(target=run_worker, args=(worker_socks, worker_index, engine, host, port, backlog))
+             for worker_index in range(worker_count)]
+
+  logger.info('Starting %s workers...', worker_count)
+  for worker in workers:
+    worker.start()
+
+  for socks in worker_socks:
+    for sock in socks:
+      sock.close()
+
+  try:
+    for worker in workers:
+      worker.join()
+
+  except KeyboardInterrupt:
+    # workers receive the interrupt as well and shut down on their own
+    logger.info('Waiting for workers to shut down...')
+    for worker in workers:
+      worker.join()
+
+  logger.info('All workers shut down')
@@ -1,12 +1,18 @@
 import psycopg2
+import psycopg2.errors
+import psycopg2.extras
 
-from chatapp.shared import exceptions
+from chatapp.shared import exceptions, log
+from chatapp.server import storage
+
+logger = log.get_logger('server')
 
 # NOTE: psycopg2 requires variables be passed into queries in tuples when using cursor.execute(),
 # with just one variable it is required to add a comma at the end to convert to tuple instead of keeping it as a string
 # ex. cursor.execute('SELECT * FROM users WHERE user_name = %s;', (user_name,))
 
-class DB_Connector:
+class DB_Connector(storage.Storage):
+  # postgres storage backend, see storage.py
   def __init__(self, host, port, dbname, username, password):
     self.conn = psycopg2.connect(host=host,
                                  port=port, 
@@ -21,7 +27,7 @@ class DB_Connector:
     self.cursor.execute('''CREATE TABLE IF NOT EXISTS users(
                           user_id INT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
                           user_name VARCHAR(32) NOT NULL,
-                          user_password_hash VARCHAR(64) NOT NULL
+                          user_password_hash VARCHAR(255) NOT NULL
                         );
 
                         CREATE TABLE IF NOT EXISTS room(
@@ -46,7 +52,7 @@ class DB_Connector:
                         );
 
                         CREATE TABLE IF NOT EXISTS message(
-                          message_id INT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+                          message_id BIGINT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
                           create_date DATE,
                           message_body TEXT,
                           
@@ -62,8 +68,50 @@ class DB_Connector:
                             REFERENCES room(room_id)
                             ON DELETE CASCADE
                         );
+                        
+                        -- history pages are read newest first by (room_id, message_id), see get_room_history
+                        CREATE INDEX IF NOT EXISTS message_room_id_message_id_idx ON message (room_id, message_id);
+                        CREATE INDEX IF NOT EXISTS message_creator_id_message_id_idx ON message (creator_id, message_id);
+                        CREATE INDEX IF NOT EXISTS user_room_user_id_room_id_idx ON user_room (user_id, room_id);
+                        CREATE INDEX IF NOT EXISTS user_room_room_id_idx ON user_room (room_id);
                         ''')
+
+    # columns of tables created by older versions are changed once, ALTER TABLE takes an exclusive lock and
+    # (for message_id) rewrites the table, so it isn't run on every startup
+    # salted hashes (see server/password_hasher.py) are longer than the original sha256 hex digests
+    if self.get_column_type('users', 'user_password_hash') != ('character varying', 255):
+      self.cursor.execute('''ALTER TABLE users ALTER COLUMN user_password_hash TYPE VARCHAR(255);''')
+    # message ids are time based (see server/message_persister.py) and don't fit an INT
+    if self.get_column_type('message', 'message_id') != ('bigint', None):
+      self.cursor.execute('''ALTER TABLE message ALTER COLUMN message_id TYPE BIGINT;''')
+    # user names are unique, so workers signing up the same name at once can't both insert it (see insert_user)
+    # building the index reads the whole table, so it is only done once, and not while a table of an older version has duplicate names
+    if not self.index_exists('users_user_name_key'):
+      duplicate_names = self.get_duplicate_user_names()
+      if duplicate_names:
+        logger.warning('user_name is not unique until duplicate users are renamed or removed: %s', duplicate_names)
+        self.cursor.execute('''CREATE INDEX IF NOT EXISTS users_user_name_idx ON users (user_name);''')
+      else:
+        self.cursor.execute('''CREATE UNIQUE INDEX users_user_name_key ON users (user_name);
+                              DROP INDEX IF EXISTS users_user_name_idx;''')
     self.conn.commit()
+
+  def get_column_type(self, table_name, column_name):
+    # returns (data_type, character_maximum_length) of a column as named by information_schema,
+    # ex. ('bigint', None) or ('character varying', 255), None if the column doesn't exist
+    self.cursor.execute('''SELECT data_type, character_maximum_length FROM information_schema.columns
+                          WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s;''', (table_name, column_name))
+    row = self.cursor.fetchone()
+    return tuple(row) if row else None
+
+  def index_exists(self, index_name):
+    self.cursor.execute('''SELECT 1 FROM pg_indexes WHERE schemaname = current_schema() AND indexname = %s;''', (index_name,))
+    return self.cursor.fetchone() is not None
+
+  def get_duplicate_user_names(self):
+    # returns up to 10 user names that more than one user has
+    self.cursor.execute('''SELECT user_name FROM users GROUP BY user_name HAVING COUNT(*) > 1 ORDER BY user_name LIMIT 10;''')
+    return [row[0] for row in self.cursor.fetchall()]
     
   def insert_user(self, user_name, user_password_hash):
     self.cursor.execute('''SELECT * FROM users WHERE user_name = %s;''', (user_name,))
@@ -72,8 +120,13 @@ class DB_Connector:
     if duplicates:
       raise exceptions.DuplicateUserError(user_name)
       
-    output = self.cursor.execute('''INSERT INTO users (user_name, user_password_hash)
-                        VALUES (%s, %s);''', (user_name, user_password_hash))
+    try:
+      output = self.cursor.execute('''INSERT INTO users (user_name, user_password_hash)
+                          VALUES (%s, %s);''', (user_name, user_password_hash))
+    except psycopg2.errors.UniqueViolation:
+      # another connection inserted the same name after the SELECT above
+      self.conn.rollback()
+      raise exceptions.DuplicateUserError(user_name)
     self.conn.commit()
     return output
     
@@ -93,14 +146,34 @@ class DB_Connector:
     # inserts a message into "message" table
     # doesn't need to check for duplicates since clients could technically send two identical messages without it being a bug
     output = self.cursor.execute('''INSERT INTO message (create_date, message_body, creator_id, room_id) 
-                        VALUES (%d, %-s, %s, %s);''', 
-                        create_date, message_body, creator_id, room_id)
+                        VALUES (%s, %s, %s, %s);''', 
+                        (create_date, message_body, creator_id, room_id))
     self.conn.commit()
     return output
+  
+  def insert_messages(self, messages):
+    # inserts many messages with a single multi-row insert and commit
+    # messages is a list of (message_id, create_date, message_body, creator_id, room_id) tuples,
+    # message ids are allocated by the server so that messages can be delivered before they are stored
+    psycopg2.extras.execute_values(self.cursor, '''INSERT INTO message (message_id, create_date, message_body, creator_id, room_id)
+                                   OVERRIDING SYSTEM VALUE
+                                   VALUES %s;''', messages, page_size=len(messages))
+    self.conn.commit()
+    
+  def get_max_message_id(self):
+    # returns largest message_id in "message" table, 0 if there are no messages
+    self.cursor.execute('''SELECT COALESCE(MAX(message_id), 0) FROM message;''')
+    return self.cursor.fetchone()[0]
     
   def add_user_to_room(self, user_id, room_id):
     # adds a given user to a given room
     # checks for duplicates since a client cant be apart of a room twice
+    self.cursor.execute('''SELECT * FROM room WHERE room_id = %s;''', (room_id,))
+    room = self.cursor.fetchone()
+    
+    if not room:
+      raise exceptions.RoomLookupError(room_id)
+    
     self.cursor.execute('''SELECT * FROM user_room WHERE user_id = %s AND room_id = %s;''', (user_id, room_id))
     duplicates = self.cursor.fetchall()
     
@@ -122,7 +195,7 @@ class DB_Connector:
     
   def get_user_info(self, user_name):
     # returns all information related to given user using user_name to identify user
-    # this function could just be used once per new client connection, by having the server cache the response
+    # the server caches the response in User_Cache (see server/user_cache.py), so this is mostly only queried once per user
     self.cursor.execute('''SELECT * FROM users WHERE user_name = %s;''', (user_name,))
     matches = self.cursor.fetchone() # only "fetchone()" required since there should only be one user with that user_name
     
@@ -133,64 +206,96 @@ class DB_Connector:
       
   def get_user_rooms(self, user_id):
     # returns all rooms a given user is apart of (used to determine: if a user is allowed to read/write messages to this room; gives client data on what rooms to display on gui when user logs on)
-    user_rooms = self.cursor.execute('''SELECT *
-                                    FROM user_room
-                                    INNER JOIN room
-                                    ON user_room.room_id = room.room_id
-                                    WHERE user_room.user_id = %s;''', (user_id,))
+    # each row is (room_id, room_name)
+    self.cursor.execute('''SELECT room.room_id, room.room_name
+                          FROM user_room
+                          INNER JOIN room
+                          ON user_room.room_id = room.room_id
+                          WHERE user_room.user_id = %s;''', (user_id,))
+    user_rooms = self.cursor.fetchall()
     return user_rooms
   
   def get_room_users(self, room_id):
-    # returns all users in a given room
-    room_users = self.cursor.execute('''SELECT *
-                                    FROM room
-                                    WHERE room_id = %s;''', (room_id,))
+    # returns (user_id, user_name) of all users in a given room
+    self.cursor.execute('''SELECT users.user_id, users.user_name
+                          FROM user_room
+                          INNER JOIN users
+                          ON user_room.user_id = users.user_id
+                          WHERE user_room.room_id = %s;''', (room_id,))
+    room_users = self.cursor.fetchall()
     return room_users
   
-  def get_room_messages(self, room_id, start_date, end_date):
-    # returns all messages in a room in a specified range of dates
-    room_messages = self.cursor.execute('''SELECT *
-                                       FROM room
-                                       INNER JOIN message
-                                       ON room.room_id = message.room_id
-                                       WHERE NOT (create_date < %d OR
-                                       create_date > %d) AND
-                                       message.room_id = %s;''', 
-                                       (start_date, end_date, room_id))
+  def get_room_history(self, room_id, before_message_id, limit, after_message_id=0, oldest=False):
+    # returns up to limit messages of a room with a message_id below before_message_id (all messages if it is None)
+    # and above after_message_id, newest messages first are selected (oldest first if oldest is True) but returned oldest first
+    # each row is (message_id, create_date, message_body, user_name)
+    # keyset pagination: the next page starts before the oldest message_id of this one, so every page is a single
+    # range scan of message_room_id_message_id_idx no matter how far back it is
+    if before_message_id is None:
+      before_message_id = 2**63 - 1 # message_id is a BIGINT
+    
+    self.cursor.execute('''SELECT message.message_id, message.create_date, message.message_body, users.user_name
+                          FROM message
+                          INNER JOIN users
+                          ON users.user_id = message.creator_id
+                          WHERE message.room_id = %s
+                          AND message.message_id < %s
+                          AND message.message_id > %s
+                          ORDER BY message.message_id ''' + ('ASC' if oldest else 'DESC') + '''
+                          LIMIT %s;''', (room_id, before_message_id, after_message_id, limit))
+    room_history = self.cursor.fetchall()
+    if not oldest:
+      room_history.reverse()
+    return room_history
+  
+  def get_room_messages(self, room_id, start_date, end_date, limit):
+    # returns up to limit messages in a room in a specified range of dates, oldest first
+    self.cursor.execute('''SELECT *
+                          FROM message
+                          WHERE message.room_id = %s
+                          AND message.create_date BETWEEN %s AND %s
+                          ORDER BY message.message_id
+                          LIMIT %s;''', 
+                          (room_id, start_date, end_date, limit))
+    room_messages = self.cursor.fetchall()
     return room_messages
   
-  def get_user_messages(self, user_id, start_date, end_date):
-    # returns all messages a given user has received in a specified date range from all rooms the user is apart of
-    user_messages = self.cursor.execute('''SELECT room.*, message.*
-                                  FROM users
-                                  INNER JOIN user_room
-                                  ON users.user_id = user_room.user_id
-                                  INNER JOIN room
-                                  ON room.room_id = user_room.room_id
-                                  INNER JOIN message
-                                  ON message.room_id = room.room_id
-                                  WHERE NOT (message.create_date < %d 
-                                  OR message.create_date > %d) 
-                                  AND users.user_id = 1;''', (start_date, end_date, user_id))
+  def get_user_messages(self, user_id, start_date, end_date, limit):
+    # returns up to limit messages a given user has received in a specified date range from all rooms the user is apart of, oldest first
+    self.cursor.execute('''SELECT room.*, message.*
+                          FROM user_room
+                          INNER JOIN room
+                          ON room.room_id = user_room.room_id
+                          INNER JOIN message
+                          ON message.room_id = room.room_id
+                          WHERE user_room.user_id = %s
+                          AND message.create_date BETWEEN %s AND %s
+                          ORDER BY message.message_id
+                          LIMIT %s;''', (user_id, start_date, end_date, limit))
+    user_messages = self.cursor.fetchall()
     return user_messages
   
-  def get_user_room_messages(self, user_id, room_id, start_date, end_date):
-    # returns messages in a specified date range of a specific user in a specific room
+  def get_user_room_messages(self, user_id, room_id, start_date, end_date, limit):
+    # returns up to limit messages in a specified date range of a specific user in a specific room, oldest first
     # date range, 1 user, 1 room
-    messages = self.cursor.execute('''SELECT room.*, message.*
-                                  FROM users
-                                  INNER JOIN user_room
-                                  ON users.user_id = user_room.user_id
-                                  INNER JOIN room
-                                  ON room.room_id = user_room.room_id
-                                  INNER JOIN message
-                                  ON message.room_id = room.room_id
-                                  WHERE NOT (message.create_date < %d 
-                                  OR message.create_date > %d) 
-                                  AND message.room_id = %s
-                                  AND users.user_id = 1;''', (start_date, end_date, room_id, user_id))
+    self.cursor.execute('''SELECT room.*, message.*
+                          FROM user_room
+                          INNER JOIN room
+                          ON room.room_id = user_room.room_id
+                          INNER JOIN message
+                          ON message.room_id = room.room_id
+                          WHERE user_room.user_id = %s
+                          AND message.room_id = %s
+                          AND message.create_date BETWEEN %s AND %s
+                          ORDER BY message.message_id
+                          LIMIT %s;''', (user_id, room_id, start_date, end_date, limit))
+    messages = self.cursor.fetchall()
     return messages
     
+  def rollback(self):
+    # aborts current transaction, required after a failed statement before the connection can be used again
+    self.conn.rollback()
+    
   def shutdown(self):
     self.cursor.close()
     self.conn.close()
\ No newline at end of file
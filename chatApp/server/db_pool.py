@@ -0,0 +1,60 @@
+import threading, time
+from concurrent import futures
+
+from chatapp.shared import exceptions
+
+class DB_Pool:
+  # bounded pool of database connections, every worker thread owns one connector
+  # queries are submitted from the event loop and return a concurrent.futures.Future, so the loop never waits on the database
+  def __init__(self, connector_factory, size, max_pending, metrics=None):
+    # connector_factory -- function returning a new connector, called once by every worker thread
+    # size -- number of worker threads (and database connections)
+    # max_pending -- max number of submitted queries that haven't finished yet, submitting more raises DataBaseBusyError
+    # metrics -- metrics.Server_Metrics the duration of every call is recorded in, None to not record anything
+    self.connector_factory = connector_factory
+    self.local = threading.local()
+    self.connectors = []
+    self.connectors_lock = threading.Lock()
+    self.pending = threading.BoundedSemaphore(max_pending)
+    self.metrics = metrics
+
+    self.executor = futures.ThreadPoolExecutor(max_workers=size, thread_name_prefix='db_pool', initializer=self.init_worker)
+
+  def init_worker(self):
+    self.local.connector = self.connector_factory()
+    with self.connectors_lock:
+      self.connectors.append(self.local.connector)
+
+  def submit(self, function, *args):
+    # runs function(connector, *args) on a worker thread, function can also be the name of a connector method,
+    # ex. submit('get_user_info', user_name) runs connector.get_user_info(user_name)
+    if not self.pending.acquire(blocking=False):
+      raise exceptions.DataBaseBusyError()
+
+    future = self.executor.submit(self.run, function, args)
+    future.add_done_callback(lambda f: self.pending.release())
+    return future
+
+  def run(self, function, args):
+    connector = self.local.connector
+    start = time.perf_counter()
+    failed = False
+    try:
+      if isinstance(function, str):
+        return getattr(connector, function)(*args)
+      return function(connector, *args)
+    except Exception:
+      failed = True
+      # leaves connection usable for the next query after a failed statement
+      connector.rollback()
+      raise
+    finally:
+      if self.metrics is not None:
+        method = function if isinstance(function, str) else function.__name__
+        self.metrics.observe_db_call(method, time.perf_counter() - start, failed)
+
+  def shutdown(self):
+    self.executor.shutdown(wait=True)
+
+    for connector in self.connectors:
+      connector.shutdown()
@@ -0,0 +1,143 @@
+import bisect, collections, threading
+from datetime import datetime
+
+from chatapp.shared import exceptions
+from chatapp.server import storage
+
+# in-process storage backend, see storage.py
+# nothing is written anywhere, everything is lost when the server stops
+
+def to_date(value):
+  # like the DATE columns of the other backends, only the date of a datetime is kept
+  if isinstance(value, datetime):
+    return value.date()
+  return value
+
+class Memory_Store:
+  # data shared by all Memory_Connectors of a process, every access holds lock
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.users = {} # user_name -> (user_id, user_name, user_password_hash)
+    self.user_names = {} # user_id -> user_name
+    self.rooms = {} # room_id -> room_name
+    self.user_rooms = set() # (user_id, room_id)
+    self.message_ids = collections.defaultdict(list) # room_id -> sorted message_ids of the room
+    self.messages = collections.defaultdict(list) # room_id -> message rows in the same order as message_ids
+    self.max_message_id = 0
+
+class Memory_Connector(storage.Storage):
+  def __init__(self, store):
+    self.store = store
+
+  def create_tables_if_needed(self):
+    pass
+
+  def insert_user(self, user_name, user_password_hash):
+    with self.store.lock:
+      if user_name in self.store.users:
+        raise exceptions.DuplicateUserError(user_name)
+
+      user_id = len(self.store.users) + 1
+      self.store.users[user_name] = (user_id, user_name, user_password_hash)
+      self.store.user_names[user_id] = user_name
+
+  def insert_room(self, room_name):
+    with self.store.lock:
+      if room_name in self.store.rooms.values():
+        raise exceptions.DuplicateRoomError(room_name)
+
+      self.store.rooms[len(self.store.rooms) + 1] = room_name
+
+  def insert_message(self, create_date, message_body, creator_id, room_id):
+    with self.store.lock:
+      self.insert_row(self.store.max_message_id + 1, create_date, message_body, creator_id, room_id)
+
+  def insert_messages(self, messages):
+    with self.store.lock:
+      for row in messages:
+        self.insert_row(*row)
+
+  def insert_row(self, message_id, create_date, message_body, creator_id, room_id):
+    # caller holds lock
+    # usually appended at the end, batches of the message persister can arrive slightly out of order
+    message_ids = self.store.message_ids[room_id]
+    index = bisect.bisect(message_ids, message_id)
+    message_ids.insert(index, message_id)
+    self.store.messages[room_id].insert(index, (message_id, to_date(create_date), message_body, creator_id, room_id))
+    self.store.max_message_id = max(message_id, self.store.max_message_id)
+
+  def get_max_message_id(self):
+    with self.store.lock:
+      return self.store.max_message_id
+
+  def add_user_to_room(self, user_id, room_id):
+    with self.store.lock:
+      if room_id not in self.store.rooms:
+        raise exceptions.RoomLookupError(room_id)
+
+      if (user_id, room_id) in self.store.user_rooms:
+        raise exceptions.DuplicateUserRoomError(user_id, room_id)
+
+      self.store.user_rooms.add((user_id, room_id))
+
+  def remove_user_from_room(self, user_id, room_id):
+    with self.store.lock:
+      self.store.user_rooms.discard((user_id, room_id))
+
+  def get_user_info(self, user_name):
+    with self.store.lock:
+      if user_name not in self.store.users:
+        raise exceptions.ClientLookupError(user_name)
+
+      return self.store.users[user_name]
+
+  def get_user_rooms(self, user_id):
+    with self.store.lock:
+      return [(room_id, room_name) for room_id, room_name in self.store.rooms.items() if (user_id, room_id) in self.store.user_rooms]
+
+  def get_room_users(self, room_id):
+    with self.store.lock:
+      return [(user_id, user_name) for user_id, user_name in self.store.user_names.items() if (user_id, room_id) in self.store.user_rooms]
+
+  def get_room_history(self, room_id, before_message_id, limit, after_message_id=0, oldest=False):
+    with self.store.lock:
+      message_ids = self.store.message_ids.get(room_id, [])
+      start = bisect.bisect_right(message_ids, after_message_id)
+      end = len(message_ids) if before_message_id is None else bisect.bisect_left(message_ids, before_message_id)
+
+      if oldest:
+        rows = self.store.messages[room_id][start:min(end, start + limit)]
+      else:
+        rows = self.store.messages[room_id][max(start, end - limit):end]
+      return [(message_id, create_date, message_body, self.store.user_names[creator_id])
+              for message_id, create_date, message_body, creator_id, message_room_id in rows]
+
+  def get_room_messages(self, room_id, start_date, end_date, limit):
+    with self.store.lock:
+      return self.select_messages([room_id], start_date, end_date, limit)
+
+  def get_user_messages(self, user_id, start_date, end_date, limit):
+    with self.store.lock:
+      room_ids = [room_id for room_id in self.store.rooms if (user_id, room_id) in self.store.user_rooms]
+      return self.select_user_messages(room_ids, start_date, end_date, limit)
+
+  def get_user_room_messages(self, user_id, room_id, start_date, end_date, limit):
+    with self.store.lock:
+      room_ids = [room_id] if (user_id, room_id) in self.store.user_rooms else []
+      return self.select_user_messages(room_ids, start_date, end_date, limit)
+
+  def select_messages(self, room_ids, start_date, end_date, limit):
+    # message rows of the rooms between start_date and end_date, oldest first, caller holds lock
+    start_date, end_date = to_date(start_date), to_date(end_date)
+    rows = [row for room_id in room_ids for row in self.store.messages.get(room_id, ()) if start_date <= row[1] <= end_date]
+    rows.sort()
+    return rows[:limit]
+
+  def select_user_messages(self, room_ids, start_date, end_date, limit):
+    return [(row[4], self.store.rooms[row[4]], *row) for row in self.select_messages(room_ids, start_date, end_date, limit)]
+
+  def rollback(self):
+    pass
+
+  def shutdown(self):
+    pass
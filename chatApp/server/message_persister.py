@@ -0,0 +1,134 @@
+import queue, threading, time
+from datetime import datetime
+
+from chatapp.shared import log
+
+error_logger = log.get_logger('server', 'errors')
+
+class Message_Id_Allocator:
+  # hands out message ids without asking the database, so a message can be delivered before it is stored
+  # an id is the time it was handed out (milliseconds since id_epoch), the worker's index and a counter of ids handed out
+  # within that millisecond: ids of all workers increase with time and workers never hand out the same id
+  # the counter continues in the next millisecond when it runs out or the clock goes back, so ids of a worker always increase
+  # ids start above the largest id already in the database (ex. of a clock that was set back), after a restart
+  # (even after a crash that lost messages which were never stored) ids continue from the current time
+  id_epoch = 1704067200000 # 2024-01-01 UTC in milliseconds
+  worker_bits = 10
+  sequence_bits = 12
+  max_workers = 1 << worker_bits
+  max_sequence = (1 << sequence_bits) - 1
+
+  def __init__(self, max_message_id, worker_index=0, worker_count=1):
+    if worker_count > self.max_workers:
+      raise ValueError(f'Message ids can only be handed out by up to {self.max_workers} workers')
+
+    self.worker_index = worker_index
+    self.last_time = max_message_id >> (self.worker_bits + self.sequence_bits)
+    self.sequence = self.max_sequence # first id is from a later millisecond than max_message_id
+
+  def next(self):
+    now = int(time.time() * 1000) - self.id_epoch
+    if now > self.last_time:
+      self.last_time = now
+      self.sequence = 0
+    elif self.sequence < self.max_sequence:
+      self.sequence += 1
+    else:
+      self.last_time += 1
+      self.sequence = 0
+    return (self.last_time << (self.worker_bits + self.sequence_bits)) | (self.worker_index << self.sequence_bits) | self.sequence
+
+
+class Message_Persister:
+  # write-behind storage of chat messages
+  # the loop thread only puts messages into a bounded queue, a background thread writes them to the "message" table
+  # in batches of up to batch_size rows, or whatever has arrived after flush_interval seconds
+  # if the queue is full (database can't keep up) messages are dropped from storage, delivery is never held up
+  # a batch that can't be written is retried up to max_retries times, retry_delay seconds apart, with a new connector
+  # (the connection may have been lost), then it is logged and counted as failed and the next batch is attempted
+  def __init__(self, connector_factory, batch_size, flush_interval, max_queue, max_retries, retry_delay):
+    self.connector_factory = connector_factory
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.max_retries = max_retries
+    self.retry_delay = retry_delay
+
+    self.messages = queue.Queue(max_queue)
+    self.dropped = 0 # messages that couldn't be queued, only changed by the loop thread
+    self.failed = 0 # messages that couldn't be written, only changed by the background thread
+    self.stopping = threading.Event()
+
+    self.thread = threading.Thread(target=self.write_loop, name='message_persister', daemon=True)
+    self.thread.start()
+
+  def submit(self, message_id, message_body, creator_id, room_id):
+    # called by the loop thread, never blocks
+    try:
+      self.messages.put_nowait((message_id, datetime.now(), message_body, creator_id, room_id))
+      return True
+    except queue.Full:
+      self.dropped += 1
+      return False
+
+  def collect_batch(self):
+    # waits for the first message, then collects more until the batch is full or flush_interval has passed
+    batch = []
+    try:
+      batch.append(self.messages.get(timeout=self.flush_interval))
+    except queue.Empty:
+      return batch
+
+    deadline = time.monotonic() + self.flush_interval
+    while len(batch) < self.batch_size:
+      remaining = deadline - time.monotonic()
+      try:
+        if remaining > 0:
+          batch.append(self.messages.get(timeout=remaining))
+        else:
+          batch.append(self.messages.get_nowait())
+      except queue.Empty:
+        break
+
+    return batch
+
+  def write_loop(self):
+    connector = None
+
+    while not self.stopping.is_set() or not self.messages.empty():
+      batch = self.collect_batch()
+      if batch:
+        connector = self.write_batch(connector, batch)
+
+    if connector is not None:
+      self.close_connector(connector)
+
+  def write_batch(self, connector, batch):
+    # returns the connector to write the next batch with, None if it had to be closed
+    for attempt in range(self.max_retries + 1):
+      try:
+        if connector is None:
+          connector = self.connector_factory()
+        connector.insert_messages(batch)
+        return connector
+      except Exception:
+        error_logger.exception('Message persister could not store %s messages (attempt %s of %s):', len(batch), attempt + 1, self.max_retries + 1)
+        if connector is not None:
+          self.close_connector(connector)
+          connector = None
+
+      if attempt < self.max_retries:
+        self.stopping.wait(self.retry_delay) # isn't waited for while shutting down
+
+    self.failed += len(batch)
+    return connector
+
+  def close_connector(self, connector):
+    try:
+      connector.shutdown()
+    except Exception:
+      error_logger.exception('Message persister could not close its connector:')
+
+  def shutdown(self):
+    # writes everything that is still queued, then stops the background thread
+    self.stopping.set()
+    self.thread.join()
@@ -0,0 +1,149 @@
+import bisect, collections, http.server, threading, time
+
+# counters and histograms of a server, enabled by "enabled" in the "metrics" section of server_config.json
+# when disabled the server's metrics attribute is None and every instrumented spot only checks that,
+# values that can be read from the server's state (ex. number of connections) are only collected when metrics are rendered
+# rendered in the prometheus text format, for STATS_REQUEST and the optional http endpoint (Metrics_Endpoint)
+
+latency_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # seconds
+depth_buckets = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+class Histogram:
+  # counts observed values per bucket (upper bounds, ascending), cumulative counts are only computed when rendered
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1) # last one counts values above every bucket
+    self.sum = 0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def render(self, name, labels=''):
+    # labels -- already formatted labels without braces, ex. 'method="insert_user"'
+    lines = []
+    cumulative = 0
+    separator = ',' if labels else ''
+    for bucket, count in zip((*self.buckets, '+Inf'), self.counts):
+      cumulative += count
+      lines.append(f'{name}_bucket{{{labels}{separator}le="{bucket}"}} {cumulative}')
+
+    labels = f'{{{labels}}}' if labels else ''
+    lines.append(f'{name}_sum{labels} {self.sum}')
+    lines.append(f'{name}_count{labels} {self.count}')
+    return lines
+
+
+class Server_Metrics:
+  # only changed by the loop thread, except database calls which are observed by database pool threads (guarded by db_lock)
+  def __init__(self):
+    self.start_time = time.time()
+
+    self.bytes_received = 0
+    self.bytes_sent = 0
+    self.connections_accepted = 0
+    self.messages_received = collections.Counter() # message type -> messages received from clients
+    self.messages_broadcast = 0
+    self.frames_dropped = collections.Counter() # backpressure policy -> frames not delivered to slow clients
+    self.slow_client_disconnects = collections.Counter() # reason ('queue_limit' or 'max_lag') -> slow clients disconnected
+    self.connection_timeouts = collections.Counter() # deadline ('auth', 'heartbeat' or 'write') -> connections closed for missing it
+
+    self.loop_iteration = Histogram(latency_buckets) # select engine: time spent handling the sockets returned by one select()
+    self.loop_lag = Histogram(latency_buckets) # asyncio engine: how late periodic callbacks run, grows with time spent in callbacks
+    self.client_messages_depth = Histogram(depth_buckets) # client_messages queued when broadcast_message drains them
+
+    self.db_lock = threading.Lock()
+    self.db_calls = {} # method name -> Histogram of call durations
+    self.db_errors = collections.Counter() # method name -> calls that raised
+
+  def observe_db_call(self, method, seconds, failed):
+    # called by database pool threads
+    with self.db_lock:
+      histogram = self.db_calls.get(method)
+      if histogram is None:
+        histogram = self.db_calls[method] = Histogram(latency_buckets)
+      histogram.observe(seconds)
+
+      if failed:
+        self.db_errors[method] += 1
+
+  def render(self, collected):
+    # returns all metrics in the prometheus text format, called by the loop thread
+    # collected -- list of (name, type, help, value) collected from the server's state when rendering
+    lines = []
+
+    def add(name, kind, help, samples):
+      lines.append(f'# HELP {name} {help}')
+      lines.append(f'# TYPE {name} {kind}')
+      lines.extend(samples)
+
+    add('chatapp_uptime_seconds', 'gauge', 'Seconds since the server started', [f'chatapp_uptime_seconds {time.time() - self.start_time:.3f}'])
+    add('chatapp_bytes_received_total', 'counter', 'Bytes received from connections', [f'chatapp_bytes_received_total {self.bytes_received}'])
+    add('chatapp_bytes_sent_total', 'counter', 'Bytes written to connections', [f'chatapp_bytes_sent_total {self.bytes_sent}'])
+    add('chatapp_connections_accepted_total', 'counter', 'Connections accepted', [f'chatapp_connections_accepted_total {self.connections_accepted}'])
+    add('chatapp_messages_received_total', 'counter', 'Valid messages received from clients by type',
+        [f'chatapp_messages_received_total{{type="{type}"}} {count}' for type, count in sorted(self.messages_received.items())])
+    add('chatapp_messages_broadcast_total', 'counter', 'Text messages fanned out', [f'chatapp_messages_broadcast_total {self.messages_broadcast}'])
+    add('chatapp_backpressure_frames_dropped_total', 'counter', 'Frames not delivered to slow clients by backpressure policy',
+        [f'chatapp_backpressure_frames_dropped_total{{policy="{policy}"}} {count}' for policy, count in sorted(self.frames_dropped.items())])
+    add('chatapp_slow_client_disconnects_total', 'counter', 'Slow clients disconnected by reason',
+        [f'chatapp_slow_client_disconnects_total{{reason="{reason}"}} {count}' for reason, count in sorted(self.slow_client_disconnects.items())])
+    add('chatapp_connection_timeouts_total', 'counter', 'Connections closed for missing a deadline by deadline',
+        [f'chatapp_connection_timeouts_total{{deadline="{deadline}"}} {count}' for deadline, count in sorted(self.connection_timeouts.items())])
+
+    for name, kind, help, value in collected:
+      add(name, kind, help, [f'{name} {value}'])
+
+    add('chatapp_loop_iteration_seconds', 'histogram', 'Time spent per select loop iteration, excluding the wait in select()',
+        self.loop_iteration.render('chatapp_loop_iteration_seconds'))
+    add('chatapp_loop_lag_seconds', 'histogram', 'Delay of periodic callbacks of the asyncio loop', self.loop_lag.render('chatapp_loop_lag_seconds'))
+    add('chatapp_client_messages_depth', 'histogram', 'Messages waiting to be broadcast when the queue is drained',
+        self.client_messages_depth.render('chatapp_client_messages_depth'))
+
+    with self.db_lock:
+      db_call_lines = []
+      for method, histogram in sorted(self.db_calls.items()):
+        db_call_lines.extend(histogram.render('chatapp_db_call_seconds', f'method="{method}"'))
+      db_error_lines = [f'chatapp_db_call_errors_total{{method="{method}"}} {count}' for method, count in sorted(self.db_errors.items())]
+
+    add('chatapp_db_call_seconds', 'histogram', 'Duration of database calls by connector method', db_call_lines)
+    add('chatapp_db_call_errors_total', 'counter', 'Database calls that raised by connector method', db_error_lines)
+
+    return '\n'.join(lines) + '\n'
+
+
+class Metrics_Endpoint:
+  # serves the metrics of a server at http://host:port/metrics on a background thread
+  # render_metrics is called by the request threads and has to be thread safe (see TCP_Nonblocking_Server.render_metrics_from_thread)
+  def __init__(self, host, port, render_metrics):
+    class Request_Handler(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path != '/metrics':
+          self.send_error(404)
+          return
+
+        try:
+          body = render_metrics().encode('utf-8')
+        except Exception:
+          self.send_error(503)
+          return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass # scrapes aren't logged
+
+    self.http_server = http.server.ThreadingHTTPServer((host, port), Request_Handler)
+    self.http_server.daemon_threads = True
+    self.thread = threading.Thread(target=self.http_server.serve_forever, name='metrics_endpoint', daemon=True)
+    self.thread.start()
+
+  def shutdown(self):
+    self.http_server.shutdown()
+    self.http_server.server_close()
@@ -0,0 +1,377 @@
+import asyncio, bisect, hashlib, hmac, json, secrets, threading, time, urllib.parse
+
+from chatapp.shared import exceptions, message, log
+from chatapp.server import user_cache
+
+# http api for clients in offline mode, they poll it for messages of their rooms instead of keeping a tcp connection
+#   POST /login          {"username": ..., "password": ...} -> {"token": ..., "expires_at": ...}
+#   GET  /notifications  with "Authorization: Bearer <token>", optional query parameters:
+#                          cursors -- message_id the client has seen everything up to in each room, ex. "all:120,3:118"
+#                                     ("all" for messages sent to all clients), the response's "cursors" in the same format
+#                          since   -- message_id the client has seen everything up to in rooms that aren't in cursors
+#                                     both are stored as the user's cursors and used if a poll leaves both out
+#                          wait    -- seconds to hold the request open while no room has anything newer than its cursor (long-poll)
+#                        -> {"cursors": {room_id: ...}, "cursor": ..., "unread": {room_id: count}, "messages": [SERVER_TEXT ...],
+#                            "truncated": [room_id ...]}, rooms are keyed like in cursors everywhere
+# responses carry an ETag, a hash of the response, a request with a matching If-None-Match gets a 304 without a body
+# every message the server fans out is published to the service, which keeps the newest max_messages_per_room of every room
+# in memory (rooms are read from storage once, when a user of the room polls for the first time), so unread counts and
+# deltas are answered without a database query, waiting polls cost one future and an idle connection
+# runs its own asyncio loop on a background thread of the server process, like the metrics endpoint
+# tokens are signed instead of stored, so any worker of a cluster (forked from the same parent) accepts them
+
+logger = log.get_logger('notifications')
+
+max_request_size = 65536 # bytes of request line, headers and body
+
+# signs tokens unless "token_secret" is set, created before workers are forked so every worker of a cluster has the same one
+token_secret = secrets.token_bytes(32)
+
+status_reasons = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found', 413: 'Payload Too Large',
+                  500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class Http_Error(Exception):
+  # ends a request with the given status code
+  def __init__(self, status_code, error_msg):
+    super().__init__(error_msg)
+    self.status_code = status_code
+    self.error_msg = error_msg
+
+
+class Room_Feed:
+  # newest messages of a room (or of messages sent to all clients, room_id None) ordered by message_id
+  def __init__(self, max_messages):
+    self.max_messages = max_messages
+    self.message_ids = []
+    self.messages = []
+    self.truncated = False # older messages were dropped, or never read from storage
+    self.loading = None # future of the read from storage, done once it finished
+
+  def add(self, msg):
+    message_id = msg['message_id']
+    index = bisect.bisect_left(self.message_ids, message_id)
+    if index < len(self.message_ids) and self.message_ids[index] == message_id:
+      return
+
+    # messages of other workers can arrive slightly out of order
+    self.message_ids.insert(index, message_id)
+    self.messages.insert(index, msg)
+
+    if len(self.message_ids) > self.max_messages:
+      del self.message_ids[0]
+      del self.messages[0]
+      self.truncated = True
+
+  def latest(self):
+    return self.message_ids[-1] if self.message_ids else 0
+
+  def count_after(self, message_id):
+    return len(self.message_ids) - bisect.bisect_right(self.message_ids, message_id)
+
+  def messages_after(self, message_id, limit):
+    # newest limit messages after message_id, oldest first
+    start = max(bisect.bisect_right(self.message_ids, message_id), len(self.messages) - limit)
+    return self.messages[start:]
+
+  def complete_after(self, message_id):
+    # True if every message of the room after message_id is in the feed
+    return not self.truncated or (self.message_ids and message_id >= self.message_ids[0])
+
+
+class Notification_Service:
+  def __init__(self, host, port, config, db_pool, hash_pool):
+    # db_pool, hash_pool -- the server's pools, the service reads rooms and users and checks passwords with them
+    self.config = config
+    self.db_pool = db_pool
+    self.hash_pool = hash_pool
+    self.token_secret = config['token_secret'].encode('utf-8') if config['token_secret'] else token_secret
+
+    self.feeds = {} # room_id -> Room_Feed
+    self.waiters = {} # room_id -> set of futures of polls waiting for a message in the room
+    self.cursors = {} # user_id -> (since, {room_id: cursor}) of the user's last poll
+    self.user_rooms = user_cache.User_Cache(config['max_cached_users'], config['rooms_ttl'], config['rooms_ttl']) # user_id -> set of room_ids
+
+    self.published = [] # messages published by the server's loop thread, added to the feeds by the service's loop
+    self.publish_lock = threading.Lock()
+    self.publish_scheduled = False
+
+    self.loop = asyncio.new_event_loop()
+    self.server = self.loop.run_until_complete(asyncio.start_server(self.handle_connection, host, port, limit=max_request_size))
+    self.thread = threading.Thread(target=self.loop.run_forever, name='notification_service', daemon=True)
+    self.thread.start()
+
+  # called by the server's thread
+
+  def publish(self, msg):
+    # msg is a SERVER_TEXT message with a message_id, fanned out by the server
+    # messages are handed over in batches, the service's loop is woken up at most once per batch
+    with self.publish_lock:
+      self.published.append(msg)
+      if self.publish_scheduled:
+        return
+      self.publish_scheduled = True
+    self.loop.call_soon_threadsafe(self.add_published_messages)
+
+  def invalidate_user(self, user_id):
+    # the user joined or left a room
+    self.loop.call_soon_threadsafe(self.user_rooms.invalidate, user_id)
+
+  def shutdown(self):
+    self.loop.call_soon_threadsafe(self.server.close)
+    self.loop.call_soon_threadsafe(self.loop.stop)
+    self.thread.join()
+
+  # runs on the service's loop
+
+  def add_published_messages(self):
+    with self.publish_lock:
+      published = self.published
+      self.published = []
+      self.publish_scheduled = False
+
+    for msg in published:
+      room_id = msg.get('room_id')
+      self.get_feed(room_id).add(msg)
+
+      for waiter in self.waiters.pop(room_id, ()):
+        if not waiter.done():
+          waiter.set_result(None)
+
+  def get_feed(self, room_id):
+    feed = self.feeds.get(room_id)
+    if feed is None:
+      feed = self.feeds[room_id] = Room_Feed(self.config['max_messages_per_room'])
+    return feed
+
+  async def load_feed(self, room_id):
+    # returns the room's feed, read from storage the first time (messages without a room aren't stored)
+    feed = self.get_feed(room_id)
+    if feed.loading is None:
+      feed.loading = self.loop.create_future()
+      if room_id is None:
+        feed.loading.set_result(None)
+      else:
+        self.loop.create_task(self.read_feed(room_id, feed))
+
+    await asyncio.shield(feed.loading)
+    return feed
+
+  async def read_feed(self, room_id, feed):
+    try:
+      room_history = await self.run_query('get_room_history', room_id, None, feed.max_messages)
+    except Exception as err:
+      if not isinstance(err, Http_Error):
+        logger.exception('Encountered error:')
+        err = Http_Error(500, 'Database error')
+      feed.loading.set_exception(err)
+      feed.loading = None # next poll tries again
+      return
+
+    feed.truncated = feed.truncated or len(room_history) == feed.max_messages
+    for message_id, create_date, message_body, username in room_history:
+      feed.add(message.create_message(type=message.config_msg_types['SERVER_TEXT'], msg_body=message_body,
+                                      username=username, room_id=room_id, message_id=message_id))
+    feed.loading.set_result(None)
+
+  async def run_query(self, function, *args):
+    # runs a storage query on the server's database pool
+    try:
+      return await asyncio.wrap_future(self.db_pool.submit(function, *args))
+    except exceptions.DataBaseBusyError:
+      raise Http_Error(503, 'Server is busy')
+
+  async def get_user_rooms(self, user_id):
+    # rooms the user is in, None stands for messages sent to all clients
+    cached, room_ids = self.user_rooms.get(user_id)
+    if cached:
+      return room_ids
+
+    cache_token = self.user_rooms.lookup_token()
+    user_rooms = await self.run_query('get_user_rooms', user_id)
+    room_ids = {None, *(room_id for room_id, room_name in user_rooms)}
+    self.user_rooms.put(user_id, room_ids, cache_token)
+    return room_ids
+
+  # http
+
+  async def handle_connection(self, reader, writer):
+    # serves the requests of one connection until the client closes it (keep-alive)
+    try:
+      while True:
+        try:
+          head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.LimitOverrunError:
+          await self.write_response(writer, 413, {'error_msg': 'Request too large'}, close=True)
+          return
+
+        request_line, *header_lines = head.decode('latin-1').split('\r\n')
+        method, target, version = request_line.split(' ', 2)
+        headers = {}
+        for line in header_lines:
+          if line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+        content_length = int(headers.get('content-length', 0))
+        if content_length > max_request_size:
+          await self.write_response(writer, 413, {'error_msg': 'Request too large'}, close=True)
+          return
+        body = await reader.readexactly(content_length) if content_length else b''
+
+        close = version != 'HTTP/1.1' or headers.get('connection', '').lower() == 'close'
+        try:
+          status_code, fields, extra_headers = await self.handle_request(method, target, headers, body)
+        except Http_Error as err:
+          status_code, fields, extra_headers = err.status_code, {'error_msg': err.error_msg}, {}
+        except Exception:
+          logger.exception('Encountered error:')
+          status_code, fields, extra_headers = 500, {'error_msg': 'Internal server error'}, {}
+
+        await self.write_response(writer, status_code, fields, extra_headers, close)
+        if close:
+          return
+
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+      pass # client went away or sent something that isn't http
+
+    finally:
+      writer.close()
+
+  async def write_response(self, writer, status_code, fields, extra_headers={}, close=False):
+    body = json.dumps(fields).encode('utf-8') if fields is not None else b''
+    lines = [f'HTTP/1.1 {status_code} {status_reasons[status_code]}', f'Content-Length: {len(body)}']
+    if fields is not None:
+      lines.append('Content-Type: application/json')
+    if close:
+      lines.append('Connection: close')
+    lines.extend(f'{name}: {value}' for name, value in extra_headers.items())
+
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+    await writer.drain()
+
+  async def handle_request(self, method, target, headers, body):
+    # returns (status_code, json fields or None, extra headers)
+    url = urllib.parse.urlsplit(target)
+    query = dict(urllib.parse.parse_qsl(url.query))
+
+    if url.path == '/login' and method == 'POST':
+      try:
+        credentials = json.loads(body)
+        username, password = credentials['username'], credentials['password']
+      except (ValueError, TypeError, KeyError):
+        raise Http_Error(400, 'Expected {"username": ..., "password": ...}')
+      return 200, await self.log_in(username, password), {}
+
+    if url.path == '/notifications' and method == 'GET':
+      user_id = self.check_token(headers.get('authorization', ''))
+      try:
+        since = int(query['since']) if 'since' in query else None
+        room_cursors = parse_cursors(query['cursors']) if 'cursors' in query else None
+        wait = min(float(query.get('wait', 0)), self.config['max_wait'])
+      except ValueError:
+        raise Http_Error(400, 'since and wait have to be numbers, cursors a list of room:message_id')
+      return await self.poll(user_id, since, room_cursors, wait, headers.get('if-none-match'))
+
+    raise Http_Error(404, 'Not found')
+
+  async def log_in(self, username, password):
+    try:
+      user_info = await self.run_query('get_user_info', username)
+      password_matches = await asyncio.wrap_future(self.hash_pool.submit_verify(password, user_info[2]))
+    except exceptions.ClientLookupError:
+      password_matches = False
+    except exceptions.LoginBusyError:
+      raise Http_Error(503, 'Server is busy')
+
+    if not password_matches:
+      raise Http_Error(401, 'Username and/or password could not be verified by server')
+
+    expires_at = int(time.time()) + self.config['token_ttl']
+    return {'token': self.sign_token(user_info[0], expires_at), 'expires_at': expires_at}
+
+  def sign_token(self, user_id, expires_at):
+    payload = f'{user_id}.{expires_at}'
+    signature = hmac.new(self.token_secret, payload.encode('utf-8'), hashlib.sha256).hexdigest()
+    return f'{payload}.{signature}'
+
+  def check_token(self, authorization):
+    # returns the user_id of a valid "Bearer <token>"
+    scheme, _, token = authorization.partition(' ')
+    try:
+      user_id, expires_at, signature = token.split('.')
+      user_id, expires_at = int(user_id), int(expires_at)
+    except ValueError:
+      raise Http_Error(401, 'Missing or malformed token')
+
+    if scheme.lower() != 'bearer' or not hmac.compare_digest(self.sign_token(user_id, expires_at), token):
+      raise Http_Error(401, 'Invalid token')
+    if expires_at < time.time():
+      raise Http_Error(401, 'Token expired')
+    return user_id
+
+  async def poll(self, user_id, since, room_cursors, wait, if_none_match):
+    room_ids = await self.get_user_rooms(user_id)
+    feeds = {room_id: await self.load_feed(room_id) for room_id in room_ids}
+
+    if since is None and room_cursors is None:
+      since, room_cursors = self.cursors.get(user_id, (None, {}))
+    elif room_cursors is None:
+      room_cursors = {}
+    # rooms without a cursor start after since, or with nothing unread on the first poll
+    cursors = {room_id: room_cursors.get(room_id, feed.latest() if since is None else since) for room_id, feed in feeds.items()}
+    self.cursors[user_id] = (since, cursors)
+
+    if wait > 0 and all(feed.latest() <= cursors[room_id] for room_id, feed in feeds.items()):
+      waiter = self.loop.create_future()
+      for room_id in room_ids:
+        self.waiters.setdefault(room_id, set()).add(waiter)
+      try:
+        await asyncio.wait_for(waiter, wait)
+      except asyncio.TimeoutError:
+        pass
+      finally:
+        for room_id in room_ids:
+          room_waiters = self.waiters.get(room_id)
+          if room_waiters is not None:
+            room_waiters.discard(waiter)
+            if not room_waiters:
+              del self.waiters[room_id]
+
+    unread = {}
+    messages = []
+    truncated = []
+    new_cursors = {}
+    for room_id, feed in feeds.items():
+      room_key = format_room_id(room_id)
+      new_cursors[room_key] = max(feed.latest(), cursors[room_id])
+      count = feed.count_after(cursors[room_id])
+      if not count:
+        continue
+
+      unread[room_key] = count
+      messages.extend(feed.messages_after(cursors[room_id], self.config['max_messages_per_poll']))
+      if count > self.config['max_messages_per_poll'] or not feed.complete_after(cursors[room_id]):
+        truncated.append(room_key) # client reads the rest with HISTORY_REQUEST once it connects
+
+    messages.sort(key=lambda msg: msg['message_id'])
+    fields = {'cursors': new_cursors, 'cursor': max(new_cursors.values()), 'unread': unread, 'messages': messages, 'truncated': truncated}
+
+    # anything that changes the response (new messages, the cursors it was asked with, rooms) changes the etag
+    etag = '"' + hashlib.sha256(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()[:32] + '"'
+    if if_none_match == etag:
+      return 304, None, {'ETag': etag}
+    return 200, fields, {'ETag': etag}
+
+
+def format_room_id(room_id):
+  # key of a room in responses and cursors, "all" for messages sent to all clients
+  return 'all' if room_id is None else str(room_id)
+
+def parse_cursors(value):
+  # "all:120,3:118" -> {None: 120, 3: 118}, raises ValueError if value isn't in that format
+  room_cursors = {}
+  for pair in value.split(','):
+    room_key, _, message_id = pair.partition(':')
+    room_cursors[None if room_key == 'all' else int(room_key)] = int(message_id)
+  return room_cursors
@@ -0,0 +1,119 @@
+import collections, itertools, os, socket, time
+
+from chatapp.shared import message
+
+# max number of buffers that can be passed to a single sendmsg() (writev) call
+try:
+  iov_max = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+  iov_max = 1024
+
+# sendmsg isn't available on every platform (ex. windows), frames are joined and sent with send() there
+has_sendmsg = hasattr(socket.socket, 'sendmsg')
+
+
+class Outbound_Queue:
+  # frames waiting to be sent to a single connection
+  # the same encoded frame object is queued for every recipient, so fanning a message out doesn't copy it,
+  # and all queued frames are written with a single sendmsg() call per flush
+  # frames are only compressed once they are about to be written, so frames that are never written (see drop_oldest)
+  # don't break the connection's deflate stream, compressed frames are always kept
+  def __init__(self):
+    self.frames = collections.deque()
+    self.critical = collections.deque() # per frame, False if it may be dropped when the connection falls behind
+    self.size = 0 # total amount of bytes waiting to be sent
+    self.compressed = 0 # number of frames at the front that are already compressed (or partially sent), these are never dropped
+    self.waiting_since = None # time.monotonic() when the queue last stopped being empty
+
+  def __len__(self):
+    return len(self.frames)
+
+  def append(self, frame, critical=True):
+    if not self.frames:
+      self.waiting_since = time.monotonic()
+
+    self.frames.append(frame)
+    self.critical.append(critical)
+    self.size += len(frame)
+
+  def lag(self):
+    # seconds since everything queued for the connection was last sent
+    if not self.frames:
+      return 0
+    return time.monotonic() - self.waiting_since
+
+  def drop_oldest(self, max_size):
+    # drops the oldest frames that aren't critical until at most max_size bytes are queued (or none are left to drop),
+    # returns number of dropped frames
+    dropped = 0
+    kept_frames = collections.deque(itertools.islice(self.frames, self.compressed))
+    kept_critical = collections.deque(itertools.islice(self.critical, self.compressed))
+
+    for frame, critical in itertools.islice(zip(self.frames, self.critical), self.compressed, None):
+      if self.size > max_size and not critical:
+        self.size -= len(frame)
+        dropped += 1
+      else:
+        kept_frames.append(frame)
+        kept_critical.append(critical)
+
+    self.frames = kept_frames
+    self.critical = kept_critical
+    return dropped
+
+  def compress(self, count, compressor):
+    # compresses the first count frames for the connection's Frame_Compressor (None if it doesn't use compression)
+    if compressor is None:
+      return
+
+    for index in range(self.compressed, count):
+      frame = self.frames[index]
+      compressed_frame = message.compress_frame(frame, compressor)
+      self.frames[index] = compressed_frame
+      self.size += len(compressed_frame) - len(frame)
+    self.compressed = max(self.compressed, count)
+
+  def take(self, compressor=None):
+    # removes and returns all queued frames, used when the transport does its own buffering (asyncio engine)
+    self.compress(len(self.frames), compressor)
+    frames = list(self.frames)
+
+    self.frames.clear()
+    self.critical.clear()
+    self.size = 0
+    self.compressed = 0
+    return frames
+
+  def flush(self, sock, compressor=None):
+    # writes as many queued frames as the socket accepts, returns number of bytes sent
+    # a partially sent frame is kept as a memoryview of its unsent remainder
+    # raises BlockingIOError if socket can't accept any data, other OSErrors if connection failed
+    count = min(len(self.frames), iov_max)
+    self.compress(count, compressor)
+
+    if len(self.frames) > count:
+      frames = list(itertools.islice(self.frames, count))
+    else:
+      frames = self.frames
+
+    if has_sendmsg:
+      sent = sock.sendmsg(frames)
+    else:
+      sent = sock.send(b''.join(frames))
+
+    self.size -= sent
+    remaining = sent
+
+    while remaining:
+      frame_len = len(self.frames[0])
+      if remaining < frame_len:
+        self.frames[0] = memoryview(self.frames[0])[remaining:]
+        self.compressed = max(self.compressed, 1) # rest of a partially sent frame has to be sent
+        break
+
+      self.frames.popleft()
+      self.critical.popleft()
+      self.compressed = max(self.compressed - 1, 0)
+      remaining -= frame_len
+
+    return sent
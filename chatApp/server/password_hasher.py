@@ -0,0 +1,112 @@
+import hashlib, hmac, multiprocessing, os, threading
+from concurrent import futures
+
+from chatapp.shared import exceptions
+
+# password hashing is done in separate processes, so a slow key derivation function never blocks the event loop
+# stored hashes start with the name of the hasher that created them (except legacy sha256 hex digests),
+# so changing the configured hasher only affects new signups and existing users can still log in
+
+class SHA256_Hasher:
+  # unsalted sha256 hex digest, the format used before hashers were configurable, only kept for existing users
+  name = 'sha256'
+
+  def hash(self, password):
+    return hashlib.sha256(password.encode('utf-8')).hexdigest()
+
+  def verify(self, password, stored_hash):
+    return hmac.compare_digest(self.hash(password), stored_hash)
+
+
+class PBKDF2_Hasher:
+  # stored as pbkdf2_sha256$iterations$salt$hash
+  name = 'pbkdf2_sha256'
+
+  def __init__(self, iterations=200000):
+    self.iterations = iterations
+
+  def hash(self, password, salt=None, iterations=None):
+    salt = salt or os.urandom(16)
+    iterations = iterations or self.iterations
+    derived_key = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return f'{self.name}${iterations}${salt.hex()}${derived_key.hex()}'
+
+  def verify(self, password, stored_hash):
+    name, iterations, salt, derived_key = stored_hash.split('$')
+    return hmac.compare_digest(self.hash(password, bytes.fromhex(salt), int(iterations)), stored_hash)
+
+
+class Scrypt_Hasher:
+  # stored as scrypt$n$r$p$salt$hash
+  name = 'scrypt'
+
+  def __init__(self, n=2**14, r=8, p=1):
+    self.n = n
+    self.r = r
+    self.p = p
+
+  def hash(self, password, salt=None, n=None, r=None, p=None):
+    salt = salt or os.urandom(16)
+    n, r, p = n or self.n, r or self.r, p or self.p
+    derived_key = hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p)
+    return f'{self.name}${n}${r}${p}${salt.hex()}${derived_key.hex()}'
+
+  def verify(self, password, stored_hash):
+    name, n, r, p, salt, derived_key = stored_hash.split('$')
+    return hmac.compare_digest(self.hash(password, bytes.fromhex(salt), int(n), int(r), int(p)), stored_hash)
+
+
+hashers = {hasher.name: hasher for hasher in (SHA256_Hasher, PBKDF2_Hasher, Scrypt_Hasher)}
+
+def create_hasher(config):
+  # creates hasher from the "password_hashing" section of server_config.json
+  if config['algorithm'] == PBKDF2_Hasher.name:
+    return PBKDF2_Hasher(config['iterations'])
+  if config['algorithm'] == Scrypt_Hasher.name:
+    return Scrypt_Hasher(config['scrypt_n'], config['scrypt_r'], config['scrypt_p'])
+  return SHA256_Hasher()
+
+def hash_password(hasher, password):
+  return hasher.hash(password)
+
+def verify_password(password, stored_hash):
+  # picks hasher that created stored_hash, returns True if password matches
+  hasher_name = stored_hash.split('$', 1)[0] if '$' in stored_hash else SHA256_Hasher.name
+  hasher_class = hashers.get(hasher_name)
+  if hasher_class is None:
+    return False
+
+  try:
+    return hasher_class().verify(password, stored_hash)
+  except ValueError:
+    # stored hash is malformed
+    return False
+
+
+class Hash_Pool:
+  # process pool for password hashing with admission control
+  # at most max_in_flight hashes can be waiting or running, submitting more raises LoginBusyError
+  # so a login storm can't build up an unbounded backlog, clients are told to retry instead
+  def __init__(self, hasher, processes, max_in_flight):
+    self.hasher = hasher
+    self.in_flight = threading.BoundedSemaphore(max_in_flight) # released by the executor's thread once a hash is done
+
+    # spawned instead of forked, forking a process that runs database threads isn't safe
+    self.executor = futures.ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+
+  def submit(self, function, *args):
+    if not self.in_flight.acquire(blocking=False):
+      raise exceptions.LoginBusyError()
+
+    future = self.executor.submit(function, *args)
+    future.add_done_callback(lambda f: self.in_flight.release())
+    return future
+
+  def submit_hash(self, password):
+    return self.submit(hash_password, self.hasher, password)
+
+  def submit_verify(self, password, stored_hash):
+    return self.submit(verify_password, password, stored_hash)
+
+  def shutdown(self):
+    self.executor.shutdown(wait=True)
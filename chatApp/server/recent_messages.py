@@ -0,0 +1,74 @@
+import collections
+
+from chatapp.shared import exceptions
+
+class Recent_Messages:
+  # bounded in-memory buffer of the last messages of every active room, used to backfill clients on login or when joining a room
+  # messages are kept as encoded frames (message.Frame_Cache, shared with the broadcast that sent them), so backfilling is a
+  # straight write without touching the database or re-encoding
+  # every room keeps at most max_messages_per_room messages, and all rooms together at most max_bytes of frames,
+  # once over max_bytes the oldest messages of the least recently active rooms are evicted first
+  # messages without a room (sent to all clients) are kept under room_id None
+  # only used from the loop thread, so no locking is needed
+  def __init__(self, max_messages_per_room, max_bytes, start_message_id=0):
+    self.max_messages_per_room = max_messages_per_room
+    self.max_bytes = max_bytes
+    self.start_message_id = start_message_id # messages up to this id were sent before the server started and are only in the database
+
+    self.rooms = collections.OrderedDict() # room_id -> deque of [message_id, frames, counted bytes], least recently active room first
+    self.horizons = {} # room_id -> largest message_id evicted from the room, older messages are only in the database
+    self.size = 0 # bytes of frames currently buffered, of every codec
+    self.message_count = 0
+    self.evicted = 0 # messages evicted because of max_messages_per_room or max_bytes
+
+  def append(self, room_id, message_id, frames):
+    room = self.rooms.get(room_id)
+    if room is None:
+      room = self.rooms[room_id] = collections.deque()
+    else:
+      self.rooms.move_to_end(room_id)
+
+    room.append([message_id, frames, frames.size])
+    self.size += frames.size
+    self.message_count += 1
+
+    if len(room) > self.max_messages_per_room:
+      self.evict(room_id)
+
+    while self.size > self.max_bytes:
+      self.evict(next(iter(self.rooms)))
+
+  def evict(self, room_id):
+    # removes the oldest message of a room, and the room itself once it's empty
+    room = self.rooms[room_id]
+    message_id, frames, counted = room.popleft()
+    self.size -= counted
+    self.message_count -= 1
+    self.evicted += 1
+    self.horizons[room_id] = max(message_id, self.horizon(room_id))
+
+    if not room:
+      del self.rooms[room_id]
+
+  def horizon(self, room_id):
+    # every message of the room with a larger message_id than this is in the buffer
+    return self.horizons.get(room_id, self.start_message_id)
+
+  def frames_after(self, room_id, after_id, codec):
+    # returns buffered frames of a room with a message_id larger than after_id (all buffered frames if after_id is None), oldest first
+    # messages that haven't been encoded with codec yet are encoded now and count towards max_bytes from the next append on
+    # messages that don't fit a frame with codec are skipped
+    result = []
+    for entry in self.rooms.get(room_id, ()):
+      message_id, frames, counted = entry
+      if after_id is None or message_id > after_id:
+        try:
+          result.append(frames.get(codec))
+        except exceptions.FrameTooLargeError:
+          continue
+        self.size += frames.size - counted
+        entry[2] = frames.size
+    return result
+
+  def stats(self):
+    return {'rooms': len(self.rooms), 'messages': self.message_count, 'bytes': self.size, 'max_bytes': self.max_bytes, 'evicted': self.evicted}
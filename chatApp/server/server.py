@@ -1,191 +1,1034 @@
-import socket, queue, select, json, traceback
-from datetime import datetime
-from hashlib import sha256
+import socket, queue, select, time, collections
+from concurrent import futures
 
-from chatapp.shared import exceptions, message
-from chatapp.server import db_connector as db_conn
+from chatapp.shared import exceptions, message, compression, log
+from chatapp.server import outbound
+from chatapp.server import db_pool
+from chatapp.server import message_persister
+from chatapp.server import user_cache
+from chatapp.server import password_hasher
+from chatapp.server import recent_messages
+from chatapp.server import storage
+from chatapp.server import metrics
+from chatapp.server import timer_wheel
+from chatapp.server import notification_service
 from chatapp.server import load_server_config
 
 server_config = load_server_config.load_config()
 server_config_python_server = server_config['python_server']
 server_config_postgres_server = server_config['postgres_server']
+server_config_storage = server_config['storage']
+server_config_db_pool = server_config['db_pool']
+server_config_message_persistence = server_config['message_persistence']
+server_config_user_cache = server_config['user_cache']
+server_config_password_hashing = server_config['password_hashing']
+server_config_history = server_config['history']
+server_config_recent_messages = server_config['recent_messages']
+server_config_metrics = server_config['metrics']
+server_config_notifications = server_config['notifications']
+server_config_backpressure = server_config['backpressure']
+server_config_heartbeat = server_config['heartbeat']
+
+# what happens to a connection whose outbound queue grows past "max_queued_bytes", see apply_backpressure
+backpressure_policies = ('drop_oldest', 'skip_non_critical', 'disconnect')
+
+# written to stdout by a background thread, levels, sampling and rate limits per category are set in shared_config.json (see log.py)
+# per-message and per-broadcast lines are debug records of their own categories, so they cost next to nothing unless enabled
+logger = log.get_logger('server')
+connection_logger = log.get_logger('server', 'connections')
+message_logger = log.get_logger('server', 'messages')
+broadcast_logger = log.get_logger('server', 'broadcast')
+error_logger = log.get_logger('server', 'errors')
+
+def create_connector_factory():
+  # returns function creating new connectors to the storage backend configured in server_config.json (see storage.py)
+  return storage.create_connector_factory(server_config_storage, server_config_postgres_server)
+
+def lookup_user_login(db_connector, username):
+  # runs on a database pool thread, returns (user_info, user_rooms) or None if user doesn't exist
+  try:
+    user_info = db_connector.get_user_info(username)
+  except exceptions.ClientLookupError:
+    return None
+  
+  return user_info, db_connector.get_user_rooms(user_info[0])
+
+def read_backfill_cursors(after_id, room_cursors):
+  # returns {room_id: after_id} for the rooms of a VERIFICATION_REQUEST, rooms missing from room_cursors use after_id
+  # room_cursors is a list of [room_id, message_id] pairs (room_id None for messages sent to all clients), others are ignored
+  # the fields' types are checked by parse_message, the pairs' items are checked here (exact types, True/False aren't ids)
+  if type(after_id) is not int:
+    after_id = None
+  cursors = collections.defaultdict(lambda: after_id)
+  if type(room_cursors) is list:
+    for pair in room_cursors:
+      if type(pair) is list and len(pair) == 2 and (pair[0] is None or type(pair[0]) is int) and type(pair[1]) is int:
+        cursors[pair[0]] = pair[1]
+  return cursors
 
 class TCP_Nonblocking_Server:
-  def __init__(self, host, port, verbose_output=True):
+  def __init__(self, host, port, verbose_output=True, backlog=10, reuse_port=False, create_tables=True, worker_index=0, worker_count=1,
+               db_connector_factory=None):
     self.host = host
     self.port = port
+    self.backlog = backlog # max number of pending connections not yet accepted
+    self.reuse_port = reuse_port # allows several worker processes to listen on the same port, kernel balances connections between them
+    self.create_tables = create_tables # in multi-worker mode tables are created once by the parent process instead
     self.sock = None
-    self.timeout = 1 # timeout for select.select() in listen_for_connections()
+    self.timeout = server_config_heartbeat['tick'] # timeout for select.select() in listen_for_connections(), timers are checked at least this often
     
     self.format = 'utf-8'
     self.verbose_output = verbose_output # determines if anything is logged to terminal
+    if verbose_output:
+      log.start()
     
     self.client_list = [] # used for storing sockets
     self.client_info = {} # used for storing info about sockets (ex. address, etc.)
     self.client_messages = queue.Queue() # used for saving messages from clients before sending them to all other clients
+    self.pending_writes = set() # sockets with data in their outbound buffer, only these are checked for writability
+    self.room_clients = {} # room_id -> set of verified client sockets in that room, so fan-out only touches the room's members
+    self.user_clients = {} # user_id -> set of client sockets logged in as that user (a user can be connected more than once)
+    self.bus_peers = [] # connections to the other worker processes when running as a cluster (see cluster.py)
+    
+    # outbound queues of slow clients are bounded, so one client that doesn't read can't hold up or exhaust memory of the others
+    if server_config_backpressure['policy'] not in backpressure_policies:
+      raise ValueError(f'Unknown backpressure policy {server_config_backpressure["policy"]}')
+    self.backpressure_policy = server_config_backpressure['policy']
+    self.max_queued_bytes = server_config_backpressure['max_queued_bytes']
+    self.max_lag = server_config_backpressure['max_lag'] # seconds, None never disconnects because of lag
+    self.slow_clients = set() # clients disconnected by apply_backpressure, closed once the current loop iteration is done
+    
+    # every client connection has one timer for its next deadline (login, heartbeat or write, see check_deadlines)
+    self.timers = timer_wheel.Timer_Wheel(server_config_heartbeat['tick'], server_config_heartbeat['slots'], time.monotonic())
+    
+    # counters and histograms of the hot path, rendered for STATS_REQUEST and the metrics endpoint (see metrics.py)
+    # None if disabled, every instrumented spot only checks that
+    self.metrics = metrics.Server_Metrics() if server_config_metrics['enabled'] else None
+    self.metrics_endpoint = None
+    
+    # database work done while clients are connected goes through db_pool, so slow queries don't stall the loop
+    # db_connector is only used for setup before the loop starts
+    # db_connector_factory returns a new storage.Storage connector, the configured backend's if not given
+    if db_connector_factory is None:
+      db_connector_factory = create_connector_factory()
+    self.db_connector = db_connector_factory()
+    self.db_pool = db_pool.DB_Pool(db_connector_factory, server_config_db_pool['size'], server_config_db_pool['max_pending'], self.metrics)
+    
+    self.user_cache = user_cache.User_Cache(server_config_user_cache['max_size'], server_config_user_cache['ttl'], server_config_user_cache['negative_ttl'])
+    
+    # passwords are hashed and checked in separate processes, a slow key derivation function doesn't stall the loop
+    self.hash_pool = password_hasher.Hash_Pool(password_hasher.create_hasher(server_config_password_hashing),
+                                               server_config_password_hashing['processes'],
+                                               server_config_password_hashing['max_in_flight'])
+    
+    self.completed_tasks = collections.deque() # (callback, args) of background work that finished, run by the loop thread
     
-    self.db_connector = db_conn.DB_Connector(server_config_postgres_server['ip'],
-                                                  server_config_postgres_server['port'],
-                                                  server_config_postgres_server['dbname'],
-                                                  server_config_postgres_server['user'],
-                                                  server_config_postgres_server['password'])
+    # message type -> handler(client_sock, msg), for clients that haven't logged in yet and ones that have
+    self.login_handlers = {message.config_msg_types['VERIFICATION_REQUEST']: self.handle_verification_request,
+                           message.config_msg_types['SIGNUP_REQUEST']: self.handle_signup_request,
+                           message.config_msg_types['PING']: self.handle_ping,
+                           message.config_msg_types['PONG']: self.handle_pong}
+    self.message_handlers = {message.config_msg_types['CLIENT_TEXT']: self.handle_client_text,
+                             message.config_msg_types['JOIN_ROOM_REQUEST']: self.handle_join_room_request,
+                             message.config_msg_types['LEAVE_ROOM_REQUEST']: self.handle_leave_room_request,
+                             message.config_msg_types['HISTORY_REQUEST']: self.handle_history_request,
+                             message.config_msg_types['STATS_REQUEST']: self.handle_stats_request,
+                             message.config_msg_types['PING']: self.handle_ping,
+                             message.config_msg_types['PONG']: self.handle_pong}
+    self.wakeup_recv = None # background threads write to wakeup_send to wake up select()
+    self.wakeup_send = None
     
     self.configure_server()
-  
-  def print_tstamp(self, msg):
-    if self.verbose_output:
-      current_time = datetime.now().strftime('%Y-%M-%d %H:%M:%S')
-      print(f'[{current_time}] [SERVER] {msg}')
     
+    # messages are numbered by the server and stored in the background, delivery never waits for the database
+    max_message_id = self.db_connector.get_max_message_id()
+    self.message_ids = message_persister.Message_Id_Allocator(max_message_id, worker_index, worker_count)
+    self.message_persister = message_persister.Message_Persister(db_connector_factory,
+                                                                 server_config_message_persistence['batch_size'],
+                                                                 server_config_message_persistence['flush_interval'],
+                                                                 server_config_message_persistence['max_queue'],
+                                                                 server_config_message_persistence['max_retries'],
+                                                                 server_config_message_persistence['retry_delay'])
+    
+    # last messages of every active room, clients are backfilled from here on login and when joining a room
+    self.recent_messages = recent_messages.Recent_Messages(server_config_recent_messages['max_messages_per_room'],
+                                                           server_config_recent_messages['max_bytes'],
+                                                           max_message_id)
+    
+    # every worker of a cluster serves its own metrics, on http_port + worker_index
+    if self.metrics and server_config_metrics['http_port'] is not None:
+      self.metrics_endpoint = metrics.Metrics_Endpoint(server_config_metrics['http_host'], server_config_metrics['http_port'] + worker_index,
+                                                       self.render_metrics_from_thread)
+    
+    # http api polled by clients in offline mode, every worker of a cluster serves it on http_port + worker_index
+    self.notification_service = None
+    if server_config_notifications['http_port'] is not None:
+      self.notification_service = notification_service.Notification_Service(server_config_notifications['http_host'],
+                                                                            server_config_notifications['http_port'] + worker_index,
+                                                                            server_config_notifications, self.db_pool, self.hash_pool)
+  
   def configure_server(self):
-    self.print_tstamp('Initializing database...')
-    self.db_connector.create_tables_if_needed()
+    if self.create_tables:
+      logger.info('Initializing database...')
+      self.db_connector.create_tables_if_needed()
     
-    self.print_tstamp('Creating socket...')
+    logger.info('Creating socket...')
     self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     
     self.sock.setblocking(False)
     
-    self.print_tstamp(f'Binding socket to [{self.host}] on port [{self.port}]...')
+    if self.reuse_port:
+      self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    
+    logger.info('Binding socket to [%s] on port [%s]...', self.host, self.port)
     self.sock.bind((self.host, self.port))
     
     self.client_list.append(self.sock)
     
+    self.wakeup_recv, self.wakeup_send = socket.socketpair()
+    self.wakeup_recv.setblocking(False)
+    self.wakeup_send.setblocking(False)
+    self.client_list.append(self.wakeup_recv)
+    
   def accept_client_socket(self):
     client_sock, client_addr = self.sock.accept()
-    self.print_tstamp(f'Accepted new connection from {client_addr}')
+    connection_logger.info('Accepted new connection from %s', client_addr)
     
     client_sock.setblocking(False) 
     
-    self.client_info[client_sock] = {'address': client_addr, 'verified': False}
+    if self.metrics:
+      self.metrics.connections_accepted += 1
+    self.client_info[client_sock] = self.new_client_info(client_addr)
     self.client_list.append(client_sock)
+    self.watch_client(client_sock)
+    
+  def add_bus_peer(self, peer_sock):
+    # registers a connection to another worker process, it is read from and written to like a client
+    # but every broadcast is forwarded to it and messages received from it are only fanned out locally
+    peer_sock.setblocking(False)
+    
+    self.client_info[peer_sock] = self.new_client_info('bus peer', bus_peer=True)
+    self.client_list.append(peer_sock)
+    self.bus_peers.append(peer_sock)
+    
+  def new_client_info(self, client_addr, bus_peer=False):
+    now = time.monotonic()
+    return {'address': client_addr, 'verified': False, 'closing': False, 'bus_peer': bus_peer,
+            'connected_at': now, 'last_activity': now, # time.monotonic() of connecting and of the last data received
+            'ping_sent': None, # time.monotonic() of the last PING that hasn't been answered yet
+            'verification_pending': False, 'deferred_messages': collections.deque(), # messages received while waiting on login/signup or a room request
+            'frame_buffer': message.Frame_Buffer(self.format),
+            'codec': 'json', # codec of frames sent to this connection, chosen in verify_client
+            'compression': None, 'compressor': None, # name and compression.Frame_Compressor if compression was negotiated in verify_client
+            'outbound': outbound.Outbound_Queue()} # frames waiting to be sent, written together once socket is writable
     
   def close_client_socket(self, client_sock):
     client_addr = self.client_info[client_sock]['address']
-    self.print_tstamp(f'Closing socket from address {client_addr}...')
+    connection_logger.debug('Closing socket from address %s...', client_addr)
     
     for s in self.client_list:
       if s == client_sock:
         self.client_list.remove(s)
     
-    del self.client_info[client_sock]
+    self.pending_writes.discard(client_sock)
+    self.remove_client_info(client_sock)
     client_sock.close()    
     
-    self.print_tstamp(f'Socket closed from address {client_addr}')
+    connection_logger.info('Socket closed from address %s', client_addr)
+    
+  def remove_client_info(self, client_sock):
+    # removes all info about client, including its entries in the room and user indexes
+    info = self.client_info[client_sock]
+    self.timers.cancel(client_sock)
+    
+    if info['bus_peer']:
+      self.bus_peers.remove(client_sock)
+    
+    if info['verified']:
+      for room_id in list(info['rooms']):
+        self.unsubscribe_client(client_sock, room_id)
+      
+      user_socks = self.user_clients[info['user_id']]
+      user_socks.discard(client_sock)
+      if not user_socks:
+        del self.user_clients[info['user_id']]
+    
+    del self.client_info[client_sock]
+    
+  def subscribe_client(self, client_sock, room_id):
+    # adds verified client to the in-memory index of the given room
+    self.client_info[client_sock]['rooms'].add(room_id)
+    self.room_clients.setdefault(room_id, set()).add(client_sock)
+    
+  def unsubscribe_client(self, client_sock, room_id):
+    # removes client from the given room and from its in-memory index
+    self.client_info[client_sock]['rooms'].discard(room_id)
+    self.remove_from_room_index(client_sock, room_id)
+    
+  def remove_from_room_index(self, client_sock, room_id):
+    # rooms without connected clients are dropped from the index
+    room_socks = self.room_clients.get(room_id)
+    if room_socks is not None:
+      room_socks.discard(client_sock)
+      if not room_socks:
+        del self.room_clients[room_id]
+    
+  def close_client_socket_when_flushed(self, client_sock):
+    # stops reading from client and closes socket once everything in its outbound buffer has been sent
+    # used when the client has to receive a response before being disconnected
+    if not self.client_info[client_sock]['outbound']:
+      self.close_client_socket(client_sock)
+      return
+    
+    self.client_info[client_sock]['closing'] = True
+    self.client_list.remove(client_sock)
     
   def receive_message(self, client_sock):
     try:    
-      data_encoded = client_sock.recv(1024)
-      client_addr = self.client_info[client_sock]['address']
-      client_verified = self.client_info[client_sock]['verified']
-      
-      if not data_encoded:
-        # no data sent from client thus client must have disconnected
-        self.close_client_socket(client_sock)
-        self.print_tstamp(f'{client_addr} disconnected')
-        return
+      data_encoded = client_sock.recv(message.recv_size)
       
-      data = data_encoded.decode(self.format) # decoding from utf-8 bytes to string
-      data = json.loads(data)                 # converting from json string to python dict
-      
-      # check if client is verified
-      if not client_verified:
-        # check if client is sending a valid verification request
-        # TODO replace if statement with try catch using InvalidMessageFormattingError exception
-        if message.is_type(data, message.config_msg_types['VERIFICATION_REQUEST']):
-          
-          # TODO remove repeating code for sending response messages
-          
-          # attempt to verify client
-          could_verify = self.verify_client(client_sock, data['username'], data['password'])
-
-          msg = message.create_message(type=message.config_msg_types['VERIFICATION_RESPONSE'], success=could_verify, error_msg='a', status_code='a')
-          msg = json.dumps(msg)
-          msg = msg.encode(self.format)
-          
-          client_sock.send(msg)
-          
-          # close connection if couldnt verify username and/or password
-          if not could_verify:
-            self.close_client_socket(client_sock)
+    except OSError as err:
+      error_logger.exception('Encountered error:')
+            
+      self.close_client_socket(client_sock)
+      return
+    
+    if not data_encoded:
+      # no data sent from client thus client must have disconnected
+      client_addr = self.client_info[client_sock]['address']
+      self.close_client_socket(client_sock)
+      connection_logger.info('%s disconnected', client_addr)
+      return
+    
+    self.receive_data(client_sock, data_encoded)
+    
+  def receive_data(self, client_sock, data_encoded):
+    # feeds bytes received from a client into its frame buffer and processes every completed message
+    # transport independent, used by every server engine
+    if self.metrics:
+      self.metrics.bytes_received += len(data_encoded)
+    self.client_info[client_sock]['last_activity'] = time.monotonic() # any data counts as a heartbeat
+    
+    try:
+      # a single recv can contain several messages, or only part of one
+      for data in self.client_info[client_sock]['frame_buffer'].feed(data_encoded):
+        self.process_message(client_sock, data)
         
-        elif message.is_type(data, message.config_msg_types['SIGNUP_REQUEST']):
-          could_signup = self.sign_up_client(data['username'], data['password'])
-          
-          msg = message.create_message(type=message.config_msg_types['SIGNUP_RESPONSE'], success=could_signup, error_msg='', status_code='')
-          msg = json.dumps(msg)
-          msg = msg.encode(self.format)
-          
-          client_sock.send(msg)
-          
-        else:
-          # closes connection if verification message is not in correct format
-          self.close_client_socket(client_sock)
-          
-      else:
-        # if client is verified, then check if message is correctly formatted and accept message, not correctly formatted messages will be ignored
-        if message.is_type(data, message.config_msg_types['CLIENT_TEXT']):
-          self.print_tstamp(f'{client_addr} client says: [{data}]')
-
-          self.client_messages.put(data)
+        if client_sock not in self.client_info or self.client_info[client_sock]['closing']:
+          # connection was closed while processing a message, remaining messages are discarded
+          return
       
-    except json.JSONDecodeError:
-      self.print_tstamp('Encountered error: Could not decode JSON')
-      traceback.print_exc()
+    except ValueError:
+      # json.JSONDecodeError, UnicodeDecodeError, malformed binary or compressed payload, or a payload nested too deeply
+      error_logger.exception('Encountered error: Could not decode message')
       
       self.close_client_socket(client_sock)
       
+    except exceptions.FrameTooLargeError as err:
+      error_logger.warning('Encountered error: %s (%s bytes)', err.message, err.frame_size)
+      
+      self.close_client_socket(client_sock)
       
     except OSError as err:
-      self.print_tstamp(f'Encountered error: ')
-      traceback.print_exc()
+      error_logger.exception('Encountered error:')
             
       self.close_client_socket(client_sock)
-  
-  def verify_client(self, client_sock, username, password):
-    #return True or False depending on if client could be verified
+      
+  def process_message(self, client_sock, data):
+    # handles a single decoded message received from a client
+    # message is validated once by parse_message, then passed to the handler of its type (see message_handlers)
+    info = self.client_info[client_sock]
+    
+    if info['bus_peer']:
+      # broadcast or user update from another worker, it has already been checked by the worker the sending client is connected to
+      if message.is_type(data, message.config_msg_types['SERVER_TEXT']):
+        self.fan_out_message(data, message.Frame_Cache(data, self.format))
+      elif message.is_type(data, message.config_msg_types['USER_UPDATE']):
+        self.apply_user_update(data['username'], data.get('user_id'), data.get('room_id'), data.get('joined'))
+      return
+    
+    if info['verification_pending']:
+      # login/signup or room request result isn't known yet, messages are handled in order once it is
+      # (ex. a client text pipelined right behind the JOIN_ROOM_REQUEST for its room)
+      info['deferred_messages'].append(data)
+      return
+    
+    handlers = self.message_handlers if info['verified'] else self.login_handlers
+    msg = message.parse_message(data)
+    handler = handlers.get(msg.type) if msg is not None else None
+    
+    if handler is not None:
+      if self.metrics:
+        self.metrics.messages_received[msg.type] += 1
+      handler(client_sock, msg)
+    elif not info['verified']:
+      # closes connection if client didn't send a correctly formatted verification/signup request
+      self.close_client_socket(client_sock)
+    # not correctly formatted messages from verified clients are ignored
+    
+  def handle_verification_request(self, client_sock, msg):
+    # attempt to verify client, response is sent once database lookup and password check are done
+    self.verify_client(client_sock, msg.username, msg.password, read_backfill_cursors(msg.after_id, msg.room_cursors), msg.codecs, msg.compression)
+    
+  def handle_signup_request(self, client_sock, msg):
+    self.sign_up_client(client_sock, msg.username, msg.password)
+    
+  def handle_client_text(self, client_sock, msg):
+    client_addr = self.client_info[client_sock]['address']
+    room_id = msg.room_id
+    
+    # clients can only send to rooms they are apart of
+    if room_id is not None and room_id not in self.client_info[client_sock]['rooms']:
+      message_logger.warning('%s attempted to send to room %s without being apart of it', client_addr, room_id)
+      return
+
+    # the SERVER_TEXT is larger than the CLIENT_TEXT, bodies are limited so that it always fits a frame (see max_text_length)
+    if not isinstance(msg.msg_body, str) or len(msg.msg_body) > message.max_text_length:
+      message_logger.warning('%s sent a text that is too long or not a string', client_addr)
+      self.send_response(client_sock, 'TEXT_RESPONSE', success=False, room_id=room_id,
+                         error_msg=f'Text has to be a string of at most {message.max_text_length} characters', status_code='413')
+      return
+
+    message_logger.debug('%s client says: [%s]', client_addr, msg.msg_body)
+
+    message_id = self.message_ids.next()
+    if not self.message_persister.submit(message_id, msg.msg_body, self.client_info[client_sock]['user_id'], room_id):
+      error_logger.warning('Message persistence queue is full, message %s will not be stored', message_id)
+
+    server_msg = message.create_message(type=message.config_msg_types['SERVER_TEXT'], msg_body=msg.msg_body,
+                                        username=self.client_info[client_sock]['username'], room_id=room_id, message_id=message_id)
+    self.client_messages.put(server_msg)
+    
+  def handle_join_room_request(self, client_sock, msg):
+    self.handle_room_request(client_sock, msg.room_id, 'add_user_to_room', True)
+    
+  def handle_leave_room_request(self, client_sock, msg):
+    self.handle_room_request(client_sock, msg.room_id, 'remove_user_from_room', False)
+    
+  def send_response(self, client_sock, type, **fields):
+    # creates, encodes and queues a response message for a single client
+    msg = message.create_message(type=message.config_msg_types[type], **fields)
+    try:
+      frame = message.encode_message(msg, self.format, self.client_info[client_sock]['codec'])
+    except exceptions.FrameTooLargeError as err:
+      error_logger.error('Could not send %s: %s (%s bytes)', type, err.message, err.frame_size)
+      return
+    self.send_to_client(client_sock, frame)
+    
+  def run_in_background(self, submit_function, args, callback, *callback_args):
+    # submits work to a pool (ex. self.db_pool.submit, self.hash_pool.submit_verify) and runs callback(future, *callback_args) on the loop thread once it's done
+    # returns False if the pool is too busy to accept more work
     try:
-      user_info = self.db_connector.get_user_info(username)
-    except exceptions.ClientLookupError:
+      future = submit_function(*args)
+    except (exceptions.DataBaseBusyError, exceptions.LoginBusyError) as err:
+      error_logger.warning(err.message)
       return False
     
-    password_hash = sha256(password.encode('utf-8')).hexdigest()
+    future.add_done_callback(lambda f: self.call_from_thread(callback, f, *callback_args))
+    return True
+  
+  def call_from_thread(self, callback, *args):
+    # schedules callback to be run by the loop thread, can be called from any thread
+    self.completed_tasks.append((callback, args))
+    try:
+      self.wakeup_send.send(b'\0')
+    except BlockingIOError:
+      pass # wakeup socket is full, so the loop is going to wake up anyway
+    
+  def run_completed_tasks(self):
+    try:
+      while self.wakeup_recv.recv(4096):
+        pass
+    except BlockingIOError:
+      pass
+    
+    while self.completed_tasks:
+      callback, args = self.completed_tasks.popleft()
+      callback(*args)
+      
+  def replay_deferred_messages(self, client_sock):
+    # processes messages that arrived while login/signup or a room request was pending, stops if another one becomes pending
+    info = self.client_info[client_sock]
+    while info['deferred_messages'] and not info['verification_pending']:
+      self.process_message(client_sock, info['deferred_messages'].popleft())
+      
+      if client_sock not in self.client_info or info['closing']:
+        return
+        
+  def handle_room_request(self, client_sock, room_id, db_method, joined):
+    # runs add_user_to_room/remove_user_from_room on a database thread, then updates the room index and responds with a ROOM_RESPONSE
+    user_id = self.client_info[client_sock]['user_id']
+    username = self.client_info[client_sock]['username']
+    
+    if self.run_in_background(self.db_pool.submit, (db_method, user_id, room_id), self.finish_room_request, client_sock, user_id, username, room_id, joined):
+      self.client_info[client_sock]['verification_pending'] = True
+    else:
+      self.send_response(client_sock, 'ROOM_RESPONSE', success=False, room_id=room_id, error_msg='Server is busy', status_code='503')
+    
+  def finish_room_request(self, future, client_sock, user_id, username, room_id, joined):
+    try:
+      future.result()
+      # index is updated even if client disconnected in the mean time, the user's other connections are still affected
+      # (including the ones connected to other workers, see apply_user_update)
+      self.apply_user_update(username, user_id, room_id, joined)
+      self.send_to_bus(message.create_message(type=message.config_msg_types['USER_UPDATE'], username=username, user_id=user_id, room_id=room_id, joined=joined))
+      fields = {'success': True, 'error_msg': '', 'status_code': ''}
+    
+    except exceptions.RoomLookupError as err:
+      error_logger.warning(err.message)
+      fields = {'success': False, 'error_msg': err.message, 'status_code': '403'}
+      
+    except exceptions.DuplicateUserRoomError as err:
+      error_logger.warning(err.message)
+      fields = {'success': False, 'error_msg': err.message, 'status_code': '409'}
+      
+    except Exception:
+      error_logger.exception('Encountered error:')
+      fields = {'success': False, 'error_msg': 'Database error', 'status_code': '500'}
+    
+    if client_sock in self.client_info:
+      self.send_response(client_sock, 'ROOM_RESPONSE', room_id=room_id, **fields)
+      
+      # client that just joined gets the room's recent messages
+      if fields['success'] and room_id in self.client_info[client_sock]['rooms']:
+        self.send_backfill(client_sock, room_id, None)
+      
+      self.client_info[client_sock]['verification_pending'] = False
+      self.replay_deferred_messages(client_sock)
+    
+  def handle_history_request(self, client_sock, msg):
+    # reads one page of a room's stored messages on a database thread, finish_history_request responds with a HISTORY_RESPONSE
+    # pages are at most max_page_size messages, clients page further back by sending the before_id of the previous response
+    room_id, before_id, limit = msg.room_id, msg.before_id, msg.limit
+    if room_id not in self.client_info[client_sock]['rooms']:
+      self.send_response(client_sock, 'HISTORY_RESPONSE', success=False, room_id=room_id, messages=[], error_msg='Not apart of room', status_code='403')
+      return
+    
+    max_page_size = server_config_history['max_page_size']
+    if not isinstance(limit, int) or not 0 < limit <= max_page_size:
+      limit = max_page_size
+    if not isinstance(before_id, int):
+      before_id = None
+    
+    if not self.run_in_background(self.db_pool.submit, ('get_room_history', room_id, before_id, limit), self.finish_history_request, client_sock, room_id, limit):
+      self.send_response(client_sock, 'HISTORY_RESPONSE', success=False, room_id=room_id, messages=[], error_msg='Server is busy', status_code='503')
+      
+  def finish_history_request(self, future, client_sock, room_id, limit):
+    try:
+      room_history = future.result()
+    except Exception:
+      error_logger.exception('Encountered error:')
+      room_history = None
+    
+    if client_sock not in self.client_info:
+      return
+    
+    if room_history is None:
+      self.send_response(client_sock, 'HISTORY_RESPONSE', success=False, room_id=room_id, messages=[], error_msg='Database error', status_code='500')
+      return
+    
+    # newest messages are kept if the page's message bodies would get larger than max_page_bytes, the rest is part of the next page
+    # (bodies are counted in characters, max_page_bytes is kept well below max_frame_size so the response always fits a frame)
+    messages = []
+    page_bytes = 0
+    for message_id, create_date, message_body, username in reversed(room_history):
+      page_bytes += len(message_body)
+      if messages and page_bytes > server_config_history['max_page_bytes']:
+        break
+      messages.append(message.create_message(type=message.config_msg_types['SERVER_TEXT'], msg_body=message_body,
+                                             username=username, room_id=room_id, message_id=message_id))
+    messages.reverse()
+    
+    # a full (or cut short) page means there may be older messages
+    before_id = messages[0]['message_id'] if len(messages) < len(room_history) or len(room_history) == limit else None
+    self.send_response(client_sock, 'HISTORY_RESPONSE', success=True, room_id=room_id, messages=messages, before_id=before_id, error_msg='', status_code='')
+  
+  def handle_ping(self, client_sock, msg):
+    self.send_response(client_sock, 'PONG')
+    
+  def handle_pong(self, client_sock, msg):
+    pass # last_activity was already updated when it was received
+    
+  def watch_client(self, client_sock):
+    # starts checking the deadlines of a new client connection, the first one is logging in within auth_timeout
+    connected_at = self.client_info[client_sock]['connected_at']
+    self.timers.schedule(client_sock, connected_at + min(server_config_heartbeat['auth_timeout'], server_config_heartbeat['ping_interval']))
+    
+  def run_timers(self):
+    # checks the deadlines of connections whose timer expired, called by the loop at least once per tick
+    now = time.monotonic()
+    for client_sock in self.timers.advance(now):
+      if client_sock in self.client_info:
+        self.check_deadlines(client_sock, now)
+    
+  def check_deadlines(self, client_sock, now):
+    # closes a connection that missed a deadline, otherwise sets its timer to its next deadline
+    # auth -- connection has to log in within auth_timeout seconds
+    # heartbeat -- a logged in client is sent a PING after ping_interval seconds without receiving anything from it,
+    #              and closed if nothing arrives within ping_timeout seconds after that (ex. half-open connections)
+    # write -- data queued for the connection has to be sent within write_timeout seconds, checked whenever the timer expires,
+    #          so a stuck connection is noticed at most one ping_interval late (the timer of a connection that hasn't
+    #          logged in yet expires at least once per ping_interval too, it isn't moved when the connection logs in)
+    # activity only updates last_activity, the timer is moved when it expires instead of on every message
+    info = self.client_info[client_sock]
+    client_outbound = info['outbound']
+    
+    if not info['verified'] and now - info['connected_at'] >= server_config_heartbeat['auth_timeout']:
+      reason = 'auth'
+    elif info['ping_sent'] is not None and info['last_activity'] < info['ping_sent'] and now - info['ping_sent'] >= server_config_heartbeat['ping_timeout']:
+      reason = 'heartbeat'
+    elif client_outbound and client_outbound.lag() >= server_config_heartbeat['write_timeout']:
+      reason = 'write'
+    else:
+      reason = None
+      
+    if reason is not None:
+      connection_logger.info('Closing connection from %s, it missed its %s deadline', info['address'], reason)
+      if self.metrics:
+        self.metrics.connection_timeouts[reason] += 1
+      self.abort_client_socket(client_sock)
+      return
+    
+    if not info['verified']:
+      deadline = min(info['connected_at'] + server_config_heartbeat['auth_timeout'], now + server_config_heartbeat['ping_interval'])
+    elif info['ping_sent'] is not None and info['last_activity'] < info['ping_sent']:
+      deadline = info['ping_sent'] + server_config_heartbeat['ping_timeout']
+    elif now - info['last_activity'] >= server_config_heartbeat['ping_interval']:
+      info['ping_sent'] = now
+      self.send_response(client_sock, 'PING')
+      deadline = now + server_config_heartbeat['ping_timeout']
+    else:
+      deadline = info['last_activity'] + server_config_heartbeat['ping_interval']
+      
+    if client_outbound:
+      deadline = min(deadline, client_outbound.waiting_since + server_config_heartbeat['write_timeout'])
+    self.timers.schedule(client_sock, deadline)
+    
+  def handle_stats_request(self, client_sock, msg):
+    # responds with the server's metrics in the prometheus text format, only to users listed in "admin_users"
+    if self.metrics is None:
+      self.send_response(client_sock, 'STATS_RESPONSE', success=False, error_msg='Metrics are disabled', status_code='404')
+    elif self.client_info[client_sock]['username'] not in server_config_metrics['admin_users']:
+      self.send_response(client_sock, 'STATS_RESPONSE', success=False, error_msg='Not an admin', status_code='403')
+    else:
+      self.send_response(client_sock, 'STATS_RESPONSE', success=True, msg_body=self.render_metrics(), error_msg='', status_code='')
+    
+  def render_metrics(self):
+    # values that can be read from the server's state are collected now instead of being counted on the hot path
+    client_infos = [info for info in self.client_info.values() if not info['bus_peer']]
+    collected = [('chatapp_connections', 'gauge', 'Open client connections', len(client_infos)),
+                 ('chatapp_verified_connections', 'gauge', 'Open connections of logged in clients', sum(1 for info in client_infos if info['verified'])),
+                 ('chatapp_pending_writes', 'gauge', 'Connections with data waiting to be written', len(self.pending_writes)),
+                 ('chatapp_connection_timers', 'gauge', 'Connections with a deadline in the timer wheel', len(self.timers)),
+                 ('chatapp_outbound_queued_bytes', 'gauge', 'Bytes queued for all connections and not yet written',
+                  sum(info['outbound'].size for info in self.client_info.values())),
+                 ('chatapp_client_messages_queue_depth', 'gauge', 'Messages waiting to be broadcast', self.client_messages.qsize()),
+                 ('chatapp_active_rooms', 'gauge', 'Rooms with connected members', len(self.room_clients)),
+                 ('chatapp_recent_messages_bytes', 'gauge', 'Bytes of frames in the recent message buffer', self.recent_messages.size),
+                 ('chatapp_recent_messages_evicted_total', 'counter', 'Messages evicted from the recent message buffer', self.recent_messages.evicted),
+                 ('chatapp_persister_queue_depth', 'gauge', 'Messages waiting to be stored', self.message_persister.messages.qsize()),
+                 ('chatapp_persister_dropped_total', 'counter', 'Messages not stored because the persister queue was full', self.message_persister.dropped),
+                 ('chatapp_persister_failed_total', 'counter', 'Messages that could not be stored', self.message_persister.failed),
+                 ('chatapp_log_records_dropped_total', 'counter', 'Log records dropped by sampling, rate limits or a full log queue', log.dropped_records())]
+    return self.metrics.render(collected)
+    
+  def render_metrics_from_thread(self):
+    # used by the metrics endpoint's threads, metrics are rendered by the loop thread so they are consistent
+    future = futures.Future()
+    self.call_from_thread(self.finish_render_metrics, future)
+    return future.result(timeout=5)
+    
+  def finish_render_metrics(self, future):
+    future.set_result(self.render_metrics())
+    
+  def apply_user_update(self, username, user_id=None, room_id=None, joined=None):
+    # user signed up (only username is given) or was added to (joined True) or removed from room_id,
+    # by a request to this worker or to another worker of the cluster
+    self.user_cache.invalidate(username) # cached login contains the user's rooms, or that the user doesn't exist
+    if room_id is None:
+      return
 
-    if username == user_info[1] and password_hash == user_info[2]:
+    if self.notification_service is not None:
+      self.notification_service.invalidate_user(user_id)
+    if joined:
+      self.subscribe_user(user_id, room_id)
+    else:
+      self.unsubscribe_user(user_id, room_id)
+    
+  def subscribe_user(self, user_id, room_id):
+    # subscribes all of the user's connections to a room the user was added to
+    for client_sock in self.user_clients.get(user_id, ()):
+      self.subscribe_client(client_sock, room_id)
+      
+  def unsubscribe_user(self, user_id, room_id):
+    # unsubscribes all of the user's connections from a room the user was removed from
+    for client_sock in self.user_clients.get(user_id, ()):
+      self.unsubscribe_client(client_sock, room_id)
+  
+  def verify_client(self, client_sock, username, password, cursors=None, codecs=None, compressions=None):
+    # answers from user_cache if possible, otherwise looks up user on a database thread, complete_verification then checks the password
+    # username is a str (checked by parse_message), so it can be used as a key of user_cache
+    # client stays in "verification pending" state until then, and anything else it sends is deferred
+    # cursors are the message_ids of the last messages the client received from each room before reconnecting, see backfill_client
+    # codecs are the codecs the client offered, the chosen one is used for everything sent to the client from now on
+    # (the client can decode every codec it offered, and only switches what it sends once it has the VERIFICATION_RESPONSE)
+    self.client_info[client_sock]['codec'] = message.choose_codec(codecs)
+    
+    # same for compression, client can decompress as soon as it offered compression
+    self.client_info[client_sock]['compression'] = compression.choose_compression(compressions)
+    if self.client_info[client_sock]['compression'] is not None:
+      self.client_info[client_sock]['compressor'] = compression.create_compressor()
+      self.client_info[client_sock]['frame_buffer'].decompressor = compression.Frame_Decompressor()
+    
+    if cursors is None:
+      cursors = read_backfill_cursors(None, None)
+    
+    cached, user_login = self.user_cache.get(username)
+    if cached:
+      self.complete_verification(client_sock, username, password, user_login, cursors)
+      return
+    
+    cache_token = self.user_cache.lookup_token()
+    if self.run_in_background(self.db_pool.submit, (lookup_user_login, username), self.finish_verification, client_sock, username, password, cache_token, cursors):
+      self.client_info[client_sock]['verification_pending'] = True
+    else:
+      self.send_response(client_sock, 'VERIFICATION_RESPONSE', success=False, error_msg='Server is busy', status_code='503')
+      self.close_client_socket_when_flushed(client_sock)
+    
+  def finish_verification(self, future, client_sock, username, password, cache_token, cursors):
+    try:
+      user_login = future.result()
+      # cached even if client disconnected in the mean time, it's likely to reconnect
+      self.user_cache.put(username, user_login, cache_token)
+    except Exception:
+      error_logger.exception('Encountered error:')
+      user_login = None
+    
+    if client_sock not in self.client_info:
+      # client disconnected while waiting for database
+      return
+    
+    self.client_info[client_sock]['verification_pending'] = False
+    self.complete_verification(client_sock, username, password, user_login, cursors)
+    
+  def complete_verification(self, client_sock, username, password, user_login, cursors):
+    # checks password against the stored hash in the hash pool, finish_password_check responds once it's done
+    if user_login is None:
+      self.send_verification_response(client_sock, False, cursors)
+      return
+    
+    user_info, user_rooms = user_login
+    if self.run_in_background(self.hash_pool.submit_verify, (password, user_info[2]), self.finish_password_check, client_sock, username, user_login, cursors):
+      self.client_info[client_sock]['verification_pending'] = True
+    else:
+      self.send_response(client_sock, 'VERIFICATION_RESPONSE', success=False, error_msg='Server is busy', status_code='503')
+      self.close_client_socket_when_flushed(client_sock)
+      
+  def finish_password_check(self, future, client_sock, username, user_login, cursors):
+    try:
+      password_matches = future.result()
+    except Exception:
+      error_logger.exception('Encountered error:')
+      password_matches = False
+    
+    if client_sock not in self.client_info:
+      return
+    
+    self.client_info[client_sock]['verification_pending'] = False
+    self.send_verification_response(client_sock, self.check_login(client_sock, username, password_matches, *user_login), cursors)
+    
+  def send_verification_response(self, client_sock, could_verify, cursors):
+    self.send_response(client_sock, 'VERIFICATION_RESPONSE', success=could_verify, error_msg='', status_code='' if could_verify else '401',
+                       codec=self.client_info[client_sock]['codec'], compression=self.client_info[client_sock]['compression'])
+    
+    # close connection if couldnt verify username and/or password
+    if not could_verify:
+      self.close_client_socket_when_flushed(client_sock)
+      return
+    
+    self.backfill_client(client_sock, [None, *self.client_info[client_sock]['rooms']], cursors)
+    self.replay_deferred_messages(client_sock)
+    
+  def backfill_client(self, client_sock, room_ids, cursors):
+    # sends the client the recent messages of the given rooms it hasn't received yet, cursors maps a room_id to the message_id
+    # of the last message the client received from that room (None if it should get everything that is buffered)
+    for room_id in room_ids:
+      self.backfill_room(client_sock, room_id, cursors[room_id])
+      
+  def backfill_room(self, client_sock, room_id, after_id, read_up_to=None):
+    # straight from recent_messages if it still holds every message after after_id
+    # otherwise what the client missed up to the buffer's horizon is read from the database first, one page of the oldest
+    # messages at a time (see finish_backfill), read_up_to is the horizon the last page was read up to if it wasn't full
+    # until all pages are queued the client doesn't get live messages of the room (they are buffered and sent right after them),
+    # so the messages of every room arrive in message_id order and a client's cursor for a room never skips one
+    # (except for messages that were evicted from the buffer before the message persister stored them)
+    horizon = self.recent_messages.horizon(room_id)
+    # messages without a room aren't part of history, only what is buffered can be backfilled
+    if after_id is None or after_id >= horizon or room_id is None or horizon == read_up_to:
+      self.resume_room(client_sock, room_id, after_id)
+      return
+    
+    db_args = ('get_room_history', room_id, horizon + 1, server_config_history['max_page_size'], after_id, True)
+    if self.run_in_background(self.db_pool.submit, db_args, self.finish_backfill, client_sock, room_id, after_id, horizon):
+      self.remove_from_room_index(client_sock, room_id)
+    else:
+      self.resume_room(client_sock, room_id, after_id)
+        
+  def finish_backfill(self, future, client_sock, room_id, after_id, read_up_to):
+    try:
+      room_history = future.result()
+    except Exception:
+      error_logger.exception('Encountered error:')
+      room_history = []
+    
+    if client_sock not in self.client_info or room_id not in self.client_info[client_sock]['rooms']:
+      # disconnected or left the room in the mean time
+      return
+    
+    for message_id, create_date, message_body, username in room_history:
+      msg = message.create_message(type=message.config_msg_types['SERVER_TEXT'], msg_body=message_body,
+                                   username=username, room_id=room_id, message_id=message_id)
+      frame = self.get_frame(message.Frame_Cache(msg, self.format), self.client_info[client_sock]['codec'])
+      if frame is not None:
+        self.send_to_client(client_sock, frame)
+      after_id = message_id
+    
+    # a full page can be followed by more messages, the horizon can also have moved while the page was read
+    if len(room_history) == server_config_history['max_page_size']:
+      read_up_to = None
+    self.backfill_room(client_sock, room_id, after_id, read_up_to)
+    
+  def resume_room(self, client_sock, room_id, after_id):
+    # sends the buffered messages after after_id, then live messages of the room are sent again
+    self.send_backfill(client_sock, room_id, after_id)
+    if room_id in self.client_info[client_sock]['rooms']:
+      self.room_clients.setdefault(room_id, set()).add(client_sock)
+    
+  def send_backfill(self, client_sock, room_id, after_id):
+    # backfill is never dropped by backpressure, a client has no way of noticing the gap (message_ids aren't consecutive)
+    for frame in self.recent_messages.frames_after(room_id, after_id, self.client_info[client_sock]['codec']):
+      self.send_to_client(client_sock, frame)
+    
+  def check_login(self, client_sock, username, password_matches, user_info, user_rooms):
+    #return True or False depending on if client could be verified, marks client as verified if it could
+    if username == user_info[1] and password_matches:
       self.client_info[client_sock]['verified'] = True
       self.client_info[client_sock]['user_id'] = user_info[0]
       self.client_info[client_sock]['username'] = user_info[1]
+      self.client_info[client_sock]['rooms'] = set()
+      self.user_clients.setdefault(user_info[0], set()).add(client_sock)
+      
+      # room index is loaded once per login and then kept current by subscribe_user/unsubscribe_user
+      for room_id, room_name in user_rooms:
+        self.subscribe_client(client_sock, room_id)
       return True
 
     return False
   
-  def sign_up_client(self, username, password):
-    # signs up new clients, client must then seperately verify to be able to use server
-    password_hash = sha256(password.encode('utf-8')).hexdigest()
+  def sign_up_client(self, client_sock, username, password):
+    # hashes password in the hash pool, then inserts user on a database thread
+    # client must then seperately verify to be able to use server
+    # username is a str (checked by parse_message), so it can be used as a key of user_cache
+    cached, user_login = self.user_cache.get(username)
+    if cached and user_login is not None:
+      # user is known to exist, no need to ask the database
+      err = exceptions.DuplicateUserError(username)
+      self.send_response(client_sock, 'SIGNUP_RESPONSE', success=False, error_msg=err.message, status_code='409')
+      return
     
+    if self.run_in_background(self.hash_pool.submit_hash, (password,), self.insert_signed_up_user, client_sock, username):
+      self.client_info[client_sock]['verification_pending'] = True
+    else:
+      self.send_response(client_sock, 'SIGNUP_RESPONSE', success=False, error_msg='Server is busy', status_code='503')
+      
+  def insert_signed_up_user(self, future, client_sock, username):
     try:
-      self.db_connector.insert_user(username, password_hash)
-      return True
+      password_hash = future.result()
+    except Exception:
+      error_logger.exception('Encountered error:')
+      self.finish_sign_up_with(client_sock, success=False, error_msg='Could not hash password', status_code='500')
+      return
+    
+    # user is inserted even if client disconnected in the mean time, like it would be if hashing was done inline
+    if not self.run_in_background(self.db_pool.submit, ('insert_user', username, password_hash), self.finish_sign_up, client_sock, username):
+      self.finish_sign_up_with(client_sock, success=False, error_msg='Server is busy', status_code='503')
+    
+  def finish_sign_up(self, future, client_sock, username):
+    try:
+      future.result()
+      self.apply_user_update(username) # removes cached negative lookups
+      self.send_to_bus(message.create_message(type=message.config_msg_types['USER_UPDATE'], username=username))
+      fields = {'success': True, 'error_msg': '', 'status_code': ''}
     
     except exceptions.DuplicateUserError as err:
-      self.print_tstamp(err.message)
+      error_logger.warning(err.message)
+      fields = {'success': False, 'error_msg': err.message, 'status_code': '409'}
+      
+    except Exception:
+      error_logger.exception('Encountered error:')
+      fields = {'success': False, 'error_msg': 'Database error', 'status_code': '500'}
+    
+    self.finish_sign_up_with(client_sock, **fields)
+    
+  def finish_sign_up_with(self, client_sock, **fields):
+    if client_sock not in self.client_info:
+      return
+    
+    self.client_info[client_sock]['verification_pending'] = False
+    self.send_response(client_sock, 'SIGNUP_RESPONSE', **fields)
+    self.replay_deferred_messages(client_sock)
+  
+  def send_to_client(self, client_sock, data, critical=True):
+    # queues already encoded frame for a single client, it is written once select() reports the socket as writable
+    # the frame isn't copied, so the same frame can be queued for any number of clients (it is compressed for the client when written)
+    # critical is False for chat messages, which may be dropped if the client can't keep up (see apply_backpressure)
+    client_info = self.client_info[client_sock]
+    client_outbound = client_info['outbound']
+    
+    if client_outbound.size + len(data) > self.max_queued_bytes and not client_info['bus_peer']:
+      if not self.apply_backpressure(client_sock, len(data), critical):
+        return
+      
+    client_outbound.append(data, critical)
+    self.pending_writes.add(client_sock)
+    
+  def apply_backpressure(self, client_sock, frame_size, critical):
+    # called when a frame would grow a client's outbound queue past max_queued_bytes, returns True if the frame should still be queued
+    # drop_oldest -- chat messages queued the longest are dropped to make room, the client keeps getting the newest ones
+    # skip_non_critical -- new chat messages aren't queued until the client caught up
+    # disconnect -- client is disconnected, it can reconnect with after_id and be backfilled
+    # with any policy clients are disconnected once they haven't caught up for more than max_lag seconds
+    # responses are always queued, they are small and only sent when the client asked for them
+    # bus peers are never limited, their messages are for all clients of another worker
+    if client_sock in self.slow_clients:
+      return False
+    
+    client_outbound = self.client_info[client_sock]['outbound']
+    lagging = self.max_lag is not None and client_outbound.lag() > self.max_lag
+    if self.backpressure_policy == 'disconnect' or lagging:
+      reason = 'max_lag' if lagging else 'queue_limit'
+      connection_logger.warning('Disconnecting slow client %s (%s, %s bytes queued)', self.client_info[client_sock]['address'],
+                                reason, client_outbound.size)
+      if self.metrics:
+        self.metrics.slow_client_disconnects[reason] += 1
+      
+      if not self.slow_clients:
+        self.call_from_thread(self.close_slow_clients) # client_sock may be in a set that is being iterated over right now
+      self.slow_clients.add(client_sock)
       return False
+    
+    if critical:
+      return True
+    
+    if self.backpressure_policy == 'drop_oldest':
+      # dropped down to half the limit, so a client that stays behind doesn't rebuild its queue for every message
+      dropped = client_outbound.drop_oldest(self.max_queued_bytes // 2 - frame_size)
+      if self.metrics:
+        self.metrics.frames_dropped['drop_oldest'] += dropped
+      if client_outbound.size + frame_size <= self.max_queued_bytes:
+        return True
+      
+    if self.metrics:
+      self.metrics.frames_dropped[self.backpressure_policy] += 1
+    return False
+    
+  def close_slow_clients(self):
+    for client_sock in self.slow_clients:
+      if client_sock in self.client_info:
+        self.abort_client_socket(client_sock)
+    self.slow_clients.clear()
+    
+  def abort_client_socket(self, client_sock):
+    # closes connection without sending what is still queued for it
+    self.close_client_socket(client_sock)
+    
+  def flush_client_socket(self, client_sock):
+    # sends as much of the outbound queue as the socket accepts with one sendmsg call, keeping the rest for the next writable event
+    client_outbound = self.client_info[client_sock]['outbound']
+    
+    try:
+      sent = client_outbound.flush(client_sock, self.client_info[client_sock]['compressor'])
+      
+    except BlockingIOError:
+      return
+    
+    except OSError as err:
+      error_logger.warning('Encountered error: %s', err)
+      self.close_client_socket(client_sock)
+      return
+    
+    if self.metrics:
+      self.metrics.bytes_sent += sent
+    
+    if not client_outbound:
+      self.pending_writes.discard(client_sock)
+      
+      if self.client_info[client_sock]['closing']:
+        self.close_client_socket(client_sock)
   
-  def broadcast_message(self, client_socks):
+  def broadcast_message(self):
     # broadcasts messages sent from other clients to other clients
-    # takes a list of client sockets to broadcast message to
-    try:
-      msg = self.client_messages.get_nowait() # get message sent from a client
-      msg = json.dumps(msg)          # convert from python dict to json string
-      msg = msg.encode(self.format)  # encode from json string to utf-8 bytes
+    # drains every message queued since the last call, so broadcast latency doesn't grow with the queue
+    if self.metrics:
+      depth = self.client_messages.qsize()
+      if depth:
+        self.metrics.client_messages_depth.observe(depth)
+        self.metrics.messages_broadcast += depth
+    
+    while True:
+      try:
+        msg = self.client_messages.get_nowait() # get message sent from a client
+      except queue.Empty:
+        break
+      
+      frames = message.Frame_Cache(msg, self.format) # message is encoded once per codec in use, not once per client
+      self.fan_out_message(msg, frames)
+      
+      # other worker processes fan the message out to their own clients
+      self.send_to_bus(msg, frames)
+  
+  def send_to_bus(self, msg, frames=None):
+    # sends a message to the other worker processes when running as a cluster, frames is the message's Frame_Cache if it has one already
+    if not self.bus_peers:
+      return
+    
+    if frames is None:
+      frames = message.Frame_Cache(msg, self.format)
+    for peer in self.bus_peers:
+      frame = self.get_frame(frames, self.client_info[peer]['codec'])
+      if frame is not None:
+        self.send_to_client(peer, frame)
+  
+  def fan_out_message(self, msg, frames):
+    # sends message to the clients connected to this process that should receive it, frames is the message's Frame_Cache
+    # messages addressed to a room only go to that room's connected members, messages without a room go to all verified clients
+    room_id = msg.get('room_id')
+    if room_id is not None:
+      client_socks = self.room_clients.get(room_id, ())
+    else:
+      client_socks = [s for s, info in self.client_info.items() if info['verified']]
 
-      self.print_tstamp(f'Broadcasting message to {len(client_socks)} clients...')
-      for s in client_socks:
-        s.send(msg)
-      self.print_tstamp(f'Broadcasted message to {len(client_socks)} clients')
+    broadcast_logger.debug('Broadcasting message to %s clients...', len(client_socks))
+    for s in client_socks:
+      frame = self.get_frame(frames, self.client_info[s]['codec'])
+      if frame is not None:
+        self.send_to_client(s, frame, critical=False)
+    broadcast_logger.debug('Broadcasted message to %s clients', len(client_socks))
     
-    except queue.Empty:
-      pass
+    # buffered after sending, so the frames of the codecs in use are already encoded and counted
+    if 'message_id' in msg:
+      self.recent_messages.append(room_id, msg['message_id'], frames)
+      if self.notification_service is not None:
+        self.notification_service.publish(msg)
+  
+  def get_frame(self, frames, codec):
+    # returns the frame of a Frame_Cache for codec, None if the message doesn't fit a frame with that codec
+    # a message that can't be sent is skipped instead of stopping the broadcast (and with it the loop)
+    try:
+      return frames.get(codec)
+    except exceptions.FrameTooLargeError as err:
+      error_logger.error('Could not send message %s: %s (%s bytes)', frames.msg.get('message_id'), err.message, err.frame_size)
+      return None
   
   def send_message(self, client_sock, msg_content):
     # respond to client with a predefined message from the server
@@ -196,52 +1039,65 @@ class TCP_Nonblocking_Server:
       
       msg = message.create_message(type=message.config_msg_types['SERVER_TEXT'], msg_body=msg_content, username=client_username)
       
-      msg = json.dumps(msg)            # convert msg from python dict to json string
-      msg = msg.encode(self.format)             # encoding msg from json string to utf-8 bytes
-      send_info = client_sock.send(msg)         # sending msg
+      msg = message.encode_message(msg, self.format, self.client_info[client_sock]['codec']) # convert msg from python dict to length-prefixed frame
+      self.send_to_client(client_sock, msg)
       
-      self.print_tstamp(f'Sent {send_info} bytes to {client_addr}')
+      message_logger.debug('Queued %s bytes for %s', len(msg), client_addr)
       
     except KeyError:
-      # handles a condition where client socket is in the writable list
-      # even though it's been removed from the dictionary
+      # handles a condition where client socket has already been removed from the dictionary
       pass
     
-    except OSError as err:
-      self.print_tstamp(f'Encountered error: {err}')
-    
     
   def handle_exception_socket(self, client_sock):
     client_addr = self.client_info[client_sock]['address']
     self.close_client_socket(client_sock)
-    self.print_tstamp(f'Closed exception socket from address {client_addr}')
+    connection_logger.info('Closed exception socket from address %s', client_addr)
 
   def listen_for_connections(self):
     # main function which handles connections and dispatches them to appropriate functions to be accepted, responded to, received from, etc.
-    self.print_tstamp('Listening for connections...')
-    self.sock.listen(10)
+    logger.info('Listening for connections...')
+    self.sock.listen(self.backlog)
     try:
       while True:
-        readable_socks, writable_socks, error_socks = select.select(self.client_list, self.client_list, self.client_list, self.timeout)
+        # sockets are only checked for writability while they have data waiting to be sent,
+        # otherwise select() would return immediately on every iteration and the loop would spin
+        readable_socks, writable_socks, error_socks = select.select(self.client_list, list(self.pending_writes), self.client_list, self.timeout)
+        iteration_start = time.perf_counter()
+        
         # read from readable sockets
         for sock in readable_socks:
           # if the socket is server socket, accept the connection
           if sock is self.sock:
             self.accept_client_socket()
-          # otherwise receive the client request
-          else:
+          # background work finished and woke up the loop
+          elif sock is self.wakeup_recv:
+            self.run_completed_tasks()
+          # otherwise receive the client request, unless the socket was closed earlier in this iteration (ex. by close_slow_clients)
+          elif sock in self.client_info:
             self.receive_message(sock)
             
-        if writable_socks:
-          self.broadcast_message(writable_socks)
+        for sock in writable_socks:
+          # socket may have been closed while reading
+          if sock in self.pending_writes:
+            self.flush_client_socket(sock)
         
         for sock in error_socks:
-          self.handle_exception_socket(sock)
+          if sock in self.client_info:
+            self.handle_exception_socket(sock)
+        
+        # queue all messages received this iteration, they are written on the next iteration
+        self.broadcast_message()
+        
+        self.run_timers()
+        
+        if self.metrics:
+          self.metrics.loop_iteration.observe(time.perf_counter() - iteration_start)
         
     except KeyboardInterrupt:
-      self.print_tstamp('Shutting down server...')
+      logger.info('Shutting down server...')
       self.shutdown_server()
-      self.print_tstamp('Server shut down')
+      logger.info('Server shut down')
         
   def shutdown_server(self):
     for s in self.client_list:
@@ -251,11 +1107,39 @@ class TCP_Nonblocking_Server:
     del self.client_info
     
     self.sock.close()
+    self.wakeup_send.close()
+    
+    logger.info('Recent message buffer: %s', self.recent_messages.stats())
+    if self.metrics_endpoint is not None:
+      self.metrics_endpoint.shutdown()
+    if self.notification_service is not None:
+      self.notification_service.shutdown()
+    self.db_pool.shutdown()
+    self.hash_pool.shutdown()
+    self.message_persister.shutdown()
+    self.db_connector.shutdown()
     
 
 def run_server():  
-  server = TCP_Nonblocking_Server('localhost', 8080)
+  engine = server_config_python_server['engine']
+  backlog = server_config_python_server['backlog']
+  workers = server_config_python_server['workers']
+  
+  if workers > 1:
+    from chatapp.server import cluster
+    cluster.run_cluster(workers, engine, 'localhost', 8080, backlog)
+    return
+  
+  server = create_server(engine, 'localhost', 8080, backlog=backlog)
   server.listen_for_connections()
   
+def create_server(engine, host, port, **kwargs):
+  # creates server using the given engine ("select" or "asyncio"), kwargs are passed on to the server
+  if engine == 'asyncio':
+    from chatapp.server import async_server
+    return async_server.Async_TCP_Server(host, port, **kwargs)
+  
+  return TCP_Nonblocking_Server(host, port, **kwargs)
+  
 if __name__ == '__main__':
   run_server()
\ No newline at end of file
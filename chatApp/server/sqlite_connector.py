@@ -0,0 +1,242 @@
+import sqlite3
+from datetime import date, datetime
+
+from chatapp.shared import exceptions, log
+from chatapp.server import storage
+
+logger = log.get_logger('server')
+
+# single file storage backend, see storage.py
+# same tables, indexes and rows as DB_Connector (server/db_connector.py), queries use ? placeholders instead of %s
+# the database is opened in WAL mode, so readers (ex. history requests) don't wait for the message persister's writes,
+# and several processes (workers of a cluster) can use the same file
+
+def to_date_text(value):
+  # dates are stored as ISO 8601 text, like the DATE columns of postgres only the date of a datetime is kept
+  if isinstance(value, datetime):
+    value = value.date()
+  if isinstance(value, date):
+    return value.isoformat()
+  return value
+
+# DATE columns are read back as datetime.date, like psycopg2 returns them
+sqlite3.register_converter('DATE', lambda value: date.fromisoformat(value.decode()))
+
+class SQLite_Connector(storage.Storage):
+  def __init__(self, path, busy_timeout):
+    # busy_timeout -- seconds to wait for another connection's write to finish before raising sqlite3.OperationalError
+    self.conn = sqlite3.connect(path, timeout=busy_timeout, detect_types=sqlite3.PARSE_DECLTYPES)
+    self.cursor = self.conn.cursor()
+
+    self.cursor.execute('PRAGMA journal_mode = WAL;')
+    self.cursor.execute('PRAGMA synchronous = NORMAL;') # WAL is still consistent after a crash, only the last commits can be lost on power loss
+    self.cursor.execute('PRAGMA foreign_keys = ON;')
+
+  def create_tables_if_needed(self):
+    self.cursor.executescript('''CREATE TABLE IF NOT EXISTS users(
+                                user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                user_name VARCHAR(32) NOT NULL,
+                                user_password_hash VARCHAR(255) NOT NULL
+                              );
+
+                              CREATE TABLE IF NOT EXISTS room(
+                                room_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                room_name VARCHAR(32) NOT NULL
+                              );
+
+                              CREATE TABLE IF NOT EXISTS user_room(
+                                user_room_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                room_id INT REFERENCES room(room_id) ON DELETE CASCADE,
+                                user_id INT REFERENCES users(user_id) ON DELETE CASCADE
+                              );
+
+                              CREATE TABLE IF NOT EXISTS message(
+                                message_id INTEGER PRIMARY KEY,
+                                create_date DATE,
+                                message_body TEXT,
+                                creator_id INT REFERENCES users(user_id) ON DELETE CASCADE,
+                                room_id INT REFERENCES room(room_id) ON DELETE CASCADE
+                              );
+
+                              CREATE INDEX IF NOT EXISTS message_room_id_message_id_idx ON message (room_id, message_id);
+                              CREATE INDEX IF NOT EXISTS message_creator_id_message_id_idx ON message (creator_id, message_id);
+                              CREATE INDEX IF NOT EXISTS user_room_user_id_room_id_idx ON user_room (user_id, room_id);
+                              CREATE INDEX IF NOT EXISTS user_room_room_id_idx ON user_room (room_id);
+                              ''')
+    # user names are unique like in DB_Connector, files of older versions had a plain index and can have duplicate names
+    if not self.index_exists('users_user_name_key'):
+      duplicate_names = self.get_duplicate_user_names()
+      if duplicate_names:
+        logger.warning('user_name is not unique until duplicate users are renamed or removed: %s', duplicate_names)
+        self.cursor.execute('''CREATE INDEX IF NOT EXISTS users_user_name_idx ON users (user_name);''')
+      else:
+        self.cursor.executescript('''CREATE UNIQUE INDEX users_user_name_key ON users (user_name);
+                                    DROP INDEX IF EXISTS users_user_name_idx;''')
+    self.conn.commit()
+
+  def index_exists(self, index_name):
+    self.cursor.execute('''SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?;''', (index_name,))
+    return self.cursor.fetchone() is not None
+
+  def get_duplicate_user_names(self):
+    # returns up to 10 user names that more than one user has
+    self.cursor.execute('''SELECT user_name FROM users GROUP BY user_name HAVING COUNT(*) > 1 ORDER BY user_name LIMIT 10;''')
+    return [row[0] for row in self.cursor.fetchall()]
+
+  def insert_user(self, user_name, user_password_hash):
+    self.cursor.execute('''SELECT * FROM users WHERE user_name = ?;''', (user_name,))
+    duplicates = self.cursor.fetchall()
+
+    if duplicates:
+      raise exceptions.DuplicateUserError(user_name)
+
+    try:
+      self.cursor.execute('''INSERT INTO users (user_name, user_password_hash)
+                          VALUES (?, ?);''', (user_name, user_password_hash))
+    except sqlite3.IntegrityError as err:
+      if 'UNIQUE' not in str(err):
+        raise
+      # another connection (ex. a worker of a cluster) inserted the same name after the SELECT above
+      self.conn.rollback()
+      raise exceptions.DuplicateUserError(user_name)
+    self.conn.commit()
+
+  def insert_room(self, room_name):
+    self.cursor.execute('''SELECT * FROM room WHERE room_name = ?;''', (room_name,))
+    duplicates = self.cursor.fetchall()
+
+    if duplicates:
+      raise exceptions.DuplicateRoomError(room_name)
+
+    self.cursor.execute('''INSERT INTO room (room_name)
+                        VALUES (?);''', (room_name,))
+    self.conn.commit()
+
+  def insert_message(self, create_date, message_body, creator_id, room_id):
+    self.cursor.execute('''INSERT INTO message (create_date, message_body, creator_id, room_id)
+                        VALUES (?, ?, ?, ?);''',
+                        (to_date_text(create_date), message_body, creator_id, room_id))
+    self.conn.commit()
+
+  def insert_messages(self, messages):
+    # inserts many messages in a single transaction
+    self.cursor.executemany('''INSERT INTO message (message_id, create_date, message_body, creator_id, room_id)
+                            VALUES (?, ?, ?, ?, ?);''',
+                            [(message_id, to_date_text(create_date), message_body, creator_id, room_id)
+                             for message_id, create_date, message_body, creator_id, room_id in messages])
+    self.conn.commit()
+
+  def get_max_message_id(self):
+    self.cursor.execute('''SELECT COALESCE(MAX(message_id), 0) FROM message;''')
+    return self.cursor.fetchone()[0]
+
+  def add_user_to_room(self, user_id, room_id):
+    self.cursor.execute('''SELECT * FROM room WHERE room_id = ?;''', (room_id,))
+    room = self.cursor.fetchone()
+
+    if not room:
+      raise exceptions.RoomLookupError(room_id)
+
+    self.cursor.execute('''SELECT * FROM user_room WHERE user_id = ? AND room_id = ?;''', (user_id, room_id))
+    duplicates = self.cursor.fetchall()
+
+    if duplicates:
+      raise exceptions.DuplicateUserRoomError(user_id, room_id)
+
+    self.cursor.execute('''INSERT INTO user_room (user_id, room_id)
+                        VALUES (?, ?);''', (user_id, room_id))
+    self.conn.commit()
+
+  def remove_user_from_room(self, user_id, room_id):
+    self.cursor.execute('''DELETE FROM user_room
+                        WHERE user_id = ?
+                        AND room_id = ?;''', (user_id, room_id))
+    self.conn.commit()
+
+  def get_user_info(self, user_name):
+    self.cursor.execute('''SELECT * FROM users WHERE user_name = ?;''', (user_name,))
+    matches = self.cursor.fetchone()
+
+    if not matches:
+      raise exceptions.ClientLookupError(user_name)
+
+    return matches
+
+  def get_user_rooms(self, user_id):
+    self.cursor.execute('''SELECT room.room_id, room.room_name
+                          FROM user_room
+                          INNER JOIN room
+                          ON user_room.room_id = room.room_id
+                          WHERE user_room.user_id = ?;''', (user_id,))
+    return self.cursor.fetchall()
+
+  def get_room_users(self, room_id):
+    self.cursor.execute('''SELECT users.user_id, users.user_name
+                          FROM user_room
+                          INNER JOIN users
+                          ON user_room.user_id = users.user_id
+                          WHERE user_room.room_id = ?;''', (room_id,))
+    return self.cursor.fetchall()
+
+  def get_room_history(self, room_id, before_message_id, limit, after_message_id=0, oldest=False):
+    # keyset pagination like DB_Connector.get_room_history, one range scan of message_room_id_message_id_idx per page
+    if before_message_id is None:
+      before_message_id = 2**63 - 1 # largest INTEGER
+
+    self.cursor.execute('''SELECT message.message_id, message.create_date, message.message_body, users.user_name
+                          FROM message
+                          INNER JOIN users
+                          ON users.user_id = message.creator_id
+                          WHERE message.room_id = ?
+                          AND message.message_id < ?
+                          AND message.message_id > ?
+                          ORDER BY message.message_id ''' + ('ASC' if oldest else 'DESC') + '''
+                          LIMIT ?;''', (room_id, before_message_id, after_message_id, limit))
+    room_history = self.cursor.fetchall()
+    if not oldest:
+      room_history.reverse()
+    return room_history
+
+  def get_room_messages(self, room_id, start_date, end_date, limit):
+    self.cursor.execute('''SELECT *
+                          FROM message
+                          WHERE message.room_id = ?
+                          AND message.create_date BETWEEN ? AND ?
+                          ORDER BY message.message_id
+                          LIMIT ?;''',
+                          (room_id, to_date_text(start_date), to_date_text(end_date), limit))
+    return self.cursor.fetchall()
+
+  def get_user_messages(self, user_id, start_date, end_date, limit):
+    self.cursor.execute('''SELECT room.*, message.*
+                          FROM user_room
+                          INNER JOIN room
+                          ON room.room_id = user_room.room_id
+                          INNER JOIN message
+                          ON message.room_id = room.room_id
+                          WHERE user_room.user_id = ?
+                          AND message.create_date BETWEEN ? AND ?
+                          ORDER BY message.message_id
+                          LIMIT ?;''', (user_id, to_date_text(start_date), to_date_text(end_date), limit))
+    return self.cursor.fetchall()
+
+  def get_user_room_messages(self, user_id, room_id, start_date, end_date, limit):
+    self.cursor.execute('''SELECT room.*, message.*
+                          FROM user_room
+                          INNER JOIN room
+                          ON room.room_id = user_room.room_id
+                          INNER JOIN message
+                          ON message.room_id = room.room_id
+                          WHERE user_room.user_id = ?
+                          AND message.room_id = ?
+                          AND message.create_date BETWEEN ? AND ?
+                          ORDER BY message.message_id
+                          LIMIT ?;''', (user_id, room_id, to_date_text(start_date), to_date_text(end_date), limit))
+    return self.cursor.fetchall()
+
+  def rollback(self):
+    self.conn.rollback()
+
+  def shutdown(self):
+    self.cursor.close()
+    self.conn.close()
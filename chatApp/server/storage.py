@@ -0,0 +1,106 @@
+import functools, os
+from chatapp import path_util
+
+# storage backends, selected by "backend" in the "storage" section of server_config.json
+#   postgres: DB_Connector (server/db_connector.py), connection configured by "postgres_server"
+#   sqlite:   SQLite_Connector (server/sqlite_connector.py), a single file database for single node deployments,
+#             can be shared by the workers of a cluster
+#   memory:   Memory_Connector (server/memory_connector.py), everything is kept in the server process and lost when it stops,
+#             for tests and benchmarks (every worker of a cluster would have its own database, so it can't be used with workers)
+# backend modules are only imported once they are used, so psycopg2 is only required for postgres
+backends = ('postgres', 'sqlite', 'memory')
+
+class Storage:
+  # interface implemented by every backend's connector
+  # the server creates one connector per thread (database pool workers, message persister, setup), a connector is only used by one thread
+  # methods raise the exceptions in shared/exceptions.py documented below, rows are tuples in the column order of the tables
+  # in db_connector.py: users (user_id, user_name, user_password_hash), room (room_id, room_name),
+  # message (message_id, create_date, message_body, creator_id, room_id)
+
+  def create_tables_if_needed(self):
+    raise NotImplementedError
+
+  def insert_user(self, user_name, user_password_hash):
+    # raises DuplicateUserError if user_name is taken
+    raise NotImplementedError
+
+  def insert_room(self, room_name):
+    # raises DuplicateRoomError if room_name is taken
+    raise NotImplementedError
+
+  def insert_message(self, create_date, message_body, creator_id, room_id):
+    raise NotImplementedError
+
+  def insert_messages(self, messages):
+    # messages is a list of (message_id, create_date, message_body, creator_id, room_id) tuples, message ids are allocated by the server
+    raise NotImplementedError
+
+  def get_max_message_id(self):
+    # largest message_id stored, 0 if there are no messages
+    raise NotImplementedError
+
+  def add_user_to_room(self, user_id, room_id):
+    # raises RoomLookupError if the room doesn't exist, DuplicateUserRoomError if the user is already in it
+    raise NotImplementedError
+
+  def remove_user_from_room(self, user_id, room_id):
+    raise NotImplementedError
+
+  def get_user_info(self, user_name):
+    # returns users row, raises ClientLookupError if there is no such user
+    raise NotImplementedError
+
+  def get_user_rooms(self, user_id):
+    # returns (room_id, room_name) of every room the user is in
+    raise NotImplementedError
+
+  def get_room_users(self, room_id):
+    # returns (user_id, user_name) of every user in the room
+    raise NotImplementedError
+
+  def get_room_history(self, room_id, before_message_id, limit, after_message_id=0, oldest=False):
+    # returns up to limit (message_id, create_date, message_body, user_name) of the room with a message_id below before_message_id
+    # (no upper bound if it is None) and above after_message_id, the newest ones of that range (the oldest ones if oldest is True),
+    # oldest first
+    raise NotImplementedError
+
+  def get_room_messages(self, room_id, start_date, end_date, limit):
+    # returns up to limit message rows of the room created between start_date and end_date, oldest first
+    raise NotImplementedError
+
+  def get_user_messages(self, user_id, start_date, end_date, limit):
+    # returns up to limit room row + message row of messages created between start_date and end_date in any room the user is in, oldest first
+    raise NotImplementedError
+
+  def get_user_room_messages(self, user_id, room_id, start_date, end_date, limit):
+    # like get_user_messages but only for one room
+    raise NotImplementedError
+
+  def rollback(self):
+    # aborts the current transaction after a failed call, so the connector can be used again
+    raise NotImplementedError
+
+  def shutdown(self):
+    raise NotImplementedError
+
+def create_connector_factory(storage_config, postgres_config):
+  # returns a function creating a new connector of the configured backend every time it's called
+  backend = storage_config['backend']
+
+  if backend == 'postgres':
+    from chatapp.server import db_connector
+    return functools.partial(db_connector.DB_Connector, postgres_config['ip'], postgres_config['port'], postgres_config['dbname'],
+                             postgres_config['user'], postgres_config['password'])
+
+  if backend == 'sqlite':
+    from chatapp.server import sqlite_connector
+    # relative paths are relative to the server directory, like server_config.json
+    path = os.path.join(path_util.get_dir_path('server'), storage_config['sqlite_path'])
+    return functools.partial(sqlite_connector.SQLite_Connector, path, storage_config['sqlite_busy_timeout'])
+
+  if backend == 'memory':
+    from chatapp.server import memory_connector
+    # every connector of the process shares the same data
+    return functools.partial(memory_connector.Memory_Connector, memory_connector.Memory_Store())
+
+  raise ValueError(f'Unknown storage backend {backend}, expected one of {backends}')
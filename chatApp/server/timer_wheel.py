@@ -0,0 +1,52 @@
+import math
+
+class Timer_Wheel:
+  # hashed timer wheel, keeps one timer per key (ex. a client socket) in slots of tick seconds
+  # advancing the wheel only looks at the slots whose tick has come, so checking the deadlines of any number of
+  # connections costs O(expired timers) instead of a scan over all connections
+  # timers further away than slots * tick stay in their slot for more turns of the wheel and are looked at once per turn,
+  # so slots * tick should be larger than the longest delay
+  # deadlines are in time.monotonic() seconds, timers expire up to one tick late
+  def __init__(self, tick, slots, now):
+    self.tick = tick
+    self.slots = [{} for i in range(slots)] # key -> tick the key's timer expires at
+    self.timers = {} # key -> index of the slot the key's timer is in
+    self.current_tick = int(now / tick) # every slot up to this tick has been expired
+
+  def __len__(self):
+    return len(self.timers)
+
+  def schedule(self, key, deadline):
+    # sets the key's timer, replacing the one it already had
+    self.cancel(key)
+
+    tick = max(math.ceil(deadline / self.tick), self.current_tick + 1)
+    index = tick % len(self.slots)
+    self.slots[index][key] = tick
+    self.timers[key] = index
+
+  def cancel(self, key):
+    index = self.timers.pop(key, None)
+    if index is not None:
+      del self.slots[index][key]
+
+  def advance(self, now):
+    # returns keys whose deadline has passed, their timers are removed
+    # timers are compared by tick instead of deadline, so rounding can't leave an expired timer in its slot for another turn
+    target_tick = int(now / self.tick)
+    steps = min(target_tick - self.current_tick, len(self.slots)) # after a long pause every slot is only looked at once
+    expired = []
+
+    for tick in range(target_tick - steps + 1, target_tick + 1):
+      slot = self.slots[tick % len(self.slots)]
+      if not slot:
+        continue
+
+      for key, expiry_tick in list(slot.items()):
+        if expiry_tick <= tick:
+          del slot[key]
+          del self.timers[key]
+          expired.append(key)
+
+    self.current_tick = max(self.current_tick, target_tick)
+    return expired
@@ -0,0 +1,49 @@
+import collections, time
+
+class User_Cache:
+  # bounded LRU cache of user logins (user_info, user_rooms) keyed by username, entries expire after ttl seconds
+  # usernames that don't exist are cached as well (negative lookups, value None) for the shorter negative_ttl,
+  # so repeated logins with an unknown username don't reach the database either
+  # only used from the loop thread, so no locking is needed
+  def __init__(self, max_size, ttl, negative_ttl):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+
+    self.entries = collections.OrderedDict() # username -> (expires_at, user_login), least recently used first
+    self.invalidations = 0 # increased on every invalidation, lookups that started before one aren't cached
+
+  def get(self, username):
+    # returns (True, user_login) if username is cached, user_login is None for users that don't exist
+    # returns (False, None) if username isn't cached
+    entry = self.entries.get(username)
+    if entry is None:
+      return False, None
+
+    expires_at, user_login = entry
+    if expires_at < time.monotonic():
+      del self.entries[username]
+      return False, None
+
+    self.entries.move_to_end(username)
+    return True, user_login
+
+  def lookup_token(self):
+    # taken before starting a database lookup and passed to put(), so results that may be outdated aren't cached
+    return self.invalidations
+
+  def put(self, username, user_login, token):
+    if token != self.invalidations:
+      return
+
+    ttl = self.ttl if user_login is not None else self.negative_ttl
+    self.entries[username] = (time.monotonic() + ttl, user_login)
+    self.entries.move_to_end(username)
+
+    if len(self.entries) > self.max_size:
+      self.entries.popitem(last=False)
+
+  def invalidate(self, username):
+    # called when a user is inserted or the user's rooms change
+    self.entries.pop(username, None)
+    self.invalidations += 1
@@ -0,0 +1,176 @@
+# compact binary encoding of messages, used instead of json on connections that negotiated it (see "codecs" in shared_config.json)
+# message types and known field names are sent as one byte ids instead of repeating their names in every frame
+#
+# payload:  marker (1 byte, never the first byte of a json payload), type id (1 byte), field count (1 byte), fields
+# field:    field id (1 byte), value
+#           field id 0 is followed by the field's name (short string value) for fields that don't have an id
+# value:    tag (1 byte), data
+#           0 None, 1 False, 2 True, 3 int (8 byte signed), 4 string up to 255 bytes (1 byte length, utf-8),
+#           5 longer string (4 byte length, utf-8), 6 list (4 byte item count, values),
+#           7 message (type id, field count, fields, like a payload)
+# lists and messages nest at most "max_depth" levels deep, deeper payloads are malformed (the payload itself is level 0)
+import json, os, struct
+from chatapp import path_util
+from chatapp.shared import exceptions
+
+shared_config_file_path = os.path.join(path_util.get_dir_path('shared'), 'shared_config.json')
+with open(shared_config_file_path, 'r') as config_json:
+  shared_config = json.load(config_json)
+
+config_msg_types = shared_config['messages']['message_types']
+config_binary = shared_config['codecs']['binary']
+
+marker = config_binary['marker']
+max_depth = config_binary['max_depth']
+type_ids = {config_msg_types[type_key]: type_id for type_key, type_id in config_binary['type_ids'].items()}
+types_by_id = {type_id: type for type, type_id in type_ids.items()}
+field_ids = config_binary['field_ids']
+fields_by_id = {field_id: field for field, field_id in field_ids.items()}
+field_prefixes = {field: bytes([field_id]) for field, field_id in field_ids.items()}
+
+NONE, FALSE, TRUE, INT, SHORT_STR, STR, LIST, MESSAGE = range(8)
+
+message_header = struct.Struct('!BBB') # marker (or message tag for nested messages), type id, field count
+short_str_value = struct.Struct('!BB') # tag + string length
+int_value = struct.Struct('!Bq')
+long_value = struct.Struct('!BI') # tag + string length or list item count
+int_data = struct.Struct('!q')
+uint_data = struct.Struct('!I')
+unpack_header = message_header.unpack_from
+unpack_int = int_data.unpack_from
+
+def encode(msg):
+  # returns payload (without frame header) of a message dict
+  parts = []
+  append_message(parts, msg, marker)
+  return b''.join(parts)
+
+def append_message(parts, msg, first_byte):
+  try:
+    type_id = type_ids[msg['type']]
+  except KeyError:
+    raise exceptions.InvalidMessageFormattingError(msg)
+
+  if len(msg) > 256:
+    raise exceptions.InvalidMessageFormattingError(msg)
+  parts.append(message_header.pack(first_byte, type_id, len(msg) - 1))
+
+  for field, value in msg.items():
+    if field == 'type':
+      continue
+
+    field_prefix = field_prefixes.get(field)
+    if field_prefix is None:
+      parts.append(b'\0')
+      append_value(parts, field)
+    else:
+      parts.append(field_prefix)
+    append_value(parts, value)
+
+def append_value(parts, value):
+  # compares exact types, so True/False aren't encoded as ints
+  value_type = type(value)
+  if value_type is str:
+    data = value.encode('utf-8')
+    if len(data) < 256:
+      parts.append(short_str_value.pack(SHORT_STR, len(data)))
+    else:
+      parts.append(long_value.pack(STR, len(data)))
+    parts.append(data)
+  elif value_type is bool:
+    parts.append(b'\x02' if value else b'\x01')
+  elif value_type is int:
+    try:
+      parts.append(int_value.pack(INT, value))
+    except struct.error:
+      raise exceptions.InvalidMessageFormattingError(value)
+  elif value is None:
+    parts.append(b'\0')
+  elif value_type is list or value_type is tuple:
+    parts.append(long_value.pack(LIST, len(value)))
+    for item in value:
+      append_value(parts, item)
+  elif value_type is dict:
+    append_message(parts, value, MESSAGE)
+  else:
+    raise exceptions.InvalidMessageFormattingError(value)
+
+def decode(payload):
+  # returns message dict of a payload (bytes or memoryview) starting with the marker
+  # raises ValueError if payload is malformed (UnicodeDecodeError for invalid utf-8, like json.loads)
+  data = bytes(payload)
+  try:
+    msg, offset = read_message(data, 0, 0)
+  except (struct.error, KeyError, IndexError, RecursionError) as err:
+    raise ValueError('Malformed binary payload') from err
+
+  if offset != len(data):
+    raise ValueError('Malformed binary payload')
+  return msg
+
+def read_message(data, offset, depth):
+  # offset is that of the marker or message tag, depth is the nesting level of the message
+  # short strings, ints and None are read inline, a function call per field is most of the decoding time of history pages
+  first_byte, type_id, field_count = unpack_header(data, offset)
+  offset += 3
+  msg = {'type': types_by_id[type_id]}
+
+  for i in range(field_count):
+    field_id = data[offset]
+    if field_id:
+      field = fields_by_id[field_id]
+      offset += 1
+    else:
+      field, offset = read_value(data, offset + 1, depth)
+
+    tag = data[offset]
+    if tag == SHORT_STR:
+      end = offset + 2 + data[offset + 1]
+      msg[field] = data[offset + 2:end].decode('utf-8')
+      offset = end
+    elif tag == INT:
+      msg[field] = unpack_int(data, offset + 1)[0]
+      offset += 9
+    elif tag == NONE:
+      msg[field] = None
+      offset += 1
+    else:
+      msg[field], offset = read_value(data, offset, depth)
+
+  return msg, offset
+
+def read_value(data, offset, depth):
+  # depth is the nesting level of the list or message containing the value
+  tag = data[offset]
+  offset += 1
+
+  if tag == SHORT_STR:
+    end = offset + 1 + data[offset]
+    return data[offset + 1:end].decode('utf-8'), end
+  if tag == INT:
+    return int_data.unpack_from(data, offset)[0], offset + 8
+  if tag == TRUE:
+    return True, offset
+  if tag == FALSE:
+    return False, offset
+  if tag == STR:
+    end = offset + 4 + uint_data.unpack_from(data, offset)[0]
+    return data[offset + 4:end].decode('utf-8'), end
+  if tag == LIST:
+    if depth >= max_depth:
+      raise ValueError('Binary payload nested too deeply')
+    item_count = uint_data.unpack_from(data, offset)[0]
+    offset += 4
+    items = []
+    for i in range(item_count):
+      item, offset = read_value(data, offset, depth + 1)
+      items.append(item)
+    return items, offset
+  if tag == MESSAGE:
+    if depth >= max_depth:
+      raise ValueError('Binary payload nested too deeply')
+    return read_message(data, offset - 1, depth + 1)
+  if tag == NONE:
+    return None, offset
+
+  raise ValueError(f'Unknown value tag {tag}')
@@ -0,0 +1,70 @@
+# optional per-connection compression of large payloads, negotiated in the verification handshake like codecs
+# every connection has its own deflate stream in each direction, kept for the whole connection, so field names and
+# text repeated across messages compress better than if every payload was compressed on its own
+# only payloads of at least "threshold" bytes are compressed, compressed payloads start with a marker byte
+# (never the first byte of a json or binary payload) followed by the payload's deflate data, ended with a sync flush
+import json, os, zlib
+from chatapp import path_util
+from chatapp.shared import exceptions
+
+shared_config_file_path = os.path.join(path_util.get_dir_path('shared'), 'shared_config.json')
+with open(shared_config_file_path, 'r') as config_json:
+  shared_config = json.load(config_json)
+
+config_compression = shared_config['compression']
+
+marker = config_compression['marker']
+marker_byte = bytes([marker])
+supported_compressions = config_compression['supported'] # in order of preference, empty list disables compression
+max_frame_size = shared_config['framing']['max_frame_size']
+
+def choose_compression(offered_compressions):
+  # used by server to pick the first compression offered by a client that is supported, None if there is none
+  if isinstance(offered_compressions, list):
+    for compression in offered_compressions:
+      if compression in supported_compressions:
+        return compression
+  return None
+
+def create_compressor():
+  return Frame_Compressor(config_compression['level'], config_compression['window_bits'],
+                          config_compression['mem_level'], config_compression['threshold'])
+
+
+class Frame_Compressor:
+  # compresses payloads sent over one connection
+  # level trades cpu for bytes (1 fastest - 9 smallest), window_bits (9-15) and mem_level (1-9) trade memory per connection for bytes
+  # the deflate stream is only created once the first payload over threshold is sent, so connections that never
+  # send large payloads don't use its memory
+  def __init__(self, level, window_bits, mem_level, threshold):
+    self.level = level
+    self.window_bits = window_bits
+    self.mem_level = mem_level
+    self.threshold = threshold
+    self.stream = None
+
+  def compress(self, payload):
+    # returns compressed payload, payloads have to be decompressed in the order they were compressed
+    if self.stream is None:
+      self.stream = zlib.compressobj(self.level, zlib.DEFLATED, -self.window_bits, self.mem_level)
+    return b''.join((marker_byte, self.stream.compress(payload), self.stream.flush(zlib.Z_SYNC_FLUSH)))
+
+
+class Frame_Decompressor:
+  # decompresses payloads received over one connection, raises FrameTooLargeError if a payload decompresses to more than max_frame_size
+  def __init__(self):
+    self.stream = None
+
+  def decompress(self, payload):
+    if self.stream is None:
+      # largest window, so payloads compressed with any window_bits can be decompressed
+      self.stream = zlib.decompressobj(-15)
+
+    try:
+      data = self.stream.decompress(payload[1:], max_frame_size + 1)
+    except zlib.error as err:
+      raise ValueError('Malformed compressed payload') from err
+
+    if len(data) > max_frame_size or self.stream.unconsumed_tail:
+      raise exceptions.FrameTooLargeError(len(data))
+    return data
@@ -70,6 +70,32 @@ class ClientLookupError(DataBaseError):
     super().__init__(self.message)
 
 
+class RoomLookupError(DataBaseError):
+  """Exception raised when a room that is referenced does not exist in database
+  
+  Attributes:
+    message -- explanation of error
+    room_id -- id of room that was attempted to be looked up"""
+    
+  def __init__(self, room_id):
+    self.message = 'No room was found for a given room id that was looked up in database'
+    self.room_id = room_id
+    
+    super().__init__(self.message)
+
+
+class DataBaseBusyError(DataBaseError):
+  """Exception raised when a query can't be submitted to the database pool because too many queries are already waiting
+  
+  Attributes:
+    message -- explanation of error"""
+    
+  def __init__(self):
+    self.message = 'Too many database queries are waiting to be run'
+    
+    super().__init__(self.message)
+
+
 ### MESSAGE EXCEPTIONS ###
 
 class MessageError(Exception):
@@ -97,6 +123,20 @@ class InvalidMessageFormattingError(MessageError):
     self.invalid_message = invalid_message
     
     super().__init__(self.message)
+    
+    
+class FrameTooLargeError(MessageError):
+  """Exception raised when a frame is received or about to be sent whose payload is larger than the configured max_frame_size
+  
+  Attributes:
+    message -- explanation of error
+    frame_size -- size in bytes of the payload that exceeded the limit"""
+    
+  def __init__(self, frame_size):
+    self.message = 'Frame payload exceeds the maximum allowed frame size'
+    self.frame_size = frame_size
+    
+    super().__init__(self.message)
 
 
 
@@ -138,4 +178,16 @@ class ClientSignupError(AuthenticationError):
     self.message = 'Client could not be signed-up using supplied credentials'
     self.client_sock = client_sock
     
+    super().__init__(self.message)
+    
+    
+class LoginBusyError(AuthenticationError):
+  """Exception raised when a login or signup can't be accepted because too many passwords are already being hashed
+  
+  Attributes:
+    message -- explanation of error"""
+    
+  def __init__(self):
+    self.message = 'Too many logins are being processed, try again later'
+    
     super().__init__(self.message)
\ No newline at end of file
@@ -0,0 +1,136 @@
+# leveled logging for the server and the client that never blocks the thread logging (ex. the event loop)
+# records are put on a bounded queue and written to stdout by a listener thread, so a slow terminal can't stall the loop,
+# records that don't fit in the queue are dropped and counted instead of waiting
+# loggers are named chatapp.<component> and chatapp.<component>.<category> (ex. chatapp.server.messages), every category in
+# the "logging" section of shared_config.json has its own level, sample rate and rate limit
+# nothing is logged until start() is called (servers and clients created with verbose_output=True do)
+import atexit, json, logging, logging.handlers, os, queue, random, sys, threading, time
+from chatapp import path_util
+
+shared_config_file_path = os.path.join(path_util.get_dir_path('shared'), 'shared_config.json')
+with open(shared_config_file_path, 'r') as config_json:
+  shared_config = json.load(config_json)
+
+config_logging = shared_config['logging']
+
+root_logger = logging.getLogger('chatapp')
+root_logger.addHandler(logging.NullHandler()) # until started, records never reach logging's last resort handler (stderr)
+root_logger.setLevel(logging.CRITICAL + 1) # until started, log calls return right away
+
+start_lock = threading.Lock()
+started_pid = None # process that started the listener, a forked worker inherits the handler but not the listener thread
+queue_handler = None
+listener = None
+stream_handler = None
+
+def get_logger(component, category=None):
+  # component -- 'server', 'client', 'cluster' ..., shown in every line
+  # category -- optional, configured in "categories" as '<component>.<category>'
+  name = f'chatapp.{component}' if category is None else f'chatapp.{component}.{category}'
+  return logging.getLogger(name)
+
+
+class Category_Filter(logging.Filter):
+  # keeps a sample_rate fraction (0-1) of the records below WARNING, then at most max_per_second records (null for no limit)
+  # warnings and errors are never sampled out but still count against the rate limit, so an error storm can't flood the queue
+  # counters are only approximate when several threads log to the same category
+  def __init__(self, sample_rate, max_per_second):
+    super().__init__()
+    self.sample_rate = sample_rate
+    self.max_per_second = max_per_second
+    self.tokens = max_per_second
+    self.last_refill = time.monotonic()
+    self.dropped = 0
+
+  def filter(self, record):
+    if self.sample_rate < 1 and record.levelno < logging.WARNING and random.random() >= self.sample_rate:
+      self.dropped += 1
+      return False
+
+    if self.max_per_second is not None:
+      now = time.monotonic()
+      self.tokens = min(self.max_per_second, self.tokens + (now - self.last_refill) * self.max_per_second)
+      self.last_refill = now
+
+      if self.tokens < 1:
+        self.dropped += 1
+        return False
+      self.tokens -= 1
+
+    return True
+
+# '<component>.<category>' -> Category_Filter, attached to the category's logger by start()
+category_filters = {name: Category_Filter(category['sample_rate'], category['max_per_second'])
+                    for name, category in config_logging['categories'].items()}
+
+
+class Dropping_Queue_Handler(logging.handlers.QueueHandler):
+  # never waits for the listener, records are dropped if the queue is full
+  def __init__(self, record_queue):
+    super().__init__(record_queue)
+    self.dropped = 0
+
+  def enqueue(self, record):
+    try:
+      self.queue.put_nowait(record)
+    except queue.Full:
+      self.dropped += 1
+
+
+class Component_Formatter(logging.Formatter):
+  # adds %(component)s, the upper cased component of the logger name (ex. SERVER for chatapp.server.messages)
+  # runs on the listener thread
+  def format(self, record):
+    parts = record.name.split('.')
+    record.component = parts[1].upper() if len(parts) > 1 else 'CHATAPP'
+    return super().format(record)
+
+
+def start():
+  # starts writing records to stdout, does nothing if this process already started
+  global started_pid, queue_handler, listener, stream_handler
+  with start_lock:
+    if started_pid == os.getpid():
+      return
+
+    if queue_handler is not None:
+      root_logger.removeHandler(queue_handler)
+
+    queue_handler = Dropping_Queue_Handler(queue.Queue(config_logging['queue_size']))
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(Component_Formatter(config_logging['format'], config_logging['date_format']))
+    listener = logging.handlers.QueueListener(queue_handler.queue, stream_handler)
+    listener.start()
+
+    root_logger.addHandler(queue_handler)
+    root_logger.propagate = False
+    root_logger.setLevel(config_logging['level'])
+
+    for name, category in config_logging['categories'].items():
+      category_logger = logging.getLogger(f'chatapp.{name}')
+      category_logger.setLevel(category['level'])
+      category_logger.addFilter(category_filters[name])
+
+    if started_pid is None:
+      atexit.register(stop)
+    started_pid = os.getpid()
+
+def stop():
+  # writes the records still queued, called at exit
+  global started_pid
+  with start_lock:
+    if started_pid != os.getpid():
+      return
+
+    listener.stop()
+    if queue_handler.dropped:
+      stream_handler.stream.write(f'{queue_handler.dropped} log records were dropped because the log queue was full\n')
+      stream_handler.flush()
+    started_pid = None
+
+def dropped_records():
+  # log records dropped by sampling, rate limits or a full queue since the process started
+  dropped = sum(category_filter.dropped for category_filter in category_filters.values())
+  if queue_handler is not None:
+    dropped += queue_handler.dropped
+  return dropped
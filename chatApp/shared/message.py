@@ -1,7 +1,7 @@
 # used to unify format of messages sent between server and client so that a single file can be changed to change formatting
-import json, os
+import json, os, struct
 from chatapp import path_util
-from chatapp.shared import exceptions
+from chatapp.shared import exceptions, binary_codec, compression
 
 # loading config using dynamically generated absolute path
 shared_config_file_path = os.path.join(path_util.get_dir_path('shared'), 'shared_config.json')
@@ -9,11 +9,28 @@ with open(shared_config_file_path, 'r') as config_json:
   shared_config = json.load(config_json)
   
 config_msg_types = shared_config['messages']['message_types']
+config_framing = shared_config['framing']
 
-# list of all possible message types
-message_types = [config_msg_types['CLIENT_TEXT'], config_msg_types['SERVER_TEXT'],
-                 config_msg_types['VERIFICATION_REQUEST'], config_msg_types['VERIFICATION_RESPONSE'],
-                 config_msg_types['SIGNUP_REQUEST'], config_msg_types['SIGNUP_RESPONSE']]
+# every message is sent as a frame: fixed size header containing the payload length, followed by the payload (utf-8 json)
+frame_header = struct.Struct(config_framing['header_format'])
+max_frame_size = config_framing['max_frame_size']
+recv_size = config_framing['recv_size'] # amount of bytes read from a socket per recv call
+
+# longest CLIENT_TEXT body (in characters) the server accepts, the SERVER_TEXT it is re-encoded into has to fit a frame with every codec
+# json escapes a character as up to 12 bytes (non-BMP characters become two \uXXXX escapes), text_frame_overhead leaves room for
+# the other fields (username, message_id, room_id)
+max_text_length = config_framing['max_text_length']
+max_encoded_char_size = 12
+text_frame_overhead = 65536
+if max_text_length * max_encoded_char_size + text_frame_overhead > max_frame_size:
+  raise ValueError(f'max_text_length {max_text_length} is too large for max_frame_size {max_frame_size}')
+
+# payloads are json unless both sides negotiated another codec in the verification handshake, see choose_codec
+# receivers tell codecs apart by the first byte of the payload, so frames of any codec can always be decoded
+supported_codecs = shared_config['codecs']['supported'] # in order of preference
+
+# list of all possible message types, in the order of shared_config.json
+message_types = list(config_msg_types.values())
 
 # required variables in a message for a given message type
 types_required_fields = {
@@ -22,22 +39,78 @@ types_required_fields = {
   config_msg_types['VERIFICATION_REQUEST']: ['username', 'password'],
   config_msg_types['VERIFICATION_RESPONSE']: ['success', 'error_msg', 'status_code'],
   config_msg_types['SIGNUP_REQUEST']: ['username', 'password'],
-  config_msg_types['SIGNUP_RESPONSE']: ['success', 'error_msg', 'status_code']
+  config_msg_types['SIGNUP_RESPONSE']: ['success', 'error_msg', 'status_code'],
+  config_msg_types['JOIN_ROOM_REQUEST']: ['room_id'],
+  config_msg_types['LEAVE_ROOM_REQUEST']: ['room_id'],
+  config_msg_types['ROOM_RESPONSE']: ['success', 'room_id', 'error_msg', 'status_code'],
+  config_msg_types['HISTORY_REQUEST']: ['room_id'],
+  config_msg_types['HISTORY_RESPONSE']: ['success', 'room_id', 'messages', 'error_msg', 'status_code'],
+  config_msg_types['STATS_REQUEST']: [],
+  config_msg_types['STATS_RESPONSE']: ['success', 'error_msg', 'status_code'],
+  config_msg_types['TEXT_RESPONSE']: ['success', 'error_msg', 'status_code'], # only sent when a CLIENT_TEXT was rejected
+  config_msg_types['PING']: [], # heartbeat, sent by either side, answered with PONG
+  config_msg_types['PONG']: [],
+  config_msg_types['USER_UPDATE']: ['username'] # only sent between the workers of a cluster
+}
+
+# variables a message of a given type can include but doesn't have to
+types_optional_fields = {
+  config_msg_types['CLIENT_TEXT']: ['room_id'],
+  config_msg_types['SERVER_TEXT']: ['room_id', 'message_id'],
+  config_msg_types['VERIFICATION_REQUEST']: ['after_id', 'room_cursors', 'codecs', 'compression'],
+  config_msg_types['VERIFICATION_RESPONSE']: ['codec', 'compression'],
+  config_msg_types['HISTORY_REQUEST']: ['before_id', 'limit'],
+  config_msg_types['HISTORY_RESPONSE']: ['before_id'],
+  config_msg_types['STATS_RESPONSE']: ['msg_body'],
+  config_msg_types['TEXT_RESPONSE']: ['room_id'],
+  config_msg_types['USER_UPDATE']: ['user_id', 'room_id', 'joined']
+}
+
+# types a received field's value can have, the same in every message type the field is used in
+# values are checked by exact type, so True/False aren't accepted as ints
+field_types = {
+  'msg_body': (str,), 'username': (str,), 'password': (str,),
+  'success': (bool,), 'status_code': (str,), 'error_msg': (str,),
+  'room_id': (int,), 'message_id': (int,), 'user_id': (int,), 'joined': (bool,),
+  'messages': (list,), 'before_id': (int,), 'limit': (int,), 'after_id': (int,), 'room_cursors': (list,),
+  'codecs': (list,), 'codec': (str,),
+  'compression': (list, str) # offered compressions in verification requests, the chosen one in verification responses
 }
 
 
-def create_message(type, msg_body=None, username=None, password=None, success=None, status_code=None, error_msg=None):
+def create_message(type, msg_body=None, username=None, password=None, success=None, status_code=None, error_msg=None, room_id=None, message_id=None,
+                   messages=None, before_id=None, limit=None, after_id=None, codecs=None, codec=None,
+                   compression=None, user_id=None, joined=None, room_cursors=None):
   # type used for all messages, allows receiver to properly process message
-  # msg_body used by client for sending texts
+  # msg_body used by client for sending texts, and by stats responses for the server's metrics (prometheus text format)
   # username used by client for verification requests
   # password used by client for verification requests
   # verified used by server for verification responses
   # status_code used by server for sending status code to clients
   # error_msg used by server to describe error (describes status code if an error occured)
+  # room_id used by text messages to address a room (optional, text without room_id goes to all clients) and by room requests/responses
+  # message_id used by server to number text messages, ids increase over time
+  # messages used by history responses, list of SERVER_TEXT messages oldest first
+  # before_id used by history requests to only get messages older than that message_id (optional, newest messages if not given),
+  #   in history responses it is the before_id to request the next (older) page with, missing if there are no older messages
+  # limit used by history requests, max number of messages to return (optional, capped by server)
+  # after_id used by verification requests, message_id of the last message received before reconnecting (optional),
+  #   the server then only backfills messages newer than that
+  # room_cursors used by verification requests, list of [room_id, message_id] pairs with the last message received from each room
+  #   (optional), after_id is only used for rooms that aren't listed
+  # codecs used by verification requests, codecs the client can send and receive in order of preference (optional, json otherwise)
+  # codec used by verification responses, codec chosen by server, both sides use it for everything sent after the response
+  # compression used by verification requests, list of compressions the client supports (optional, no compression otherwise),
+  #   and by verification responses, compression chosen by server (missing if none), see shared/compression.py
+  # user_id, joined used by user updates a worker sends the other workers of a cluster when a user joined (True) or left (False) room_id,
+  #   a user update with only username is sent when the user signed up
   
   # first adds all params, then removes params that where None (not supplied)
   msg = {'type': type, 'msg_body': msg_body, 'username': username, 'password': password, 
-         'success': success, 'status_code': status_code, 'error_msg': error_msg}
+         'success': success, 'status_code': status_code, 'error_msg': error_msg, 'room_id': room_id,
+         'message_id': message_id, 'messages': messages, 'before_id': before_id, 'limit': limit,
+         'after_id': after_id, 'codecs': codecs, 'codec': codec, 'compression': compression, 'user_id': user_id, 'joined': joined,
+         'room_cursors': room_cursors}
   
   msg = remove_null_keys(msg)
   
@@ -46,31 +119,190 @@ def create_message(type, msg_body=None, username=None, password=None, success=No
   raise exceptions.InvalidMessageFormattingError(msg)
   
 def remove_null_keys(msg):
-  new_msg = {}
-  for key in msg:
-    if msg[key] != None:
-      new_msg[key] = msg[key]
-  return new_msg
+  return {key: value for key, value in msg.items() if value is not None}
 
 def valid_message(msg):
-  # checks if all required fields for the given message type are present
+  # checks if all required fields for the given message type are present (and not None)
   try:
-    for message_type in message_types:
-      if msg['type'] == message_type:
-        for field in types_required_fields[message_type]:
-          if msg[field] != None:
-            pass # checks if key exists in msg, if it doesn't, it will raise a KeyError exception
-          else:
-            # return false if for whatever reason the key exists, but is None
-            return False 
-        return True
-    
-  except KeyError:
+    fields = required_fields[msg['type']]
+  except (KeyError, TypeError):
+    # no type, unknown type or msg isn't a dict
     return False
   
+  for field in fields:
+    if msg.get(field) is None:
+      return False
+  return True
+  
 def is_type(msg, type):
-  # checks if msg is correctly formatted, then checks if message is of given type
-  if valid_message(msg):
-    if msg['type'] == type:
-      return True
-  return False
\ No newline at end of file
+  # checks if msg is of given type, then checks if message is correctly formatted
+  try:
+    return msg['type'] == type and valid_message(msg)
+  except (KeyError, TypeError):
+    return False
+
+def parse_message(data):
+  # validates a received message (python dict) once and returns it as an instance of its type's message class,
+  # returns None if it isn't a valid message: a required field is missing, or a field has a type not listed in field_types
+  try:
+    message_class = message_classes[data['type']]
+  except (KeyError, TypeError):
+    return None
+  
+  msg = message_class()
+  for field, types in message_class.required_field_types:
+    value = data.get(field)
+    if type(value) not in types: # also None, a missing field
+      return None
+    setattr(msg, field, value)
+  for field, types in message_class.optional_field_types:
+    value = data.get(field)
+    if value is not None and type(value) not in types:
+      return None
+    setattr(msg, field, value)
+  return msg
+
+
+class Message:
+  # base of the message classes, one class per message type is created at import time (see message_classes)
+  # instances are created by parse_message, every field of the type is an attribute, optional fields that weren't sent are None
+  __slots__ = ()
+  type = None
+  required_fields = ()
+  optional_fields = ()
+  required_field_types = () # (field, types) pairs, see field_types
+  optional_field_types = ()
+  
+  def to_dict(self):
+    msg = {'type': self.type}
+    for field in self.required_fields + self.optional_fields:
+      value = getattr(self, field)
+      if value is not None:
+        msg[field] = value
+    return msg
+
+def create_message_class(type_key):
+  # ex. CLIENT_TEXT -> class Client_Text(Message) with __slots__ ('msg_body', 'room_id')
+  message_type = config_msg_types[type_key]
+  required = tuple(types_required_fields[message_type])
+  optional = tuple(types_optional_fields.get(message_type, ()))
+  return type(type_key.title(), (Message,), {'__slots__': required + optional, 'type': message_type,
+                                             'required_fields': required, 'optional_fields': optional,
+                                             'required_field_types': tuple((field, field_types[field]) for field in required),
+                                             'optional_field_types': tuple((field, field_types[field]) for field in optional)})
+
+# built once at import time, so validating a message is a dict lookup and a loop over its type's required fields
+required_fields = {message_type: tuple(fields) for message_type, fields in types_required_fields.items()}
+message_classes = {config_msg_types[type_key]: create_message_class(type_key) for type_key in config_msg_types}
+
+def encode_message(msg, format='utf-8', codec='json'):
+  # converts python dict to a frame (header + payload) ready to be sent over a socket
+  if codec == 'binary':
+    payload = binary_codec.encode(msg)
+  else:
+    payload = json.dumps(msg).encode(format)
+  return frame_payload(payload)
+
+def compress_frame(frame, compressor):
+  # returns frame with its payload compressed by the connection's Frame_Compressor if it is large enough,
+  # otherwise (or if the connection doesn't use compression, compressor None) the frame itself
+  if compressor is None or len(frame) - frame_header.size < compressor.threshold:
+    return frame
+  with memoryview(frame) as view:
+    return frame_payload(compressor.compress(view[frame_header.size:]))
+
+def decode_payload(payload, format='utf-8'):
+  # converts payload (bytes or memoryview) of any codec back to a python dict
+  # raises ValueError (json.JSONDecodeError, UnicodeDecodeError) if payload can't be decoded
+  if payload and payload[0] == binary_codec.marker:
+    return binary_codec.decode(payload)
+  try:
+    return json.loads(str(payload, format))
+  except RecursionError as err:
+    # deeply nested arrays or objects (ex. '[' * 5000) exceed the interpreter's recursion limit
+    raise ValueError('Payload nested too deeply') from err
+
+def choose_codec(offered_codecs):
+  # used by server to pick the first codec offered by a client that is supported, json if there is none
+  if isinstance(offered_codecs, list):
+    for codec in offered_codecs:
+      if codec in supported_codecs:
+        return codec
+  return 'json'
+
+
+def frame_payload(payload):
+  # prepends length header to an already encoded payload
+  if len(payload) > max_frame_size:
+    raise exceptions.FrameTooLargeError(len(payload))
+  return frame_header.pack(len(payload)) + payload
+
+
+class Frame_Buffer:
+  # per-connection reassembly buffer
+  # bytes received from a socket are fed into the buffer, which returns every complete message it contains,
+  # incomplete frames stay in the buffer until the rest of their bytes arrive
+  def __init__(self, format='utf-8'):
+    self.format = format
+    self.decompressor = None # compression.Frame_Decompressor once compression is negotiated
+    self.buffer = bytearray()
+    self.pending_frame_end = 0 # end offset of a frame known to be incomplete, avoids re-parsing its header on every recv
+    
+  def feed(self, data):
+    # adds data to the buffer and returns a list of all messages (python dicts) that are now complete
+    # raises FrameTooLargeError if a header announces a payload over max_frame_size, ValueError if a payload can't be decoded
+    self.buffer += data
+    buffer_len = len(self.buffer)
+    
+    if buffer_len < self.pending_frame_end:
+      return []
+    
+    messages = []
+    offset = 0
+    self.pending_frame_end = 0
+    
+    # memoryview allows decoding payloads directly out of the buffer without copying them first
+    with memoryview(self.buffer) as view:
+      while buffer_len - offset >= frame_header.size:
+        payload_len, = frame_header.unpack_from(view, offset)
+        if payload_len > max_frame_size:
+          raise exceptions.FrameTooLargeError(payload_len)
+        
+        payload_start = offset + frame_header.size
+        frame_end = payload_start + payload_len
+        if frame_end > buffer_len:
+          self.pending_frame_end = frame_end - offset
+          break
+        
+        messages.append(self.decode_frame_payload(view[payload_start:frame_end]))
+        offset = frame_end
+    
+    # only the unfinished tail is kept, shifting it once per feed instead of once per message
+    if offset:
+      del self.buffer[:offset]
+    
+    return messages
+  
+  def decode_frame_payload(self, payload):
+    # payload is a memoryview into the buffer, it must not be kept after returning since the buffer is resized afterwards
+    if payload and payload[0] == compression.marker:
+      if self.decompressor is None:
+        raise ValueError('Compressed payload on a connection without compression')
+      payload = self.decompressor.decompress(payload)
+    return decode_payload(payload, self.format)
+
+
+class Frame_Cache:
+  # encodes a message at most once per codec, used when the same message is sent to many connections
+  def __init__(self, msg, format='utf-8'):
+    self.msg = msg
+    self.format = format
+    self.frames = {}
+    self.size = 0 # bytes of all frames encoded so far
+    
+  def get(self, codec):
+    frame = self.frames.get(codec)
+    if frame is None:
+      frame = self.frames[codec] = encode_message(self.msg, self.format, codec)
+      self.size += len(frame)
+    return frame
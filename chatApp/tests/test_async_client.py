@@ -0,0 +1,102 @@
+import asyncio, unittest
+from unittest import mock
+
+from chatapp.shared import message
+from chatapp.client import async_client
+
+# reconnects of Async_TCP_Client, against a fake server that answers every VERIFICATION_REQUEST with the next of its responses
+# run with: python -m unittest chatapp.tests.test_async_client
+
+def verification_response(status_code):
+  success = status_code == ''
+  return message.encode_message(message.create_message(message.config_msg_types['VERIFICATION_RESPONSE'], success=success,
+                                                       error_msg='' if success else 'refused', status_code=status_code))
+
+
+class Fake_Server:
+  # closes a connection right after its response unless keep_open is True
+  def __init__(self, status_codes, keep_open=False):
+    self.status_codes = status_codes
+    self.keep_open = keep_open
+    self.connections = 0
+    self.writers = []
+
+  async def start(self):
+    self.server = await asyncio.start_server(self.handle_connection, 'localhost', 0)
+    return self.server.sockets[0].getsockname()[1]
+
+  async def handle_connection(self, reader, writer):
+    status_code = self.status_codes[min(self.connections, len(self.status_codes) - 1)]
+    self.connections += 1
+    writer.write(verification_response(status_code))
+    await writer.drain()
+    if self.keep_open:
+      self.writers.append(writer)
+    else:
+      writer.close()
+
+  def drop_connections(self):
+    for writer in self.writers:
+      writer.close()
+    self.writers = []
+
+  def close(self):
+    self.drop_connections()
+    self.server.close()
+
+
+class Async_Client_Reconnect_Test(unittest.IsolatedAsyncioTestCase):
+  async def asyncSetUp(self):
+    patcher = mock.patch.dict(async_client.client_config_reconnect, {'initial_delay': 0.01, 'multiplier': 1, 'max_delay': 0.01, 'max_attempts': 3})
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  async def connect(self, server):
+    port = await server.start()
+    self.addCleanup(server.close)
+    client = async_client.Async_TCP_Client('localhost', port, 'user', 'password', verbose_output=False)
+    self.addAsyncCleanup(client.close)
+    return client, await client.connect()
+
+  async def test_busy_server_is_retried_by_connect_only(self):
+    server = Fake_Server(['503'])
+    client, result = await self.connect(server)
+    self.assertEqual(result, (False, 'Server is busy'))
+
+    await asyncio.sleep(0.2)
+    self.assertEqual(server.connections, 3) # one per attempt, closed connections didn't start reconnects of their own
+    self.assertIsNone(client.reconnect_task)
+
+  async def test_rejected_login_is_not_retried(self):
+    server = Fake_Server(['401'])
+    client, result = await self.connect(server)
+    self.assertFalse(result[0])
+
+    await asyncio.sleep(0.2)
+    self.assertEqual(server.connections, 1)
+
+  async def test_messages_sent_behind_refused_verification_are_kept(self):
+    server = Fake_Server(['503', ''], keep_open=True)
+    client = async_client.Async_TCP_Client('localhost', await server.start(), 'user', 'password', verbose_output=False)
+    self.addCleanup(server.close)
+    self.addAsyncCleanup(client.close)
+    client.send_message('queued')
+
+    with mock.patch.object(client, 'encode_message', wraps=client.encode_message) as encode_message:
+      self.assertEqual(await client.connect(), (True, ''))
+    sent = [call.args[0].get('msg_body') for call in encode_message.call_args_list]
+    self.assertEqual(sent.count('queued'), 2) # written behind both verification requests
+
+  async def test_lost_connection_is_reopened_once(self):
+    server = Fake_Server([''], keep_open=True)
+    client, result = await self.connect(server)
+    self.assertEqual(result, (True, ''))
+
+    server.drop_connections()
+    await asyncio.sleep(0.2)
+    self.assertTrue(client.connected.is_set())
+    self.assertEqual(server.connections, 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,159 @@
+import threading, time, unittest
+from unittest import mock
+
+from chatapp.shared import message
+from chatapp.server import server as tcp_server
+from chatapp.server import storage
+from chatapp.client import client as tcp_client
+from chatapp.tests.test_text_limits import find_free_port, wait_for_server
+
+# backfill of reconnecting clients from the server's recent messages, every test runs against a server on the memory storage backend
+# run with: python -m unittest chatapp.tests.test_backfill
+
+class Backfill_Test:
+  # runs on both engines, see the subclasses below
+  engine = None
+
+  @classmethod
+  def setUpClass(cls):
+    cls.port = find_free_port()
+    db_connector_factory = storage.create_connector_factory({'backend': 'memory'}, None)
+    cls.db_connector = db_connector_factory()
+    for room_name in ('first', 'second'):
+      cls.db_connector.insert_room(room_name)
+    cls.server = tcp_server.create_server(cls.engine, 'localhost', cls.port, verbose_output=False, db_connector_factory=db_connector_factory)
+    cls.server_thread = threading.Thread(target=cls.server.listen_for_connections, daemon=True)
+    cls.server_thread.start()
+    wait_for_server(cls.port)
+    cls.user_count = 0
+
+  def create_user(self):
+    # signs up a user that is apart of both rooms, returns its name
+    type(self).user_count += 1
+    username = f'{self.engine}_user{self.user_count}'
+    client = tcp_client.TCP_Nonblocking_Client('localhost', self.port, username, 'password', verbose_output=False)
+    client.create_socket()
+    self.assertEqual(client.connect_to_server(True), (True, ''))
+    for room_id in (1, 2):
+      client.join_room(room_id)
+      self.assertTrue(self.receive_type(client, 'ROOM_RESPONSE')['success'])
+    client.shutdown_socket()
+    return username
+
+  def receive_type(self, client, type):
+    # next received message of the given type, anything else (ex. backfill of earlier tests) is skipped
+    while True:
+      msg = client.receive_next_message()
+      if msg['type'] == message.config_msg_types[type]:
+        return msg
+
+  def send_texts(self, username, texts):
+    # sends (room_id, text) pairs, returns the message_id of every text once they have all been broadcast
+    client = tcp_client.TCP_Nonblocking_Client('localhost', self.port, username, 'password', verbose_output=False)
+    client.create_socket()
+    self.assertEqual(client.connect_to_server(False), (True, ''))
+    for room_id, text in texts:
+      client.send_message(text, room_id)
+    message_ids = {}
+    while len(message_ids) < len(texts):
+      msg = self.receive_type(client, 'SERVER_TEXT')
+      if msg['msg_body'] in [text for room_id, text in texts] and msg['username'] == username:
+        message_ids[msg['msg_body']] = msg['message_id']
+    client.shutdown_socket()
+    return message_ids
+
+  def verify(self, username, **fields):
+    # logs in with a VERIFICATION_REQUEST including fields, backfill is queued along with the response
+    client = tcp_client.TCP_Nonblocking_Client('localhost', self.port, username, 'password', verbose_output=False)
+    client.create_socket()
+    client.sock.connect(('localhost', self.port))
+    self.addCleanup(client.shutdown_socket)
+    client.send(message.create_message(message.config_msg_types['VERIFICATION_REQUEST'], username=username, password='password', **fields))
+    self.assertTrue(self.receive_type(client, 'VERIFICATION_RESPONSE')['success'])
+    return client
+
+  def receive_backfill(self, client, room_id=None):
+    # returns the texts received before a text the client sends now (to room_id, live messages of a room arrive after its backfill)
+    client.send(message.create_message(message.config_msg_types['CLIENT_TEXT'], msg_body='end', room_id=room_id))
+    texts = []
+    while True:
+      msg = self.receive_type(client, 'SERVER_TEXT')
+      if msg['msg_body'] == 'end' and msg['username'] == client.username:
+        return texts
+      texts.append(msg['msg_body'])
+
+  def test_backfill_starts_at_cursor_of_every_room(self):
+    username = self.create_user()
+    message_ids = self.send_texts(username, [(1, f'{username} first 1'), (2, f'{username} second 1'), (1, f'{username} first 2')])
+
+    # last message received from the second room is newer than the one from the first room
+    client = self.verify(username, room_cursors=[[1, message_ids[f'{username} first 1']], [2, message_ids[f'{username} second 1']]])
+    texts = self.receive_backfill(client)
+    self.assertEqual([text for text in texts if text.startswith(username)], [f'{username} first 2'])
+
+  def test_rooms_without_cursor_use_after_id(self):
+    username = self.create_user()
+    message_ids = self.send_texts(username, [(1, f'{username} first 1'), (2, f'{username} second 1')])
+
+    client = self.verify(username, after_id=message_ids[f'{username} first 1'], room_cursors=[[1, message_ids[f'{username} first 1']]])
+    texts = self.receive_backfill(client)
+    self.assertEqual([text for text in texts if text.startswith(username)], [f'{username} second 1'])
+
+  def test_backfill_is_not_dropped_by_backpressure(self):
+    username = self.create_user()
+    self.send_texts(username, [(1, f'{username} first 1'), (2, f'{username} second 1')])
+
+    with mock.patch.object(self.server, 'max_queued_bytes', 1): # every chat message is over the limit
+      client = self.verify(username)
+    texts = self.receive_backfill(client)
+    self.assertIn(f'{username} first 1', texts)
+    self.assertIn(f'{username} second 1', texts)
+
+  def wait_until_stored(self, room_id, message_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while message_id not in [row[0] for row in self.db_connector.get_room_history(room_id, None, 100)]:
+      self.assertLess(time.monotonic(), deadline)
+      time.sleep(0.05)
+
+  def test_gaps_older_than_buffer_are_read_page_by_page(self):
+    username = self.create_user()
+    texts = [(1, f'{username} gap {i}') for i in range(7)]
+
+    # the buffer keeps only the newest 2 messages of a room, the database is read 2 messages at a time
+    with mock.patch.object(self.server.recent_messages, 'max_messages_per_room', 2), \
+         mock.patch.dict(tcp_server.server_config_history, {'max_page_size': 2}):
+      message_ids = self.send_texts(username, texts)
+      self.wait_until_stored(1, message_ids[texts[-1][1]])
+
+      client = self.verify(username, room_cursors=[[1, message_ids[texts[0][1]]]])
+      received = self.receive_backfill(client, 1)
+    self.assertEqual([text for text in received if text.startswith(username)], [text for room_id, text in texts[1:]])
+    self.assertTrue(all(self.server.room_clients.values())) # rooms aren't left in the index without clients
+
+  def test_malformed_room_cursors_are_ignored(self):
+    username = self.create_user()
+    message_ids = self.send_texts(username, [(1, f'{username} first 1'), (2, f'{username} second 1')])
+
+    client = self.verify(username, after_id=message_ids[f'{username} first 1'], room_cursors=[[[1], 5], [{'2': 1}, 5], [2, [5]], [True, 5]])
+    texts = self.receive_backfill(client)
+    self.assertEqual([text for text in texts if text.startswith(username)], [f'{username} second 1'])
+    self.assertTrue(self.server_thread.is_alive())
+
+
+class Read_Backfill_Cursors_Test(unittest.TestCase):
+  def test_only_pairs_of_room_id_and_message_id_are_read(self):
+    cursors = tcp_server.read_backfill_cursors(7, [[1, 5], [None, 6], [[2], 5], [3, None], [4, True], [True, 5], [5], 'x'])
+    self.assertEqual(dict(cursors), {1: 5, None: 6})
+    self.assertEqual(cursors[2], 7)
+
+
+class Select_Backfill_Test(Backfill_Test, unittest.TestCase):
+  engine = 'select'
+
+
+class Asyncio_Backfill_Test(Backfill_Test, unittest.TestCase):
+  engine = 'asyncio'
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+
+from chatapp.shared import binary_codec, message
+
+# decoding of untrusted binary payloads, see shared/binary_codec.py
+# run with: python -m unittest chatapp.tests.test_binary_codec
+
+def nested_lists_payload(depth):
+  # CLIENT_TEXT whose msg_body is depth nested one item lists around None
+  return bytes([binary_codec.marker, binary_codec.type_ids[message.config_msg_types['CLIENT_TEXT']], 1,
+                binary_codec.field_ids['msg_body']]) + bytes([binary_codec.LIST, 0, 0, 0, 1]) * depth + bytes([binary_codec.NONE])
+
+
+class Binary_Codec_Test(unittest.TestCase):
+  def test_nesting_up_to_max_depth_is_decoded(self):
+    msg = binary_codec.decode(nested_lists_payload(binary_codec.max_depth))
+    value = msg['msg_body']
+    for i in range(binary_codec.max_depth):
+      value, = value
+    self.assertIsNone(value)
+
+  def test_deeper_nesting_is_malformed(self):
+    with self.assertRaises(ValueError):
+      binary_codec.decode(nested_lists_payload(binary_codec.max_depth + 1))
+    with self.assertRaises(ValueError):
+      binary_codec.decode(nested_lists_payload(2000)) # would exceed the interpreter's recursion limit without max_depth
+
+  def test_history_pages_are_within_max_depth(self):
+    server_text = message.create_message(message.config_msg_types['SERVER_TEXT'], msg_body='text', username='user', room_id=1, message_id=1)
+    history_response = message.create_message(message.config_msg_types['HISTORY_RESPONSE'], success=True, room_id=1, error_msg='',
+                                              status_code='', messages=[server_text])
+    self.assertEqual(binary_codec.decode(binary_codec.encode(history_response)), history_response)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,114 @@
+import json, socket, threading, unittest
+from unittest import mock
+
+from chatapp.shared import binary_codec, message
+from chatapp.server import server as tcp_server
+from chatapp.server import storage
+from chatapp.client import client as tcp_client
+from chatapp.tests.test_text_limits import find_free_port, wait_for_server
+
+# regression tests for messages from misbehaving clients that used to stop the select engine's loop thread,
+# every test runs against a server on the memory storage backend
+# run with: python -m unittest chatapp.tests.test_malformed_messages
+
+class Malformed_Messages_Test:
+  # runs on both engines, see the subclasses below
+  engine = None
+
+  @classmethod
+  def setUpClass(cls):
+    cls.port = find_free_port()
+    db_connector_factory = storage.create_connector_factory({'backend': 'memory'}, None)
+    cls.server = tcp_server.create_server(cls.engine, 'localhost', cls.port, verbose_output=False, db_connector_factory=db_connector_factory)
+    cls.server_thread = threading.Thread(target=cls.server.listen_for_connections, daemon=True)
+    cls.server_thread.start()
+    wait_for_server(cls.port)
+    cls.user_count = 0
+
+  def connect_client(self):
+    type(self).user_count += 1
+    client = tcp_client.TCP_Nonblocking_Client('localhost', self.port, f'{self.engine}_user{self.user_count}', 'password', verbose_output=False)
+    client.create_socket()
+    self.assertEqual(client.connect_to_server(True), (True, ''))
+    self.addCleanup(client.shutdown_socket)
+    return client
+
+  def send_payload(self, payload):
+    # sends one frame with a raw payload from a new connection, returns the socket
+    sock = socket.create_connection(('localhost', self.port))
+    self.addCleanup(sock.close)
+    sock.settimeout(10)
+    sock.sendall(message.frame_payload(payload))
+    return sock
+
+  def assert_closed(self, sock):
+    # the server closed the connection (nothing else was sent to it) and keeps serving others
+    self.assertEqual(sock.recv(1024), b'')
+    self.assertTrue(self.server_thread.is_alive())
+    self.connect_client()
+
+  def send_message(self, msg):
+    return self.send_payload(json.dumps(msg).encode())
+
+  def assert_ignored(self, client, msg):
+    # the server ignored a message of a logged in client and keeps serving it
+    client.send(msg)
+    client.send(message.create_message(message.config_msg_types['PING']))
+    while client.receive_next_message()['type'] != message.config_msg_types['PONG']:
+      pass
+    self.assertTrue(self.server_thread.is_alive())
+
+  def test_deeply_nested_json_closes_connection(self):
+    self.assert_closed(self.send_payload(b'[' * 5000))
+
+  def test_deeply_nested_binary_closes_connection(self):
+    payload = bytes([binary_codec.marker, 1, 1, 1]) + bytes([binary_codec.LIST, 0, 0, 0, 1]) * 2000 + bytes([binary_codec.NONE])
+    self.assert_closed(self.send_payload(payload))
+
+  def test_verification_with_list_username_closes_connection(self):
+    self.assert_closed(self.send_message({'type': message.config_msg_types['VERIFICATION_REQUEST'], 'username': ['x'], 'password': 'password'}))
+
+  def test_signup_with_dict_username_closes_connection(self):
+    self.assert_closed(self.send_message({'type': message.config_msg_types['SIGNUP_REQUEST'], 'username': {'x': 1}, 'password': 'password'}))
+
+  def test_unhashable_usernames_do_not_reach_user_cache(self):
+    self.connect_client() # the cache has an entry
+    with mock.patch.object(self.server.user_cache, 'get', wraps=self.server.user_cache.get) as get:
+      self.assert_closed(self.send_message({'type': message.config_msg_types['VERIFICATION_REQUEST'], 'username': ['x'], 'password': 'password'}))
+      self.assert_closed(self.send_message({'type': message.config_msg_types['SIGNUP_REQUEST'], 'username': {'x': 1}, 'password': 'password'}))
+    self.assertTrue(get.called) # by the logins of assert_closed
+    self.assertTrue(all(type(call.args[0]) is str for call in get.call_args_list))
+
+  def test_list_room_ids_are_ignored(self):
+    client = self.connect_client()
+    self.assert_ignored(client, {'type': message.config_msg_types['CLIENT_TEXT'], 'msg_body': 'text', 'room_id': [1]})
+    self.assert_ignored(client, {'type': message.config_msg_types['HISTORY_REQUEST'], 'room_id': [1]})
+
+
+class Parse_Message_Test(unittest.TestCase):
+  def test_fields_of_other_types_are_invalid(self):
+    client_text = message.config_msg_types['CLIENT_TEXT']
+    self.assertIsNone(message.parse_message({'type': client_text, 'msg_body': ['text']}))
+    self.assertIsNone(message.parse_message({'type': client_text, 'msg_body': 'text', 'room_id': '1'}))
+    self.assertIsNone(message.parse_message({'type': client_text, 'msg_body': 'text', 'room_id': True}))
+    self.assertIsNone(message.parse_message({'type': message.config_msg_types['HISTORY_REQUEST'], 'room_id': 1, 'limit': 1.5}))
+    self.assertIsNone(message.parse_message({'type': message.config_msg_types['VERIFICATION_REQUEST'], 'username': 'user',
+                                             'password': 'password', 'room_cursors': {'1': 5}}))
+
+  def test_fields_of_listed_types_are_valid(self):
+    msg = message.parse_message({'type': message.config_msg_types['VERIFICATION_REQUEST'], 'username': 'user', 'password': 'password',
+                                 'after_id': 3, 'room_cursors': [[1, 5]], 'codecs': ['json'], 'compression': ['deflate']})
+    self.assertEqual((msg.username, msg.after_id, msg.room_cursors, msg.codecs), ('user', 3, [[1, 5]], ['json']))
+    self.assertIsNone(message.parse_message({'type': message.config_msg_types['CLIENT_TEXT'], 'msg_body': 'text'}).room_id)
+
+
+class Select_Malformed_Messages_Test(Malformed_Messages_Test, unittest.TestCase):
+  engine = 'select'
+
+
+class Asyncio_Malformed_Messages_Test(Malformed_Messages_Test, unittest.TestCase):
+  engine = 'asyncio'
+
+
+if __name__ == '__main__':
+  unittest.main()
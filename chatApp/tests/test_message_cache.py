@@ -0,0 +1,58 @@
+import os, sqlite3, tempfile, unittest
+
+from chatapp.shared import message
+from chatapp.client import message_cache
+
+# local message cache of the clients, see client/message_cache.py
+# run with: python -m unittest chatapp.tests.test_message_cache
+
+def server_text(message_id, room_id=None):
+  return message.create_message(message.config_msg_types['SERVER_TEXT'], msg_body=f'text {message_id}', username='user',
+                                room_id=room_id, message_id=message_id)
+
+
+class Message_Cache_Test(unittest.TestCase):
+  def setUp(self):
+    directory = tempfile.TemporaryDirectory()
+    self.addCleanup(directory.cleanup)
+    self.path = os.path.join(directory.name, 'cache.sqlite3')
+
+  def open_cache(self):
+    cache = message_cache.Message_Cache(self.path, 100)
+    self.addCleanup(cache.close)
+    return cache
+
+  def test_high_water_marks_are_kept_per_room(self):
+    cache = message_cache.Message_Cache(self.path, 100)
+    for msg in (server_text(5, 1), server_text(9, 2), server_text(7, 1), server_text(8)):
+      cache.add(msg)
+    cache.flush()
+    cache.close()
+
+    # a newer message of room 2 doesn't skip what room 1 hasn't received yet
+    self.assertEqual(self.open_cache().room_cursors, {1: 7, 2: 9, None: 8})
+
+  def test_history_pages_do_not_move_high_water_marks(self):
+    cache = self.open_cache()
+    cache.add(server_text(5, 1))
+    cache.add(message.create_message(message.config_msg_types['HISTORY_RESPONSE'], success=True, room_id=1, error_msg='', status_code='',
+                                     messages=[server_text(3, 1), server_text(12, 1)]))
+    cache.flush()
+
+    self.assertEqual(cache.get_room_cursors(), [[1, 5]])
+    self.assertEqual([msg['message_id'] for msg in cache.get_room_messages(1, 10)], [3, 5, 12])
+
+  def test_high_water_mark_of_older_cache_is_after_id(self):
+    conn = sqlite3.connect(self.path)
+    conn.execute('''CREATE TABLE sync_state(name TEXT PRIMARY KEY, value INTEGER);''')
+    conn.execute('''INSERT INTO sync_state (name, value) VALUES ('high_water_mark', 42);''')
+    conn.commit()
+    conn.close()
+
+    cache = self.open_cache()
+    self.assertEqual(cache.after_id, 42)
+    self.assertIsNone(cache.get_room_cursors())
+
+
+if __name__ == '__main__':
+  unittest.main()
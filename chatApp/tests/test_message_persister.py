@@ -0,0 +1,77 @@
+import unittest
+from unittest import mock
+
+from chatapp.server import message_persister
+
+# message ids and write-behind storage, see server/message_persister.py
+# run with: python -m unittest chatapp.tests.test_message_persister
+
+class Message_Id_Allocator_Test(unittest.TestCase):
+  def test_ids_of_workers_follow_allocation_order(self):
+    workers = [message_persister.Message_Id_Allocator(0, index, 4) for index in range(4)]
+    ids = []
+    with mock.patch('time.time') as clock:
+      for now in range(1704067200, 1704067210):
+        clock.return_value = now
+        for worker in reversed(workers):
+          ids.append(worker.next())
+    self.assertEqual(len(set(ids)), len(ids))
+    self.assertEqual(ids[::4], sorted(ids[::4])) # every second is later than the ones before, no matter the worker
+
+  def test_ids_increase_when_clock_goes_back(self):
+    allocator = message_persister.Message_Id_Allocator(0)
+    with mock.patch('time.time', return_value=1704067300):
+      first = [allocator.next() for _ in range(allocator.max_sequence + 10)]
+    with mock.patch('time.time', return_value=1704067200):
+      second = [allocator.next() for _ in range(10)]
+    ids = first + second
+    self.assertEqual(ids, sorted(set(ids)))
+
+  def test_restart_continues_above_stored_ids(self):
+    with mock.patch('time.time', return_value=1704067300):
+      before_crash = message_persister.Message_Id_Allocator(0).next()
+    with mock.patch('time.time', return_value=1704067200): # clock set back before the restart
+      self.assertGreater(message_persister.Message_Id_Allocator(before_crash).next(), before_crash)
+
+
+class Flaky_Connector:
+  def __init__(self, failures):
+    self.failures = failures
+    self.stored = []
+
+  def insert_messages(self, messages):
+    if self.failures:
+      self.failures -= 1
+      raise ConnectionError('connection lost')
+    self.stored.extend(messages)
+
+  def shutdown(self):
+    pass
+
+
+class Message_Persister_Test(unittest.TestCase):
+  def create_persister(self, connector_factory, max_retries):
+    persister = message_persister.Message_Persister(connector_factory, batch_size=10, flush_interval=0.01, max_queue=100,
+                                                    max_retries=max_retries, retry_delay=0)
+    persister.submit(1, 'hello', 1, None)
+    persister.shutdown()
+    return persister
+
+  def test_failed_batch_is_retried_with_new_connector(self):
+    connector = Flaky_Connector(failures=2)
+    factory = mock.Mock(return_value=connector)
+    persister = self.create_persister(factory, max_retries=2)
+    self.assertEqual([row[0] for row in connector.stored], [1])
+    self.assertEqual(factory.call_count, 3)
+    self.assertEqual(persister.failed, 0)
+
+  def test_thread_survives_failing_connector_factory(self):
+    factory = mock.Mock(side_effect=ConnectionError('database is down'))
+    with self.assertLogs('chatapp.server.errors', 'ERROR'):
+      persister = self.create_persister(factory, max_retries=1)
+    self.assertEqual(persister.failed, 1)
+    self.assertFalse(persister.thread.is_alive())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,103 @@
+import http.client, json, threading, unittest
+from unittest import mock
+
+from chatapp.shared import message
+from chatapp.server import server as tcp_server
+from chatapp.server import storage
+from chatapp.client import client as tcp_client
+from chatapp.tests.test_text_limits import find_free_port, wait_for_server
+
+# http api of the notification service, runs against a server on the memory storage backend
+# run with: python -m unittest chatapp.tests.test_notification_service
+
+class Notification_Service_Test(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.port = find_free_port()
+    cls.http_port = find_free_port()
+    db_connector_factory = storage.create_connector_factory({'backend': 'memory'}, None)
+    db_connector = db_connector_factory()
+    for room_name in ('first', 'second'):
+      db_connector.insert_room(room_name)
+    with mock.patch.dict(tcp_server.server_config_notifications, {'http_port': cls.http_port}):
+      cls.server = tcp_server.create_server('select', 'localhost', cls.port, verbose_output=False, db_connector_factory=db_connector_factory)
+    threading.Thread(target=cls.server.listen_for_connections, daemon=True).start()
+    wait_for_server(cls.port)
+
+    # sender is in both rooms, the polling user as well
+    cls.sender = cls.connect_client('sender')
+    cls.connect_client('reader').shutdown_socket()
+    cls.token = cls.request('POST', '/login', {'username': 'reader', 'password': 'password'})[2]['token']
+
+  @classmethod
+  def connect_client(cls, username):
+    client = tcp_client.TCP_Nonblocking_Client('localhost', cls.port, username, 'password', verbose_output=False)
+    client.create_socket()
+    client.connect_to_server(True)
+    for room_id in (1, 2):
+      client.join_room(room_id)
+      while client.receive_next_message()['type'] != message.config_msg_types['ROOM_RESPONSE']:
+        pass
+    return client
+
+  @classmethod
+  def request(cls, method, path, body=None, headers={}):
+    # returns (status, etag, json body or None)
+    connection = http.client.HTTPConnection('localhost', cls.http_port, timeout=10)
+    connection.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+    response = connection.getresponse()
+    data = response.read()
+    connection.close()
+    return response.status, response.getheader('ETag'), json.loads(data) if data else None
+
+  def poll(self, query, if_none_match=None):
+    headers = {'Authorization': f'Bearer {self.token}'}
+    if if_none_match is not None:
+      headers['If-None-Match'] = if_none_match
+    return self.request('GET', f'/notifications?{query}', headers=headers)
+
+  def send_texts(self, texts):
+    # sends (room_id, text) pairs, returns their message_ids once the sender received all of them
+    for room_id, text in texts:
+      self.sender.send_message(text, room_id)
+    message_ids = {}
+    while len(message_ids) < len(texts):
+      msg = self.sender.receive_next_message()
+      if msg.get('username') == 'sender':
+        message_ids[msg['msg_body']] = msg['message_id']
+    return [message_ids[text] for room_id, text in texts]
+
+  def test_etag_changes_with_since(self):
+    first_id, second_id = self.send_texts([(1, 'etag 1'), (1, 'etag 2')])
+
+    status, etag, body = self.poll(f'since={first_id - 1}')
+    self.assertEqual(body['unread'], {'1': 2})
+    # same newest message, but one less unread
+    status, etag_after_read, body = self.poll(f'since={first_id}', if_none_match=etag)
+    self.assertEqual(status, 200)
+    self.assertEqual(body['unread'], {'1': 1})
+    self.assertEqual(self.poll(f'since={first_id}', if_none_match=etag_after_read)[0], 304)
+
+  def test_rooms_are_read_from_their_own_cursor(self):
+    first_id, second_id, third_id = self.send_texts([(1, 'cursor 1'), (2, 'cursor 2'), (1, 'cursor 3')])
+
+    # the newer message of the second room was already read, the older one of the first room wasn't
+    status, etag, body = self.poll(f'cursors=1:{first_id - 1},2:{second_id},all:{third_id}')
+    self.assertEqual(body['unread'], {'1': 2})
+    self.assertEqual([msg['msg_body'] for msg in body['messages']], ['cursor 1', 'cursor 3'])
+    self.assertEqual(body['cursors'], {'1': third_id, '2': second_id, 'all': third_id})
+
+  def test_truncated_rooms_are_keyed_like_cursors(self):
+    first_id, second_id, third_id = self.send_texts([(None, 'truncated 1'), (None, 'truncated 2'), (1, 'truncated 3')])
+
+    with mock.patch.dict(tcp_server.server_config_notifications, {'max_messages_per_poll': 1}):
+      status, etag, body = self.poll(f'cursors=all:{first_id - 1},1:{third_id - 1},2:{third_id}')
+    self.assertEqual(body['unread'], {'all': 2, '1': 1})
+    self.assertEqual(body['truncated'], ['all'])
+
+  def test_malformed_cursors_are_refused(self):
+    self.assertEqual(self.poll('cursors=1-5')[0], 400)
+
+
+if __name__ == '__main__':
+  unittest.main()
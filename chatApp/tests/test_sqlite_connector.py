@@ -0,0 +1,68 @@
+import os, sqlite3, tempfile, unittest
+
+from chatapp.shared import exceptions
+from chatapp.server import sqlite_connector
+
+# unique user names of the sqlite storage backend, see server/sqlite_connector.py
+# run with: python -m unittest chatapp.tests.test_sqlite_connector
+
+class Stale_Select_Cursor:
+  # cursor whose SELECTs find nothing, as if another connection inserted rows right after them
+  def __init__(self, cursor):
+    self.cursor = cursor
+
+  def fetchall(self):
+    return []
+
+  def __getattr__(self, name):
+    return getattr(self.cursor, name)
+
+
+class SQLite_Connector_Test(unittest.TestCase):
+  def setUp(self):
+    directory = tempfile.TemporaryDirectory()
+    self.addCleanup(directory.cleanup)
+    self.path = os.path.join(directory.name, 'chat.sqlite3')
+
+  def open_connector(self):
+    connector = sqlite_connector.SQLite_Connector(self.path, 5)
+    self.addCleanup(connector.shutdown)
+    connector.create_tables_if_needed()
+    return connector
+
+  def create_older_tables(self, user_names):
+    # users table and plain user_name index of older versions
+    conn = sqlite3.connect(self.path)
+    conn.executescript('''CREATE TABLE users(user_id INTEGER PRIMARY KEY AUTOINCREMENT, user_name VARCHAR(32) NOT NULL,
+                                             user_password_hash VARCHAR(255) NOT NULL);
+                          CREATE INDEX users_user_name_idx ON users (user_name);''')
+    conn.executemany('''INSERT INTO users (user_name, user_password_hash) VALUES (?, 'hash');''', [(name,) for name in user_names])
+    conn.commit()
+    conn.close()
+
+  def test_insert_after_stale_select_is_duplicate(self):
+    connector = self.open_connector()
+    connector.insert_user('user', 'hash')
+
+    connector.cursor = Stale_Select_Cursor(connector.cursor)
+    with self.assertRaises(exceptions.DuplicateUserError):
+      connector.insert_user('user', 'hash')
+    self.assertEqual(len(connector.cursor.execute('''SELECT * FROM users;''').fetchall()), 1)
+
+  def test_older_index_is_replaced_by_unique_index(self):
+    self.create_older_tables(['first', 'second'])
+    connector = self.open_connector()
+    self.assertTrue(connector.index_exists('users_user_name_key'))
+    self.assertFalse(connector.index_exists('users_user_name_idx'))
+
+  def test_duplicate_names_of_older_tables_are_kept(self):
+    self.create_older_tables(['first', 'second', 'first'])
+    with self.assertLogs('chatapp.server', 'WARNING'):
+      connector = self.open_connector()
+    self.assertFalse(connector.index_exists('users_user_name_key'))
+    self.assertTrue(connector.index_exists('users_user_name_idx'))
+    self.assertEqual(connector.get_duplicate_user_names(), ['first'])
+
+
+if __name__ == '__main__':
+  unittest.main()
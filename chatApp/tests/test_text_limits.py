@@ -0,0 +1,108 @@
+import socket, threading, time, unittest
+from unittest import mock
+
+from chatapp.shared import message
+from chatapp.server import server as tcp_server
+from chatapp.server import storage
+from chatapp.client import client as tcp_client
+
+# regression tests for texts whose SERVER_TEXT doesn't fit a frame, which used to stop the select engine's loop thread
+# (and a broadcast of the asyncio engine halfway), every test runs against a server on the memory storage backend
+# run with: python -m unittest chatapp.tests.test_text_limits
+
+def find_free_port():
+  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+    sock.bind(('localhost', 0))
+    return sock.getsockname()[1]
+
+def wait_for_server(port, timeout=5):
+  deadline = time.monotonic() + timeout
+  while True:
+    try:
+      socket.create_connection(('localhost', port)).close()
+      return
+    except ConnectionRefusedError:
+      if time.monotonic() > deadline:
+        raise
+      time.sleep(0.05)
+
+
+class Text_Limits_Test:
+  # runs on both engines, see the subclasses below
+  engine = None
+
+  @classmethod
+  def setUpClass(cls):
+    cls.port = find_free_port()
+    db_connector_factory = storage.create_connector_factory({'backend': 'memory'}, None)
+    cls.server = tcp_server.create_server(cls.engine, 'localhost', cls.port, verbose_output=False, db_connector_factory=db_connector_factory)
+    cls.server_thread = threading.Thread(target=cls.server.listen_for_connections, daemon=True)
+    cls.server_thread.start()
+    wait_for_server(cls.port)
+    cls.user_count = 0
+
+  def connect_client(self, codecs=message.supported_codecs):
+    type(self).user_count += 1
+    client = tcp_client.TCP_Nonblocking_Client('localhost', self.port, f'{self.engine}_user{self.user_count}', 'password', verbose_output=False)
+    client.create_socket()
+    with mock.patch.object(message, 'supported_codecs', codecs): # codecs the client offers
+      connected, error_msg = client.connect_to_server(True)
+    self.assertTrue(connected, error_msg)
+
+    threading.Thread(target=client.read_message_loop, daemon=True).start()
+    self.addCleanup(client.shutdown_socket)
+    return client
+
+  def receive_type(self, client, type, username=None, timeout=10):
+    # next received message of the given type (sent by username), anything else (ex. backfill of earlier tests) is skipped
+    deadline = time.monotonic() + timeout
+    while True:
+      msg = client.received_messages.get(timeout=max(deadline - time.monotonic(), 0.01))
+      if msg['type'] == message.config_msg_types[type] and username in (None, msg.get('username')):
+        return msg
+
+  def test_text_over_limit_is_refused(self):
+    sender = self.connect_client()
+    # sent as a raw frame, the client itself refuses texts over the limit
+    sender.send(message.create_message(message.config_msg_types['CLIENT_TEXT'], msg_body='x' * (message.max_text_length + 1)))
+
+    response = self.receive_type(sender, 'TEXT_RESPONSE')
+    self.assertFalse(response['success'])
+    self.assertEqual(response['status_code'], '413')
+    self.assertEqual(sender.send_message('x' * (message.max_text_length + 1)), (False, 'Message is too long'))
+
+  def test_text_at_limit_is_broadcast(self):
+    # every character is escaped by json (😀 becomes two \uXXXX escapes), the largest SERVER_TEXT an accepted text can turn into
+    sender = self.connect_client(['binary'])
+    receiver = self.connect_client(['json'])
+    body = '\U0001F600' * message.max_text_length
+    self.assertEqual(sender.send_message(body), (True, ''))
+
+    self.assertEqual(self.receive_type(receiver, 'SERVER_TEXT', sender.username, timeout=30)['msg_body'], body)
+    self.assertTrue(self.server_thread.is_alive())
+
+  def test_broadcast_skips_message_that_does_not_fit(self):
+    sender = self.connect_client()
+    receiver = self.connect_client()
+
+    # can't be sent by a client anymore, queued the way handle_client_text queues it
+    too_large = message.create_message(type=message.config_msg_types['SERVER_TEXT'], msg_body='x' * message.max_frame_size,
+                                       username='nobody', message_id=self.server.message_ids.next())
+    self.server.client_messages.put(too_large)
+    sender.send_message('after')
+
+    self.assertEqual(self.receive_type(receiver, 'SERVER_TEXT', sender.username)['msg_body'], 'after')
+    self.assertTrue(self.server_thread.is_alive())
+    self.connect_client() # server still accepts logins
+
+
+class Select_Text_Limits_Test(Text_Limits_Test, unittest.TestCase):
+  engine = 'select'
+
+
+class Asyncio_Text_Limits_Test(Text_Limits_Test, unittest.TestCase):
+  engine = 'asyncio'
+
+
+if __name__ == '__main__':
+  unittest.main()